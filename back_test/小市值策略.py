@@ -3,7 +3,7 @@ import backtrader as bt
 import pandas as pd
 import numpy as np
 import datetime
-from base.stock_processor import SingleStockDataProcessor
+from base.stock_processor import PanelStockDataProcessor, SingleStockDataProcessor
 from base.config import PathConfig
 import quantstats
 import webbrowser
@@ -11,7 +11,13 @@ import os
 import matplotlib.pyplot as plt  # 由于 Backtrader 的问题，此处要求 pip install matplotlib==3.2.2
 from base.log import performance_log
 from multiprocessing import Pool, cpu_count
+from collections import deque
+from itertools import islice
+from base.column_block import ColumnBlock
 from base.fast_cerebro import FastCerebro
+from base.incremental_processor import IncrementalStockProcessor
+from base.panel_data import PanelData
+from base.stock_store import StockStore
 from base.base_stock_strategy import BaseStockStrategy, StampDutyCommissionScheme
 
 # 设置字体
@@ -22,6 +28,13 @@ plt.rcParams["axes.unicode_minus"] = False  # 设置画图时的负号显示
 
 
 class SmallCapStockDataProcessor(SingleStockDataProcessor):
+    # 计算涨跌停、复权价格、补全停牌日期以及 format_data 用到的原始列
+    read_columns = [
+        "股票代码", "股票名称", "开盘价", "最高价", "最低价", "收盘价", "前收盘价", "成交量", "成交额", "总市值",
+    ]
+    # 成交额只在停牌日补 0，不参与计算；总市值用于排序选股，保持 float64
+    read_dtypes = {"股票名称": "category", "成交额": "float32"}
+
     @staticmethod
     def format_data(df):
         df = df[
@@ -125,7 +138,7 @@ class SmallCapStrategy(BaseStockStrategy):
         super().execute_trade_logic()
         self.rebalance_portfolio()
 
-    def rebalance_portfolio(self):
+    def select_stocks(self):
         # 过滤掉涨停、停牌、nan值的数据
         datas_filtered = list(
             filter(
@@ -139,9 +152,12 @@ class SmallCapStrategy(BaseStockStrategy):
             )
         )
         # 按照市值排序
-        datas_new_position = sorted(datas_filtered, key=lambda x: x.market_cap[0])[
+        return sorted(datas_filtered, key=lambda x: x.market_cap[0])[
             : self.p.num_stocks
         ]
+
+    def rebalance_portfolio(self):
+        datas_new_position = self.select_stocks()
         # 删除不在继续持有的股票，进而释放资金用于买入新的股票
         datas_position = [d for d, pos in self.getpositions().items() if pos]
         performance_log.debug(f"现有持仓个数：{len(datas_position)}")
@@ -209,30 +225,99 @@ class SmallCapStrategy(BaseStockStrategy):
             )
 
 
-def process_stock(args):
+class SmallCapPanelStrategy(SmallCapStrategy):
+    """
+    面板数据版本的小市值策略，self.datas[0] 为 PanelData。
+    用当前 bar 的横截面数组一次性完成过滤和按市值排序。
+
+    不支持 PyFolio、PositionsValue 等按 feed 统计持仓的分析器(面板 feed 的价格为 0)，
+    收益率用 TimeReturn 统计。
+    """
+
+    def select_stocks(self):
+        panel = self.datas[0]
+        market_cap = panel.cross_section("market_cap")
+        # 过滤掉涨停、停牌、nan值的数据
+        mask = (
+            ~np.isnan(market_cap)
+            & (panel.cross_section("is_trade") == 1.0)
+            & (panel.cross_section("is_st") == 0.0)
+            & (panel.cross_section("is_delisting") == 0.0)
+            & (panel.cross_section("limit_up") == 0.0)
+        )
+        candidates = np.flatnonzero(mask)
+        # 按照市值排序，稳定排序保证与逐只股票版本的顺序一致
+        selected = candidates[np.argsort(market_cap[candidates], kind="stable")][
+            : self.p.num_stocks
+        ]
+        return [panel.stocks[i] for i in selected]
+
+
+# 所有股票共用的加载参数，由 init_loader 在每个进程中设置一次
+_loader_context = {}
+
+
+def init_loader(data_path, start_date, end_date, index_data, store_dir=None, incremental_dir=None, block_dir=None):
+    """
+    进程池的初始化函数：每个工作进程只接收一次共用的参数(包括指数数据)，任务只传股票代码，
+    不再为每只股票序列化一次指数数据。
+
+    :param data_path: 股票 CSV 所在目录
+    :param start_date: 开始日期
+    :param end_date: 结束日期
+    :param index_data: 指数数据
+    :param store_dir: 列式存储目录，None 表示读取 CSV
+    :param incremental_dir: 增量处理结果目录，None 表示每次完整处理
+    :param block_dir: 处理结果的内存映射文件目录，None 表示通过进程间通信返回数据
+    """
+    _loader_context.update(
+        data_path=data_path,
+        start_date=start_date,
+        end_date=end_date,
+        index_data=index_data,
+        store_dir=store_dir,
+        incremental_dir=incremental_dir,
+        block_dir=block_dir,
+    )
+
+
+def process_stock(stock_code):
     """
     处理股票数据。
 
-    该函数接收一组参数，包括CSV文件名、数据路径、开始日期、结束日期和指数数据。
+    共用的参数(数据路径、开始日期、结束日期、指数数据等)由 init_loader 预先设置。
     它的目的是处理指定股票的数据，并返回处理后的股票代码和数据对象。
 
-    :param args: 元组，包含CSV文件名、数据路径、开始日期、结束日期和指数数据。
-    :return: 如果处理成功，返回股票代码和SmallCapData对象；如果数据为空，则返回None。
+    :param stock_code: 股票代码
+    :return: 如果处理成功，返回股票代码和 ColumnBlock(由主进程创建 SmallCapData)，
+        设置了 block_dir 时返回 ColumnBlock 文件的路径；如果数据为空，则返回None。
     """
-    # 从CSV文件名中提取股票代码
-    csv_file, data_path, start_date, end_date, index_data = args
-    stock_code = csv_file.split(".")[0]
+    context = _loader_context
+    data_path = context["data_path"]
+    start_date = context["start_date"]
+    end_date = context["end_date"]
+    index_data = context["index_data"]
+    store_dir = context["store_dir"]
+    incremental_dir = context["incremental_dir"]
 
     # 构建股票数据文件的完整路径
     read_file_path = os.path.join(data_path, "%s.csv")
 
     # 初始化股票数据处理器
     processor = SmallCapStockDataProcessor(
-        stock_code, read_file_path, start_date, end_date
+        stock_code,
+        read_file_path,
+        start_date,
+        end_date,
+        store=StockStore(store_dir) if store_dir and not incremental_dir else None,
     )
 
     # 处理股票数据
-    stock_df = processor.process_stock_data(index_data=index_data)
+    if incremental_dir:
+        # 只处理 CSV 新追加的交易日，历史数据被修改时自动完整重建
+        stock_df = IncrementalStockProcessor(processor, incremental_dir).update(index_data=index_data)
+    else:
+        stock_df = processor.process_stock_data(index_data=index_data)
 
     # 如果处理后的数据为空，则记录警告并返回None
     if stock_df.empty:
@@ -241,9 +326,90 @@ def process_stock(args):
         )
         return None, None
 
-    # 创建并返回股票数据对象
-    data = SmallCapData(dataname=stock_df, fromdate=start_date, todate=end_date)
-    return stock_code, data
+    # 只返回数据数组，不在工作进程中创建 feed，减少序列化和传输的数据量
+    block = ColumnBlock.from_frame(stock_df)
+    if context["block_dir"]:
+        path = os.path.join(context["block_dir"], "%s.npy" % stock_code)
+        block.save(path)
+        return stock_code, path
+    return stock_code, block
+
+
+def process_stocks(stock_codes):
+    """
+    处理一组股票，返回 process_stock 的结果列表。进程池按组分发，减少进程间通信的次数。
+    """
+    return [process_stock(stock_code) for stock_code in stock_codes]
+
+
+def iter_stocks(stock_codes, data_path, start_date, end_date, index_data,
+                store_dir=None, incremental_dir=None, block_dir=None, use_multiprocessing=True, window=None):
+    """
+    逐只产出 (股票代码, SmallCapData)，顺序与 stock_codes 相同，没有数据的股票被跳过。
+
+    股票按组分发给进程池，每组处理完就在主进程中创建 feed 并产出，调用方可以一边接收一边 adddata，
+    与其余股票的处理同时进行，不必等所有股票处理完。最多有 window 组已分发但还没有产出
+    (正在处理或已完成等待前面的组)，主进程持有的中间结果数量有上限。
+
+    :param block_dir: 工作进程把处理结果写入该目录，主进程以内存映射方式读取，回测期间须保留该目录
+    :param use_multiprocessing: 是否使用多进程
+    :param window: 已分发但还没有产出的组数上限，None 表示工作进程数的 2 倍
+    """
+    if block_dir:
+        os.makedirs(block_dir, exist_ok=True)
+    initargs = (data_path, start_date, end_date, index_data, store_dir, incremental_dir, block_dir)
+
+    def to_feeds(results):
+        for stock_code, block in results:
+            if stock_code is not None:
+                if isinstance(block, str):
+                    block = ColumnBlock.load(block)
+                yield stock_code, SmallCapData(dataname=block.to_frame(), fromdate=start_date, todate=end_date)
+
+    if not use_multiprocessing:
+        init_loader(*initargs)
+        yield from to_feeds(process_stock(stock_code) for stock_code in stock_codes)
+        return
+
+    processes = max(cpu_count() - 1, 1)
+    window = window or processes * 2
+    # 任务只有股票代码，按组分发；每个工作进程约 4 组，保证各进程的负载均衡
+    chunksize = max(1, len(stock_codes) // (processes * 4))
+    chunks = (stock_codes[i:i + chunksize] for i in range(0, len(stock_codes), chunksize))
+    pool = Pool(processes, initializer=init_loader, initargs=initargs)
+    try:
+        pending = deque(pool.apply_async(process_stocks, (chunk,)) for chunk in islice(chunks, window))
+        while pending:
+            results = pending.popleft().get()
+            # 先分发下一组，再在主进程中创建 feed，两者同时进行
+            for chunk in islice(chunks, 1):
+                pending.append(pool.apply_async(process_stocks, (chunk,)))
+            yield from to_feeds(results)
+    finally:
+        # 调用方提前结束时，等待已分发的组(最多 window 组)处理完再退出。
+        # 不使用 terminate：工作进程正在发送结果时终止进程池可能一直等待
+        pool.close()
+        pool.join()
+
+
+def load_stocks(stock_codes, data_path, start_date, end_date, index_data,
+                store_dir=None, incremental_dir=None, block_dir=None, use_multiprocessing=True):
+    """
+    加载所有股票，返回 {股票代码: SmallCapData}，没有数据的股票被跳过。参数同 iter_stocks。
+    """
+    return dict(
+        iter_stocks(
+            stock_codes,
+            data_path,
+            start_date,
+            end_date,
+            index_data,
+            store_dir=store_dir,
+            incremental_dir=incremental_dir,
+            block_dir=block_dir,
+            use_multiprocessing=use_multiprocessing,
+        )
+    )
 
 
 if __name__ == "__main__":
@@ -251,12 +417,15 @@ if __name__ == "__main__":
     output_base = os.path.splitext(os.path.basename(__file__))[
         0
     ]  # 获取当前文件名，去掉路径和扩展名
-    cache_file = os.path.join(
-        PathConfig.data_folder, f"{output_base}.joblib"
-    )  # 拼接路径和新文件名
+    cache_dir = os.path.join(
+        PathConfig.data_folder, f"{output_base}_cache"
+    )  # 预加载缓存目录
     output_file = os.path.join(
         PathConfig.data_folder, f"{output_base}.html"
     )  # 拼接路径和新文件名
+    checkpoint_file = os.path.join(
+        PathConfig.data_folder, f"{output_base}_checkpoint.pkl"
+    )  # 回测状态快照，延长回测区间时从快照继续
     # 创建Cerebro实例
     cerebro = FastCerebro()
     # 回测时间段
@@ -273,30 +442,77 @@ if __name__ == "__main__":
     data_path = PathConfig.stock_daily_folder
     csv_files = [f for f in os.listdir(data_path) if f.endswith(".csv")]
     csv_files = [f for f in csv_files if "bj" not in f]  # 过滤掉北交所股票
+    # 是否使用列式存储，默认为False。首次使用时把 CSV 一次性转换为 Parquet，之后只读取需要的列和日期范围
+    store_enabled = False
+    store_dir = os.path.join(PathConfig.data_folder, "stock_store") if store_enabled else None
+    if store_enabled:
+        StockStore(store_dir).convert_folder(data_path)
+    # 是否增量处理，默认为False。每天 CSV 只追加新的交易日时，只处理新增的数据(与列式存储互斥，直接读取 CSV)
+    incremental_enabled = False
+    incremental_dir = os.path.join(PathConfig.data_folder, f"{output_base}_processed") if incremental_enabled else None
+    # 是否通过内存映射文件取回处理结果，默认为False。数据不经过进程间通信，主进程按需载入
+    block_enabled = False
+    block_dir = os.path.join(PathConfig.data_folder, f"{output_base}_blocks") if block_enabled else None
     #
     # ## 2.加载数据到Cerebro
-    args_list = [(csv_file, data_path, start_date, end_date, index_data) for csv_file in csv_files]
+    stock_codes = [csv_file.split(".")[0] for csv_file in csv_files]
+    # 是否整个市场一次性处理(面板模式)，默认为False。结果与逐只股票处理相同
+    panel_processing_enabled = False
     # 是否启用多进程，默认为True
     multiprocessing_enabled = True
-    if multiprocessing_enabled:
-        # 使用多进程处理
-        with Pool(max(cpu_count() - 1, 1)) as pool:
-            results = pool.map(process_stock, args_list)
+    if panel_processing_enabled:
+        panel_processor = PanelStockDataProcessor(
+            stock_codes,
+            os.path.join(data_path, "%s.csv"),
+            start_date,
+            end_date,
+            store=StockStore(store_dir) if store_dir else None,
+            processor_class=SmallCapStockDataProcessor,
+        )
+        stocks = (
+            (stock_code, SmallCapData(dataname=stock_df, fromdate=start_date, todate=end_date))
+            for stock_code, stock_df in panel_processor.process_stocks(index_data=index_data).items()
+        )
     else:
-        # 单进程处理
-        results = [process_stock(args) for args in args_list]
-
-    # 过滤并构造字典
-    stock_data_dict = {result[0]: result[1] for result in results if result[0] is not None}
+        # 流式加载：每只股票处理完就创建 feed，按 stock_codes 的顺序产出
+        stocks = iter_stocks(
+            stock_codes,
+            data_path,
+            start_date,
+            end_date,
+            index_data,
+            store_dir=store_dir,
+            incremental_dir=incremental_dir,
+            block_dir=block_dir,
+            use_multiprocessing=multiprocessing_enabled,
+        )
 
-    performance_log.info(f"Loaded {len(stock_data_dict)} stocks.")
-    # 加载数据到Cerebro
-    for stock_code, data in stock_data_dict.items():
-        # performance_log.debug(f"Loaded {stock_code}")
-        cerebro.adddata(data, name=stock_code)  # 将数据加载到Cerebro中
+    # 是否使用面板数据(整个股票池一个 feed)，默认为False
+    panel_enabled = False
+    if panel_enabled:
+        stock_data_dict = dict(stocks)
+        performance_log.info(f"Loaded {len(stock_data_dict)} stocks.")
+        panel = PanelData.from_frames(
+            {stock_code: data.p.dataname for stock_code, data in stock_data_dict.items()},
+            fromdate=start_date,
+            todate=end_date,
+        )
+        cerebro.adddata(panel, name="panel")
+    else:
+        # 加载数据到Cerebro，与其余股票的处理同时进行
+        n_stocks = 0
+        for stock_code, data in stocks:
+            # performance_log.debug(f"Loaded {stock_code}")
+            cerebro.adddata(data, name=stock_code)  # 将数据加载到Cerebro中
+            n_stocks += 1
+        performance_log.info(f"Loaded {n_stocks} stocks.")
     performance_log.info(f"adddata done")
     # 添加策略
-    cerebro.addstrategy(SmallCapStrategy, period_type="week", n_periods=1)
+    cerebro.addstrategy(
+        SmallCapPanelStrategy if panel_enabled else SmallCapStrategy,
+        period_type="week",
+        n_periods=1,
+    )
 
     # 初始资金 100,000,00
     cerebro.broker.setcash(1000000.0)
@@ -306,7 +522,11 @@ if __name__ == "__main__":
     cerebro.broker.addcommissioninfo(comm_info)
 
     # 添加分析器
-    cerebro.addanalyzer(bt.analyzers.PyFolio, _name="pyfolio")
+    # 面板模式下 PyFolio 统计的持仓没有意义(面板 feed 的价格为 0)，只用 TimeReturn 记录每日收益率
+    if panel_enabled:
+        cerebro.addanalyzer(bt.analyzers.TimeReturn, timeframe=bt.TimeFrame.Days, _name="time_return")
+    else:
+        cerebro.addanalyzer(bt.analyzers.PyFolio, _name="pyfolio")
 
     # 策略执行
     performance_log.info("期初总资金: %.2f" % cerebro.broker.getvalue())
@@ -316,21 +536,28 @@ if __name__ == "__main__":
         preload=False,
         # cache_data=True,
         # replace_cache_data=False,
-        # cache_file_path=cache_file,
+        # cache_dir=cache_dir,
+        # checkpoint_file=checkpoint_file,  # 回测结束时保存快照
+        # resume_file=checkpoint_file,  # 追加新交易日后从上次的快照继续，只模拟新增的 bar
     )  # 用单核 CPU 做优化, 禁用观察者用以提高执行速度,不做预加载
     performance_log.info("最终资金: %.2f" % cerebro.broker.getvalue())
     stats = results[0]
 
-    # 初始化投资组合统计分析器
-    portfolio_stats = stats.analyzers.getbyname("pyfolio")
-    # 从分析器中提取投资组合的回报、头寸、交易和杠杆数据
-    # returns: 时间序列的每日收益率。
-    # positions: 每个交易日的投资组合仓位信息。
-    # transactions: 所有交易的记录，包括买卖操作。
-    # gross_lev: 总杠杆，即投资组合的总市场价值除以净资本。
-    returns, positions, transactions, gross_lev = portfolio_stats.get_pf_items()
-    # 转换回报率指数的时区，确保时间序列的一致性
-    returns.index = returns.index.tz_convert(None)
+    if panel_enabled:
+        # 每日收益率，与 PyFolio 的 returns 相同
+        returns = pd.Series(stats.analyzers.getbyname("time_return").get_analysis(), name="return")
+        returns.index = pd.to_datetime(returns.index)
+    else:
+        # 初始化投资组合统计分析器
+        portfolio_stats = stats.analyzers.getbyname("pyfolio")
+        # 从分析器中提取投资组合的回报、头寸、交易和杠杆数据
+        # returns: 时间序列的每日收益率。
+        # positions: 每个交易日的投资组合仓位信息。
+        # transactions: 所有交易的记录，包括买卖操作。
+        # gross_lev: 总杠杆，即投资组合的总市场价值除以净资本。
+        returns, positions, transactions, gross_lev = portfolio_stats.get_pf_items()
+        # 转换回报率指数的时区，确保时间序列的一致性
+        returns.index = returns.index.tz_convert(None)
     # df_weekly_returns = returns.resample('W').agg(lambda x: (1 + x).prod() - 1).shift(-1)
     # df_yearly_returns = returns.resample('Y').agg(lambda x: (1 + x).prod() - 1).shift(-1)
     # print(df_weekly_returns)
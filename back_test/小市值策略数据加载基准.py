@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+import pickle
+import time
+import tracemalloc
+from multiprocessing import Pool, cpu_count
+
+from back_test.小市值策略 import (
+    SmallCapData,
+    SmallCapStockDataProcessor,
+    init_loader,
+    iter_stocks,
+    load_stocks,
+    process_stock,
+)
+from base.column_block import ColumnBlock
+from base.config import PathConfig
+from base.fast_cerebro import FastCerebro
+from base.log import performance_log
+from base.stock_processor import SingleStockDataProcessor
+
+
+def process_stock_with_args(args):
+    """
+    旧的任务格式：每个任务都携带完整的参数元组(包括指数数据)。
+    """
+    stock_code, initargs = args
+    init_loader(*initargs)
+    return process_stock(stock_code)
+
+
+def load_stocks_with_args(stock_codes, initargs):
+    with Pool(max(cpu_count() - 1, 1)) as pool:
+        results = pool.map(process_stock_with_args, [(stock_code, initargs) for stock_code in stock_codes])
+    return {stock_code: block for stock_code, block in results if stock_code is not None}
+
+
+def load_into_cerebro(stock_codes, *args):
+    """
+    流式加载：每只股票处理完就 adddata。
+    """
+    cerebro = FastCerebro()
+    for stock_code, data in iter_stocks(stock_codes, *args):
+        cerebro.adddata(data, name=stock_code)
+    return cerebro.datas
+
+
+def measure(name, func, *args):
+    """
+    记录加载的耗时和主进程的内存峰值(Python 对象分配，包括序列化任务的缓冲区)。
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    performance_log.info(
+        "%s: %d stocks, %.2fs, parent peak %.1f MB" % (name, len(result), elapsed, peak / 2 ** 20)
+    )
+    return result
+
+
+if __name__ == "__main__":
+    start_date = datetime.datetime(2008, 1, 1)
+    end_date = datetime.datetime(2022, 12, 31)
+    index_data = SingleStockDataProcessor.import_index_data(
+        "F:/stock_data/index_data/sh000001.csv",
+        back_trader_start=start_date,
+        back_trader_end=end_date,
+    )
+    data_path = PathConfig.stock_daily_folder
+    stock_codes = [f.split(".")[0] for f in os.listdir(data_path) if f.endswith(".csv") and "bj" not in f]
+    initargs = (data_path, start_date, end_date, index_data, None, None)
+
+    # 每个任务序列化后的大小
+    performance_log.info(
+        "task payload: with index data %d bytes, stock code only %d bytes"
+        % (len(pickle.dumps((stock_codes[0], initargs))), len(pickle.dumps(stock_codes[0])))
+    )
+    # 每只股票返回的数据序列化后的大小：feed 对象与 ColumnBlock
+    stock_df = SmallCapStockDataProcessor(
+        stock_codes[0], os.path.join(data_path, "%s.csv"), start_date, end_date
+    ).process_stock_data(index_data=index_data)
+    feed = SmallCapData(dataname=stock_df, fromdate=start_date, todate=end_date)
+    block = ColumnBlock.from_frame(stock_df)
+    performance_log.info(
+        "result payload: feed %d bytes, column block %d bytes"
+        % (len(pickle.dumps(feed)), len(pickle.dumps(block)))
+    )
+    measure("index data per task", load_stocks_with_args, stock_codes, initargs)
+    measure("index data per worker", load_stocks, stock_codes, *initargs)
+    measure("streaming into cerebro", load_into_cerebro, stock_codes, *initargs)
+    block_dir = os.path.join(PathConfig.data_folder, "小市值策略数据加载基准_blocks")
+    measure("memory-mapped results", load_stocks, stock_codes, *initargs, block_dir)
@@ -2,9 +2,10 @@
 import backtrader as bt
 from datetime import datetime
 from base.stock_processor import SingleStockDataProcessor
-import pandas as pd
 from base.log import performance_log
 from base.config import PathConfig
+from base.fast_cerebro import FastCerebro
+from base.opt_results import records_to_frame
 
 
 class CustomData(bt.feeds.PandasData):
@@ -151,7 +152,7 @@ class SmaStrategy(bt.Strategy):
 
 
 def main(code="sz000002"):
-    cerebro = bt.Cerebro()  # 创建主控制器
+    cerebro = FastCerebro()  # 创建主控制器
     cerebro.optstrategy(
         SmaStrategy, period_short=range(5, 20, 1), period_long=range(20, 100, 1)
     )  # 导入策略参数寻优
@@ -190,25 +191,22 @@ def main(code="sz000002"):
     cerebro.addanalyzer(bt.analyzers.PyFolio, _name="pyfolio")
     performance_log.info("Starting Portfolio Value: %.2f" % cerebro.broker.getvalue())
     performance_log.info("期初总资金: %.2f" % cerebro.broker.getvalue())
-    back = cerebro.run(maxcpus=None, stdstats=False)  # 用最大cpu做优化
+    back = cerebro.run(
+        maxcpus=None,
+        stdstats=False,
+        # 子进程只返回参数和以下指标，不再回传分析器对象
+        opt_records=[
+            ("return", "returns.rnorm"),
+            ("dd", "drawdown.max.drawdown"),
+            ("sharpe", "SharpeRatio.sharperatio"),
+        ],
+    )  # 用最大cpu做优化
     performance_log.info("最终资金: %.2f" % cerebro.broker.getvalue())
-    # 构建优化结果
-    par_list = [
-        [
-            x[0].params.period_short,
-            x[0].params.period_long,
-            x[0].analyzers.returns.get_analysis()["rnorm"],
-            x[0].analyzers.drawdown.get_analysis()["max"]["drawdown"],
-            x[0].analyzers.SharpeRatio.get_analysis()["sharperatio"],
-        ]
-        for x in back
+    # 构建优化结果，结果转成dataframe
+    par_df = records_to_frame([x[0] for x in back])[
+        ["period_short", "period_long", "return", "dd", "sharpe"]
     ]
 
-    # 结果转成dataframe
-    par_df = pd.DataFrame(
-        par_list, columns=["period_short", "period_long", "return", "dd", "sharpe"]
-    )
-
     print(par_df.head())
     output_file = PathConfig.data_optimized_folder + "择时策略优化.csv"
     par_df.to_csv(output_file)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import os
+from datetime import datetime
+
+from back_test.择时策略优化 import CustomData, SmaStrategy
+from base.config import PathConfig
+from base.fast_cerebro import FastCerebro
+from base.log import performance_log
+from base.stock_processor import SingleStockDataProcessor
+from base.walk_forward import WalkForward
+
+
+def main(code="sz000002"):
+    output_base = os.path.splitext(os.path.basename(__file__))[0]  # 获取当前文件名，去掉路径和扩展名
+    cerebro = FastCerebro()  # 创建主控制器，策略由滚动优化按窗口添加
+    # 读取股票数据
+    data_path = "E:/邢不行量化课程学习/代码/xbx_stock_2019-pro/xbx_stock_2019/data/择时策略-回测/"
+    read_file_path = data_path + "%s.csv"
+
+    processor = SingleStockDataProcessor(code, read_file_path)
+    stock_df = processor.process_stock_data()
+
+    # 加载数据
+    start_date = datetime(2008, 1, 1)  # 回测开始时间
+    end_date = datetime(2018, 12, 31)  # 回测结束时间
+    data = CustomData(
+        dataname=stock_df, fromdate=start_date, todate=end_date
+    )  # 规范化数据格式
+    cerebro.adddata(data, name=code)  # 将数据加载至回测系统
+    # 初始资金 100,000,00
+    cerebro.broker.setcash(1000000.0)
+    # 佣金，双边各 0.0003
+    cerebro.broker.setcommission(commission=0.0003)
+    # 滑点：双边各 0.0001
+    cerebro.broker.set_slippage_perc(perc=0.0001)
+    cerebro.p.stdstats = False  # 禁用观察者用以提高执行速度
+
+    # 训练窗口约两年、测试窗口约半年(按交易日计)，每次向后滚动一个测试窗口
+    walk_forward = WalkForward(
+        cerebro,
+        SmaStrategy,
+        params=dict(period_short=range(5, 20, 1), period_long=range(20, 100, 5)),
+        train=500,
+        test=120,
+        maxcpus=None,  # 用最大cpu做优化
+    )
+    result = walk_forward.run()
+
+    print(result.windows)
+    performance_log.info("样本外总收益: %.4f" % (result.equity.iloc[-1] / cerebro.broker.startingcash - 1))
+    result.windows.to_csv(PathConfig.data_optimized_folder + f"{output_base}.csv")
+    result.equity.to_csv(PathConfig.data_optimized_folder + f"{output_base}_equity.csv")
+
+
+if __name__ == "__main__":
+    main(code="sz000002")
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import time
+from decimal import Decimal, ROUND_HALF_UP
+
+import numpy as np
+import pandas as pd
+
+from base.incremental_processor import IncrementalStockProcessor
+from base.log import performance_log
+from base.stock_processor import SingleStockDataProcessor, StockDataProcessor, round_half_up
+
+
+def decimal_round_half_up(x, decimals=2):
+    """
+    round_half_up 原来的实现：逐个元素用 Decimal 四舍五入。
+    """
+    scale = 10 ** decimals
+    return float(Decimal(x * scale).quantize(Decimal('1'), rounding=ROUND_HALF_UP) / scale)
+
+
+def merge_with_index_data_by_fillna(df, index_data):
+    """
+    merge_with_index_data 原来的实现：right merge 之后逐步 fillna。
+    """
+    df = pd.merge(left=df, right=index_data, on="交易日期", how="right", sort=True, indicator=True)
+    df["收盘价"] = df["收盘价"].ffill()
+    df["开盘价"] = df["开盘价"].fillna(df["收盘价"])
+    df["最高价"] = df["最高价"].fillna(df["收盘价"])
+    df["最低价"] = df["最低价"].fillna(df["收盘价"])
+    df["前收盘价"] = df["前收盘价"].fillna(df["收盘价"].shift())
+    fill_0_list = ["成交量", "成交额"]
+    df.loc[:, fill_0_list] = df[fill_0_list].fillna(value=0)
+    df = df.bfill().ffill()
+    df["是否交易"] = True
+    df.loc[df["_merge"] == "right_only", "是否交易"] = False
+    del df["_merge"]
+    df["下日_是否交易"] = df["是否交易"].shift(-1)
+    df.reset_index(drop=True, inplace=True)
+    return df
+
+
+def benchmark_round_half_up(rng, n_stocks, n_days):
+    """
+    全市场规模的涨跌停价四舍五入，与逐个元素的 Decimal 结果逐位比较。
+    """
+    pre_close = np.round(rng.lognormal(2.5, 0.8, n_stocks * n_days), 2)
+    ratio = rng.choice([1.1, 0.9, 1.05, 0.95, 1.2, 0.8, 1.3, 0.7], pre_close.size)
+    prices = pre_close * ratio
+    # 浮点边界：恰好在 0.005 上的十进制价格，以及正好在其左右的相邻浮点数
+    edges = np.arange(1, 100000) / 1000.0
+    prices = np.concatenate([prices, edges, np.nextafter(edges, 0), np.nextafter(edges, np.inf), [0.0, np.nan]])
+
+    start = time.perf_counter()
+    vectorized = round_half_up(prices)
+    vectorized_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = np.array([decimal_round_half_up(x) for x in prices])
+    decimal_time = time.perf_counter() - start
+
+    assert np.array_equal(vectorized, expected, equal_nan=True)
+    performance_log.info(
+        "round_half_up %d values: vectorized %.3fs, Decimal %.3fs, %.0fx"
+        % (prices.size, vectorized_time, decimal_time, decimal_time / vectorized_time)
+    )
+
+
+def benchmark_merge_with_index_data(rng, n_days, repeat=200):
+    """
+    单只股票与指数交易日历对齐，约 10% 的日期停牌，与 right merge 之后逐步 fillna 的结果比较。
+    """
+    dates = pd.bdate_range("2008-01-01", periods=n_days)
+    index_data = pd.DataFrame({"交易日期": dates, "指数涨跌幅": rng.normal(0, 0.01, n_days)})
+    trade_dates = dates[rng.random(n_days) > 0.1]
+    close = np.round(10 * np.exp(np.cumsum(rng.normal(0, 0.02, len(trade_dates)))), 2)
+    stock_df = pd.DataFrame({
+        "股票代码": "sh600000",
+        "股票名称": "测试股份",
+        "交易日期": trade_dates,
+        "开盘价": close,
+        "最高价": close,
+        "最低价": close,
+        "收盘价": close,
+        "前收盘价": np.concatenate([[close[0]], close[:-1]]),
+        "成交量": rng.integers(1000, 100000, len(trade_dates)).astype(float),
+        "成交额": rng.uniform(1e5, 1e7, len(trade_dates)),
+        "总市值": rng.uniform(1e8, 1e10, len(trade_dates)),
+    })
+    stock_df = SingleStockDataProcessor.calculate_zdt_price_and_st(stock_df)
+    stock_df = SingleStockDataProcessor.calculate_adjusted_prices(stock_df)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        merged = StockDataProcessor.merge_with_index_data(stock_df, index_data)
+    single_pass_time = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        expected = merge_with_index_data_by_fillna(stock_df, index_data)
+    fillna_time = (time.perf_counter() - start) / repeat
+
+    pd.testing.assert_frame_equal(merged, expected)
+    performance_log.info(
+        "merge_with_index_data %d days: single pass %.2fms, fillna %.2fms, %.1fx"
+        % (n_days, single_pass_time * 1000, fillna_time * 1000, fillna_time / single_pass_time)
+    )
+
+
+def check_incremental_update(rng, steps=(150, 170, 200, 230)):
+    """
+    增量更新与完整处理的结果比较。CSV 带有一列全部为空的 备注(行情数据中常见)：
+    空列不能阻止已处理的行被确定；最后一次追加的行中 备注 出现非空值，需要完整重建。
+
+    :param steps: 每次更新后 CSV 中的行数
+    """
+    n_days = steps[-1]
+    dates = pd.bdate_range("2020-01-01", periods=n_days)
+    close = np.round(10 * np.exp(np.cumsum(rng.normal(0, 0.02, n_days))), 2)
+    raw = pd.DataFrame({
+        "股票代码": "sh600000",
+        "股票名称": "测试股份",
+        "交易日期": dates.strftime("%Y-%m-%d"),
+        "开盘价": close,
+        "最高价": close,
+        "最低价": close,
+        "收盘价": close,
+        "前收盘价": np.concatenate([[close[0]], close[:-1]]),
+        "成交量": rng.integers(1000, 100000, n_days).astype(float),
+        "成交额": rng.uniform(1e5, 1e7, n_days),
+        "备注": np.nan,
+    })
+    raw.loc[raw.index[steps[-2]:], "备注"] = "复牌"
+    index_data = pd.DataFrame({"交易日期": dates, "指数涨跌幅": rng.normal(0, 0.01, n_days)})
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        file_path = os.path.join(work_dir, "%s.csv")
+        csv_path = file_path % "sh600000"
+        with open(csv_path, "w", encoding="gbk") as f:
+            f.write("数据说明\n")
+            raw.iloc[:0].to_csv(f, index=False)
+        written = 0
+        for n in steps:
+            with open(csv_path, "a", encoding="gbk") as f:
+                raw.iloc[written:n].to_csv(f, index=False, header=False)
+            written = n
+            incremental = IncrementalStockProcessor(
+                SingleStockDataProcessor("sh600000", file_path), os.path.join(work_dir, "incremental")
+            )
+            result = incremental.update(index_data)
+            expected = SingleStockDataProcessor("sh600000", file_path).process_stock_data(index_data)
+            pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+            state = incremental.load_state()
+            # 空的 备注 列不影响确定行：未确定的原始数据只有末尾几行
+            assert state["parts"] and len(state["raw_tail"]) < 5, (n, len(state["parts"]), len(state["raw_tail"]))
+    performance_log.info("incremental update with an empty column: %d updates equal to full processing" % len(steps))
+
+
+if __name__ == "__main__":
+    # 全市场规模：5000 只股票 x 4000 个交易日
+    rng = np.random.default_rng(0)
+    benchmark_round_half_up(rng, 5000, 4000)
+    benchmark_merge_with_index_data(rng, 4000)
+    check_incremental_update(rng)
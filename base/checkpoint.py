@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+import datetime
+import io
+import os
+import pickle
+
+import backtrader as bt
+import pandas as pd
+from backtrader.metabase import AutoInfoClass, MetaParams
+from backtrader.utils import date2num, num2date
+
+from base.log import performance_log
+
+
+class _Unpicklable(pickle.PicklingError):
+    pass
+
+
+class _StatePickler(pickle.Pickler):
+    """
+    序列化状态时把 feed、策略和 broker 替换为引用(下标)，恢复时指向新一次运行中的对象。
+    其他 backtrader 对象(指标、line、分析器、订单、参数等)无法脱离本次运行恢复，遇到时抛出 _Unpicklable。
+    """
+
+    def __init__(self, file, refs):
+        super(_StatePickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._refs = refs
+
+    def persistent_id(self, obj):
+        ref = self._refs.get(id(obj))
+        if ref is not None:
+            return ref
+        if isinstance(type(obj), MetaParams) or isinstance(obj, AutoInfoClass):
+            raise _Unpicklable(type(obj).__name__)
+        return None
+
+
+class _StateUnpickler(pickle.Unpickler):
+    def __init__(self, file, objects):
+        super(_StateUnpickler, self).__init__(file)
+        self._objects = objects
+
+    def persistent_load(self, pid):
+        return self._objects[pid]
+
+
+def dump_state(obj, refs):
+    buf = io.BytesIO()
+    _StatePickler(buf, refs).dump(obj)
+    return buf.getvalue()
+
+
+def load_state(blob, objects):
+    return _StateUnpickler(io.BytesIO(blob), objects).load()
+
+
+def object_state(obj, refs, names=None):
+    """
+    逐个序列化 obj 的属性，返回 {属性名: bytes}。
+    names 为 None 时尝试所有属性，无法序列化的属性被跳过。
+    """
+    attrs = vars(obj)
+    state = {}
+    for name in attrs if names is None else names:
+        if name not in attrs:
+            continue
+        try:
+            state[name] = dump_state(attrs[name], refs)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            continue
+    return state
+
+
+def _created_by_backtrader(value):
+    """
+    指标、line、参数，或由它们组成的 list/tuple/dict(如每个 feed 一个指标)。
+    """
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return len(value) > 0 and all(_created_by_backtrader(item) for item in value)
+    return isinstance(value, (bt.LineRoot, bt.lineseries.Lines, AutoInfoClass))
+
+
+def strategy_state(strat, refs, names, live_orders):
+    """
+    逐个序列化策略的属性。
+    - 指标、line、参数由 backtrader 和策略的 __init__ 重新创建，不保存
+    - 指向未成交订单的属性(如 self.order)按订单 ref 记录，恢复时绑定到重新提交的订单
+    - 其他无法序列化的属性(如已结束的订单)记录警告后跳过，恢复后保持 __init__ 中的值
+
+    :param live_orders: {id(订单): 订单 ref}
+    :return: ({属性名: bytes}, {属性名: 订单 ref})
+    """
+    attrs = vars(strat)
+    state = {}
+    order_refs = {}
+    for name in names:
+        if name not in attrs:
+            continue
+        value = attrs[name]
+        if _created_by_backtrader(value):
+            continue
+        if id(value) in live_orders:
+            order_refs[name] = live_orders[id(value)]
+            continue
+        try:
+            state[name] = dump_state(value, refs)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            performance_log.warning(
+                "checkpoint skips unpicklable attribute %s.%s (%s)" % (type(strat).__name__, name, e)
+            )
+    return state, order_refs
+
+
+def restore_object_state(obj, state, objects):
+    for name, blob in state.items():
+        setattr(obj, name, load_state(blob, objects))
+
+
+def _analyzer_tree(analyzers, prefix=()):
+    """
+    按 (下标, 子分析器下标, ...) 遍历分析器及其子分析器。
+    """
+    for i, analyzer in enumerate(analyzers):
+        path = prefix + (i,)
+        yield path, analyzer
+        for item in _analyzer_tree(analyzer._children, path):
+            yield item
+
+
+def _strategy_internal(name):
+    """
+    由 backtrader 管理、不属于策略自身状态的属性：私有属性、feed 别名、broker、观察器/分析器集合等。
+    """
+    return (
+        name.startswith("_")
+        or name in ("datas", "ddatas", "dnames", "broker", "env", "cerebro", "stats", "observers", "analyzers", "writers")
+        or (name.startswith("data") and name[4:].isdigit())
+        or name == "data"
+    )
+
+
+def _class_name(obj):
+    return "%s.%s" % (type(obj).__module__, type(obj).__qualname__)
+
+
+class Checkpoint:
+    """
+    回测在某个 bar 结束时的完整状态快照，用于在延长数据后从该 bar 之后继续回测。
+
+    包含：
+    - broker：现金、持仓、净值等(按 feed 下标对应)
+    - 未成交订单：按参数记录，恢复时由原策略重新提交
+    - 策略：公开属性(如 day_count)或策略类 checkpoint_attrs 指定的属性，以及未平仓的交易；
+      指向未成交订单的属性恢复时绑定到重新提交的订单
+    - 分析器及其子分析器的累积状态
+    - 定时器状态(上次触发日期、周/月的补触发队列等)
+
+    指标、观察器的 line 不保存，恢复时由完整数据重新计算。
+    """
+
+    version = 2
+    broker_attrs = (
+        "cash", "startingcash", "positions", "d_credit",
+        "_value", "_valuemkt", "_valuelever", "_valuemktlever",
+        "_leverage", "_unrealized", "_fundval", "_fundshares",
+    )
+    order_attrs = (
+        "size", "price", "pricelimit", "exectype", "valid",
+        "tradeid", "trailamount", "trailpercent",
+    )
+
+    def __init__(self, dt, datas, broker, orders, strategies, timers):
+        self.dt = dt  # 快照对应的最后一个 bar 的时间(backtrader 数值格式)
+        self.datas = datas
+        self.broker = broker
+        self.orders = orders
+        self.strategies = strategies
+        self.timers = timers
+
+    @property
+    def datetime(self):
+        return num2date(self.dt)
+
+    @staticmethod
+    def _refs(cerebro, runstrats):
+        refs = {id(cerebro.broker): ("broker",)}
+        for i, data in enumerate(cerebro.datas):
+            refs[id(data)] = ("data", i)
+        for i, strat in enumerate(runstrats):
+            refs[id(strat)] = ("strategy", i)
+        return refs
+
+    @staticmethod
+    def _objects(cerebro, runstrats):
+        objects = {("broker",): cerebro.broker}
+        for i, data in enumerate(cerebro.datas):
+            objects[("data", i)] = data
+        for i, strat in enumerate(runstrats):
+            objects[("strategy", i)] = strat
+        return objects
+
+    @classmethod
+    def capture(cls, cerebro, runstrats):
+        """
+        在两个 bar 之间(上一个 bar 已处理完，下一个 bar 的订单还未撮合)记录状态。
+        """
+        refs = cls._refs(cerebro, runstrats)
+        broker = cerebro.broker
+        datas = [data._name for data in cerebro.datas]
+
+        orders = []
+        live_orders = {}
+        for order in list(broker.submitted) + list(broker.pending):
+            if order is None or not order.alive():
+                continue
+            if order.parent is not None or broker._ocos.get(order.ref, order.ref) != order.ref:
+                performance_log.warning("checkpoint skips bracket/oco order %s" % order.ref)
+                continue
+            spec = {name: getattr(order, name) for name in cls.order_attrs}
+            spec["size"] = abs(order.executed.remsize)  # 部分成交时只重新提交剩余数量
+            spec.update(
+                ref=order.ref,
+                owner=runstrats.index(order.owner),
+                data=cerebro.datas.index(order.data),
+                isbuy=order.isbuy(),
+                created=(order.created.dt, order.created.price, order.created.pclose),
+                info=dict(order.info),
+            )
+            orders.append(spec)
+            live_orders[id(order)] = order.ref
+
+        strategies = []
+        for strat in runstrats:
+            names = getattr(strat, "checkpoint_attrs", None)
+            if names is None:
+                names = [name for name in vars(strat) if not _strategy_internal(name)]
+            trades = []
+            for data, datatrades in strat._trades.items():
+                for tradeid, tradelist in datatrades.items():
+                    for trade in tradelist:
+                        if trade.isopen:
+                            trades.append((cerebro.datas.index(data), tradeid, object_state(trade, refs)))
+            attrs, order_refs = strategy_state(strat, refs, names, live_orders)
+            strategies.append(
+                {
+                    "class": _class_name(strat),
+                    "attrs": attrs,
+                    "orders": order_refs,
+                    "trades": trades,
+                    "analyzers": [
+                        (path, _class_name(analyzer), object_state(analyzer, refs))
+                        for path, analyzer in _analyzer_tree(strat.analyzers)
+                    ],
+                }
+            )
+
+        timers = [object_state(timer, refs) for timer in cerebro._pretimers]
+        return cls(
+            dt=runstrats[0].datetime[0],
+            datas=datas,
+            broker=object_state(broker, refs, cls.broker_attrs),
+            orders=orders,
+            strategies=strategies,
+            timers=timers,
+        )
+
+    def check(self, cerebro, runstrats):
+        """
+        检查本次运行的 feed、策略和定时器与快照是否一致，不一致时抛出 ValueError。
+        """
+        datas = [data._name for data in cerebro.datas]
+        if datas != self.datas:
+            raise ValueError("checkpoint datas %s do not match %s" % (self.datas, datas))
+        classes = [_class_name(strat) for strat in runstrats]
+        if classes != [s["class"] for s in self.strategies]:
+            raise ValueError("checkpoint strategies do not match %s" % classes)
+        if len(cerebro._pretimers) != len(self.timers):
+            raise ValueError("checkpoint has %d timers, got %d" % (len(self.timers), len(cerebro._pretimers)))
+
+    def restore(self, cerebro, runstrats):
+        """
+        把快照状态写回本次运行的对象，并重新提交快照时未成交的订单。
+        应在快照时间之后的第一个 bar 撮合订单之前调用。
+        """
+        objects = self._objects(cerebro, runstrats)
+        restore_object_state(cerebro.broker, self.broker, objects)
+
+        for timer, state in zip(cerebro._pretimers, self.timers):
+            restore_object_state(timer, state, objects)
+
+        for strat, saved in zip(runstrats, self.strategies):
+            restore_object_state(strat, saved["attrs"], objects)
+            for data_index, tradeid, state in saved["trades"]:
+                data = cerebro.datas[data_index]
+                trade = bt.Trade(data=data, tradeid=tradeid)
+                restore_object_state(trade, state, objects)
+                strat._trades[data][tradeid].append(trade)
+
+            analyzers = dict(_analyzer_tree(strat.analyzers))
+            for path, clsname, state in saved["analyzers"]:
+                analyzer = analyzers.get(tuple(path))
+                if analyzer is None or _class_name(analyzer) != clsname:
+                    raise ValueError("checkpoint analyzer %s does not match" % clsname)
+                restore_object_state(analyzer, state, objects)
+
+        resubmitted = {}
+        for spec in self.orders:
+            strat = runstrats[spec["owner"]]
+            submit = strat.buy if spec["isbuy"] else strat.sell
+            kwargs = {name: spec[name] for name in self.order_attrs}
+            kwargs["plimit"] = kwargs.pop("pricelimit")
+            kwargs.update(spec["info"])
+            order = submit(data=cerebro.datas[spec["data"]], **kwargs)
+            order.created.dt, order.created.price, order.created.pclose = spec["created"]
+            resubmitted[spec["ref"]] = order
+
+        for strat, saved in zip(runstrats, self.strategies):
+            for name, ref in saved["orders"].items():
+                setattr(strat, name, resubmitted[ref])
+
+    def save(self, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(dict(vars(self), version=self.version), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state.pop("version", None) != cls.version:
+            raise ValueError("unsupported checkpoint version in %s" % path)
+        return cls(**state)
+
+
+# 回放期间屏蔽的策略方法：策略逻辑、订单/净值通知和分析器
+_replay_methods = ("next", "prenext", "nextstart", "next_open", "_notify", "_next_analyzers")
+
+
+def start_replay(strat):
+    """
+    让策略进入回放状态：bar 照常推进(指标、观察器的时钟随之前进)，但不执行策略逻辑。
+    """
+    for name in _replay_methods:
+        setattr(strat, name, _skip_bar)
+
+
+def end_replay(strat):
+    """
+    撤销 start_replay 的替换。
+    """
+    for name in _replay_methods:
+        strat.__dict__.pop(name, None)
+
+
+def _skip_bar(*args, **kwargs):
+    pass
+
+
+def date_num(value, day_end=True):
+    """
+    把日期转换为 backtrader 的数值时间，数值原样返回。
+    只给出日期时，day_end 为 True 取当天结束(包含当天的所有 bar)，否则取当天开始。
+    """
+    if isinstance(value, float):
+        return value
+    if isinstance(value, datetime.datetime):
+        return date2num(value)
+    stamp = pd.Timestamp(value)
+    if stamp == stamp.normalize():
+        day_time = datetime.time.max if day_end else datetime.time.min
+        return date2num(datetime.datetime.combine(stamp.date(), day_time))
+    return date2num(stamp.to_pydatetime())
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def compact_column(values):
+    """
+    把一列转换为紧凑的 numpy 数组：数值和 bool 列保持原类型，
+    object 列(如 shift 之后带空值的 bool 列)全部为 bool 时转为 bool，否则转为 float64(空值为 nan)。
+    """
+    if values.dtype != object:
+        return np.ascontiguousarray(values)
+    if all(isinstance(v, (bool, np.bool_)) for v in values):
+        return values.astype(bool)
+    return values.astype(np.float64)
+
+
+class ColumnBlock:
+    """
+    紧凑的行情数据块：日期数组 + 每列一个 numpy 数组 + 列名。
+
+    用于从进程池返回处理好的股票数据，替代携带 DataFrame 的 feed 对象：
+    序列化时只有若干个连续的数组，没有 object 列，主进程用 to_frame 直接包装成 DataFrame(不复制数据)再创建 feed。
+    feed 读入 line 时所有值都转换为浮点数，因此 object 列转换为 bool/float64 不影响回测。
+
+    也可以由工作进程 save 到文件，只返回路径，主进程 load 时以内存映射方式打开，数据不经过进程间通信。
+    """
+
+    index_field = "index"  # 没有索引名时，文件中日期字段的名称
+
+    __slots__ = ("dates", "arrays", "columns", "index_name")
+
+    def __init__(self, dates, arrays, columns, index_name=None):
+        self.dates = dates
+        self.arrays = arrays
+        self.columns = columns
+        self.index_name = index_name
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        :param df: 以日期为索引的 DataFrame
+        """
+        return cls(
+            df.index.to_numpy(dtype="datetime64[ns]"),
+            [compact_column(df[column].to_numpy()) for column in df.columns],
+            tuple(df.columns),
+            df.index.name,
+        )
+
+    def to_frame(self):
+        return pd.DataFrame(
+            dict(zip(self.columns, self.arrays)),
+            index=pd.DatetimeIndex(self.dates, name=self.index_name),
+            copy=False,
+        )
+
+    @property
+    def nbytes(self):
+        return self.dates.nbytes + sum(array.nbytes for array in self.arrays)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getstate__(self):
+        return self.dates, self.arrays, self.columns, self.index_name
+
+    def __setstate__(self, state):
+        self.dates, self.arrays, self.columns, self.index_name = state
+
+    def save(self, path):
+        """
+        保存为一个 .npy 文件(结构化数组，第一个字段为日期)，先写临时文件再重命名。
+        """
+        index_field = self.index_name or self.index_field
+        if index_field in self.columns:
+            raise ValueError("column %s conflicts with the index field" % index_field)
+        dtype = [(index_field, self.dates.dtype)] + [
+            (column, array.dtype) for column, array in zip(self.columns, self.arrays)
+        ]
+        records = np.empty(len(self.dates), dtype=dtype)
+        records[index_field] = self.dates
+        for column, array in zip(self.columns, self.arrays):
+            records[column] = array
+        tmp_path = path + ".tmp.npy"
+        np.save(tmp_path, records)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        读取 save 保存的文件。默认以只读内存映射方式打开，各列是映射数组的视图，按需载入。
+        """
+        records = np.load(path, mmap_mode=mmap_mode)
+        names = records.dtype.names
+        return cls(
+            records[names[0]],
+            [records[name] for name in names[1:]],
+            names[1:],
+            None if names[0] == cls.index_field else names[0],
+        )
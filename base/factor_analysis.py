@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+import warnings
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from base.log import performance_log
+
+# 多因子分析子进程中的 (analyzer, factors, group_codes, group_labels, quantiles, prepare)，由进程池的 initializer 设置
+_worker_args = None
+
+
+def forward_fill(matrix):
+    """
+    按列向前填充空值(每只股票用之前最近的非空值)，与 DataFrame.ffill() 相同。
+    """
+    index = np.where(np.isnan(matrix), 0, np.arange(len(matrix))[:, None])
+    np.maximum.accumulate(index, axis=0, out=index)
+    return np.take_along_axis(matrix, index, axis=0)
+
+
+def rank_rows(matrix, groups=None, chunk_size=1 << 22):
+    """
+    每行非空值的平均排名(从 1 开始，相同的值取平均排名)，与 Series.rank() 相同，空值的位置为 nan。
+    groups 不为空时，在每行的每个组内分别排名。
+
+    :param matrix: 二维数组
+    :param groups: 与 matrix 形状相同的非负整数组号，matrix 为空值的位置可以是任意值
+    :param chunk_size: 按行分块计算，每块的元素个数不超过该值，限制临时数组的大小
+    """
+    ranks = np.empty(matrix.shape)
+    step = max(chunk_size // max(matrix.shape[1], 1), 1)
+    for start in range(0, len(matrix), step):
+        block = slice(start, start + step)
+        ranks[block] = _rank_block(matrix[block], None if groups is None else groups[block])
+    return ranks
+
+
+def _rank_block(matrix, groups):
+    shape = matrix.shape
+    missing = np.isnan(matrix)
+    order = np.argsort(matrix, axis=1)  # nan 排在每行的最后
+    if groups is not None:
+        # 再按组号稳定排序，同一组内的值相邻且有序；组号不超过 16 位时 numpy 使用基数排序
+        groups = np.where(missing, groups.max(initial=0) + 1, groups)
+        if groups.max(initial=0) < 1 << 16:
+            groups = groups.astype(np.uint16)
+        ordered_groups = np.take_along_axis(groups, order, axis=1)
+        by_group = np.argsort(ordered_groups, axis=1, kind="stable")
+        order = np.take_along_axis(order, by_group, axis=1)
+        ordered_groups = np.take_along_axis(ordered_groups, by_group, axis=1)
+    ordered = np.take_along_axis(matrix, order, axis=1)
+    index = np.broadcast_to(np.arange(shape[1]), shape)
+
+    # 相同值(组内)的一段的起点和终点
+    first = 0
+    start = np.ones(shape, dtype=bool)
+    start[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    if groups is not None:
+        new_group = np.ones(shape, dtype=bool)
+        new_group[:, 1:] = ordered_groups[:, 1:] != ordered_groups[:, :-1]
+        start |= new_group
+        first = np.maximum.accumulate(np.where(new_group, index, 0), axis=1)
+    end = np.ones(shape, dtype=bool)
+    end[:, :-1] = start[:, 1:]
+    tie_first = np.maximum.accumulate(np.where(start, index, 0), axis=1)
+    tie_last = np.minimum.accumulate(np.where(end, index, shape[1])[:, ::-1], axis=1)[:, ::-1]
+
+    ranks = np.empty(shape)
+    np.put_along_axis(ranks, order, (tie_first + tie_last) / 2 - first + 1, axis=1)
+    ranks[missing] = np.nan
+    return ranks
+
+
+def quantize_rows(matrix, quantiles):
+    """
+    每行非空值按分位数分组，与 alphalens 的 quantize_factor(pd.qcut(x, quantiles, labels=False) + 1)相同。
+
+    :param quantiles: 分组数，或分位点序列(如 [0, .1, .5, .9, 1])
+    :return: int8 矩阵，值为 1..分组数；空值、分位点以外的值以及分位点有重复(qcut 报错)的行为 0
+    """
+    q = np.linspace(0, 1, quantiles + 1) if isinstance(quantiles, int) else np.asarray(quantiles, dtype=np.float64)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # 整行为空值
+        edges = np.nanquantile(matrix, q, axis=1).T
+    # searchsorted(edges, x, side="left")：小于 x 的分位点个数，等于第一个分位点的值归入第一组
+    labels = np.zeros(matrix.shape, dtype=np.int8)
+    for k in range(len(q)):
+        labels += matrix > edges[:, k:k + 1]
+    labels[matrix == edges[:, :1]] = 1
+    labels[labels == len(q)] = 0
+    invalid = np.isnan(edges).any(axis=1)
+    if len(q) != 2:
+        invalid |= (edges[:, 1:] == edges[:, :-1]).any(axis=1)
+    labels[invalid] = 0
+    return labels
+
+
+def row_corr(x, y):
+    """
+    每行 x 和 y 都不为空值的位置上的 Pearson 相关系数，与 DataFrame.corrwith(axis=1) 相同，少于两个值或方差为 0 的行为 nan。
+    """
+    both = ~np.isnan(x) & ~np.isnan(y)
+    count = both.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dx = np.where(both, x - (np.where(both, x, 0).sum(axis=1) / count)[:, None], 0)
+        dy = np.where(both, y - (np.where(both, y, 0).sum(axis=1) / count)[:, None], 0)
+        return (dx * dy).sum(axis=1) / np.sqrt((dx * dx).sum(axis=1) * (dy * dy).sum(axis=1))
+
+
+def segment_corr(x, y, segments, n_segments):
+    """
+    按段计算 x 和 y 的 Pearson 相关系数，少于两个值或方差为 0 的段为 nan。
+    用各段的和与乘积和计算(不需要按段去均值)，用于排名等与均值量级相当的数据。
+    """
+    count = np.bincount(segments, minlength=n_segments)
+    sum_x = np.bincount(segments, x, n_segments)
+    sum_y = np.bincount(segments, y, n_segments)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sxy = np.bincount(segments, x * y, n_segments) - sum_x * sum_y / count
+        sxx = np.bincount(segments, x * x, n_segments) - sum_x * sum_x / count
+        syy = np.bincount(segments, y * y, n_segments) - sum_y * sum_y / count
+        corr = sxy / np.sqrt(sxx * syy)
+    corr[count < 2] = np.nan
+    return corr
+
+
+def segment_mean(values, segments, n_segments):
+    """
+    按段求均值，返回 (均值, 个数)，没有值的段均值为 nan。
+    """
+    count = np.bincount(segments, minlength=n_segments)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.bincount(segments, values, n_segments) / count, count
+
+
+def mean_std_error(matrix, axis):
+    """
+    沿 axis 对非空值求均值和标准误(样本标准差 / sqrt(个数))，与 alphalens 对各交易日结果的汇总方式相同。
+    """
+    count = (~np.isnan(matrix)).sum(axis=axis)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mean = np.nanmean(matrix, axis=axis)
+        std = np.nanstd(matrix, axis=axis, ddof=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return mean, std / np.sqrt(count)
+
+
+class FactorReport:
+    """
+    FactorAnalyzer.analyze 的结果。各项与 alphalens 对应函数的结果相同(alphalens 按交易日历补出的空值行除外)：
+    - ic: 交易日期 x 周期 的 Rank IC(factor_information_coefficient)
+    - quantile_returns / quantile_returns_std_error: 分组 x 周期 的去均值收益及其标准误(mean_return_by_quantile)
+    - quantile_returns_by_date: (分组, 交易日期) x 周期 的去均值收益(mean_return_by_quantile(by_date=True))
+    - turnover: {周期: 交易日期 x 分组} 的换手率(quantile_turnover)
+    - rank_autocorrelation: 交易日期 x 周期 的因子排名自相关(factor_rank_autocorrelation)
+    - ic_by_group / quantile_returns_by_group: 传入 groups 时按组(行业)的平均 IC 和分组收益(by_group=True)，否则为 None
+    """
+
+    def __init__(self, ic, quantile_returns, quantile_returns_std_error, quantile_returns_by_date,
+                 turnover, rank_autocorrelation, ic_by_group=None, quantile_returns_by_group=None):
+        self.ic = ic
+        self.quantile_returns = quantile_returns
+        self.quantile_returns_std_error = quantile_returns_std_error
+        self.quantile_returns_by_date = quantile_returns_by_date
+        self.turnover = turnover
+        self.rank_autocorrelation = rank_autocorrelation
+        self.ic_by_group = ic_by_group
+        self.quantile_returns_by_group = quantile_returns_by_group
+
+    def ic_summary(self):
+        """
+        各周期 IC 的均值、标准差、IR 和 t 统计量，各周期的 IC 均值即 IC 衰减。
+        """
+        count = self.ic.count()
+        mean, std = self.ic.mean(), self.ic.std()
+        return pd.DataFrame({
+            "IC Mean": mean,
+            "IC Std.": std,
+            "Risk-Adjusted IC": mean / std,
+            "t-stat(IC)": mean / std * np.sqrt(count),
+        })
+
+    def summary(self):
+        """
+        每个周期一行的汇总表：IC 统计量、最高/最低分组收益及其差、最高分组的平均换手率、因子排名自相关的均值。
+        """
+        top, bottom = self.quantile_returns.iloc[-1], self.quantile_returns.iloc[0]
+        summary = self.ic_summary()
+        summary["Top Quantile Return"] = top
+        summary["Bottom Quantile Return"] = bottom
+        summary["Top-Bottom Spread"] = top - bottom
+        summary["Top Quantile Turnover"] = pd.Series(
+            {label: turnover.iloc[:, -1].mean() for label, turnover in self.turnover.items()}
+        )
+        summary["Rank Autocorrelation"] = self.rank_autocorrelation.mean()
+        return summary
+
+
+class FactorAnalyzer:
+    """
+    向量化的因子有效性分析，替代 alphalens.utils.get_clean_factor_and_forward_returns + tear sheet 的计算部分。
+
+    alphalens 把因子、各周期远期收益、分组和行业展开成以 (交易日期, 股票代码) 为索引的长表，
+    IC、分组收益等都是对每个交易日(或每个交易日的每个行业)做一次 groupby-apply，全市场数据又慢又占内存。
+    这里所有数据都是 交易日期 x 股票 的矩阵(与价格透视表相同)：远期收益在创建时按周期计算一次，
+    之后每个因子的排名、分位数分组、IC、分组收益和换手率都按行向量化计算，结果与 alphalens 相同。
+
+    与 alphalens 的区别：
+    - 远期收益的 filter_zscore 按价格表的全部交易日统计(alphalens 按因子的交易日)，因子覆盖全部交易日时两者相同
+    - 不检查 max_loss，只记录丢弃的比例
+    """
+
+    def __init__(self, prices, periods=(1, 5, 10), filter_zscore=20):
+        """
+        :param prices: 交易日期 x 股票代码 的价格(收盘价)，与 alphalens 的 prices 相同
+        :param periods: 远期收益的周期(交易日数)
+        :param filter_zscore: 偏离均值超过该倍数标准差的远期收益视为空值，None 表示不过滤
+        """
+        self.dates = pd.DatetimeIndex(prices.index)
+        self.codes = pd.Index(prices.columns)
+        self.periods = sorted(periods)
+        self.labels = ["%dD" % period for period in self.periods]
+
+        # 与 pct_change 相同：先向前填充价格
+        closes = forward_fill(prices.to_numpy(dtype=np.float64))
+        self.forward_returns = {}
+        for period in self.periods:
+            returns = np.full(closes.shape, np.nan)
+            returns[:-period] = closes[period:] / closes[:-period] - 1
+            if filter_zscore is not None:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", RuntimeWarning)
+                    mean = np.nanmean(returns, axis=0)
+                    std = np.nanstd(returns, axis=0, ddof=1)
+                returns[np.abs(returns - mean) > filter_zscore * std] = np.nan
+            self.forward_returns[period] = returns
+
+    def align(self, data, dtype=np.float64, fill=np.nan):
+        """
+        把 DataFrame(交易日期 x 股票代码)或以 (交易日期, 股票代码) 为索引的 Series 对齐为与价格相同的矩阵，
+        价格中没有的日期和股票被忽略，缺失的位置为 fill。
+        """
+        if isinstance(data, pd.DataFrame):
+            return data.reindex(index=self.dates, columns=self.codes).to_numpy(dtype=dtype, na_value=fill)
+        rows = self.dates.get_indexer(data.index.get_level_values(0))
+        columns = self.codes.get_indexer(data.index.get_level_values(1))
+        keep = (rows >= 0) & (columns >= 0)
+        matrix = np.full((len(self.dates), len(self.codes)), fill, dtype=dtype)
+        matrix[rows[keep], columns[keep]] = np.asarray(data, dtype=dtype)[keep]
+        return matrix
+
+    def align_groups(self, groups):
+        """
+        把分组(如行业)对齐为组号矩阵，返回 (组号矩阵, 组名)，组名按排序，缺失的位置为 -1。
+        """
+        if isinstance(groups, pd.DataFrame):
+            values = groups.reindex(index=self.dates, columns=self.codes).to_numpy(dtype=object)
+            codes, labels = pd.factorize(values.ravel(), sort=True)
+            return codes.reshape(values.shape).astype(np.int32), labels
+        codes, labels = pd.factorize(np.asarray(groups), sort=True)
+        return self.align(pd.Series(codes, index=groups.index), dtype=np.int32, fill=-1), labels
+
+    def analyze(self, factor, groups=None, quantiles=10, chunk_size=1 << 18):
+        """
+        :param factor: 因子值，DataFrame(交易日期 x 股票代码)或以 (交易日期, 股票代码) 为索引的 Series
+        :param groups: 可选，与 factor 格式相同的分组(如行业)
+        :param quantiles: 分组数或分位点序列，与 alphalens 的 quantiles 相同
+        :param chunk_size: 按交易日分块计算，每块的元素个数不超过该值，临时数组的大小与全市场的交易日数无关
+        :return: FactorReport
+        """
+        group_codes = group_labels = None
+        if groups is not None:
+            group_codes, group_labels = self.align_groups(groups)
+        return self._analyze(self.align(factor), group_codes, group_labels, quantiles, chunk_size)
+
+    def analyze_many(self, factors, groups=None, quantiles=10, prepare=None, processes=None):
+        """
+        分析多个因子，共用创建时计算好的远期收益，分组只对齐一次。
+
+        多进程时子进程通过 fork 继承远期收益、因子和分组，只有因子名和结果需要序列化；
+        使用 spawn 启动方式的平台(Windows)上，每个子进程启动时会序列化一次这些数据。
+
+        :param factors: {因子名: 因子值}，因子值的格式与 analyze 相同
+        :param groups: 可选，所有因子共用的分组(如行业)
+        :param quantiles: 分组数或分位点序列
+        :param prepare: 可选，prepare(因子值) 返回预处理(去极值、标准化、中性化等)之后的因子值，与分析一起在子进程中执行
+        :param processes: 进程数，None 或 1 时在当前进程中依次分析
+        :return: {因子名: FactorReport}，顺序与 factors 相同
+        """
+        group_codes = group_labels = None
+        if groups is not None:
+            group_codes, group_labels = self.align_groups(groups)
+        initargs = (self, factors, group_codes, group_labels, quantiles, prepare)
+        names = list(factors)
+        if processes is None or processes <= 1 or len(names) <= 1:
+            return dict(_analyze_factor(name, *initargs) for name in names)
+        with Pool(min(processes, len(names)), initializer=_init_worker, initargs=initargs) as pool:
+            return dict(pool.imap(_analyze_in_worker, names))
+
+    def _analyze(self, factor, group_codes, group_labels, quantiles, chunk_size=1 << 18):
+        n_dates, n_codes = factor.shape
+        n_periods = len(self.periods)
+        n_quantiles = quantiles if isinstance(quantiles, int) else len(quantiles) - 1
+        n_groups = 0 if group_labels is None else len(group_labels)
+
+        # 每块的结果按交易日写入以下数组，排名用于计算排名自相关(float32 可以精确表示 0.5 的整数倍)
+        quantile = np.zeros((n_dates, n_codes), dtype=np.int8)
+        ranks = np.full((n_dates, n_codes), np.nan, dtype=np.float32)
+        ic = np.full((n_dates, n_periods), np.nan)
+        by_date = np.full((n_quantiles, n_dates, n_periods), np.nan)
+        group_ic = np.full((n_dates, n_groups, n_periods), np.nan)
+        by_date_group = np.full((n_quantiles, n_dates, n_groups, n_periods), np.nan)
+        n_factor = n_returns = n_clean = 0
+
+        step = max(chunk_size // max(n_codes, 1), 1)
+        for start in range(0, n_dates, step):
+            block = slice(start, start + step)
+            values = factor[block]
+            n_rows = len(values)
+            valid = np.isfinite(values)
+            n_factor += valid.sum()
+            for returns in self.forward_returns.values():
+                valid &= ~np.isnan(returns[block])
+            if group_codes is not None:
+                valid &= group_codes[block] >= 0
+            n_returns += valid.sum()
+            labels = quantize_rows(np.where(valid, values, np.nan), quantiles)
+            valid &= labels > 0
+            n_clean += valid.sum()
+            quantile[block] = labels
+
+            values = np.where(valid, values, np.nan)
+            block_ranks = rank_rows(values)
+            ranks[block] = block_ranks
+            rows = np.nonzero(valid)[0]
+            by_quantile = (labels[valid].astype(np.int64) - 1) * n_rows + rows
+            if group_codes is not None:
+                group = group_codes[block][valid]
+                by_group = rows * n_groups + group
+                group_factor_ranks = rank_rows(values, group_codes[block])[valid]
+
+            for i, period in enumerate(self.periods):
+                returns = np.where(valid, self.forward_returns[period][block], np.nan)
+                ic[block, i] = row_corr(block_ranks, rank_rows(returns))
+                # 每个交易日去均值后 (分组, 交易日期) 的均值，即原始收益的均值减去当天的均值
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    date_mean = np.nansum(returns, axis=1) / valid.sum(axis=1)
+                valid_returns = returns[valid]
+                by_date[:, block, i] = (
+                    segment_mean(valid_returns, by_quantile, n_quantiles * n_rows)[0].reshape(n_quantiles, n_rows) - date_mean
+                )
+                if group_codes is not None:
+                    group_ic[block, :, i] = segment_corr(
+                        group_factor_ranks, rank_rows(returns, group_codes[block])[valid], by_group, n_rows * n_groups
+                    ).reshape(n_rows, n_groups)
+                    by_date_group[:, block, :, i] = (
+                        segment_mean(valid_returns, by_quantile * n_groups + group, n_quantiles * n_rows * n_groups)[0]
+                        .reshape(n_quantiles, n_rows, n_groups) - date_mean[:, None]
+                    )
+
+        if n_factor:
+            performance_log.info(
+                "Dropped %.1f%% entries from factor data: %.1f%% in forward returns computation and %.1f%% in binning phase"
+                % ((1 - n_clean / n_factor) * 100, (1 - n_returns / n_factor) * 100, (n_returns - n_clean) / n_factor * 100)
+            )
+
+        # 对交易日期汇总：均值和标准误
+        quantile_index = pd.Index(np.arange(1, n_quantiles + 1), name="factor_quantile")
+        mean, std_error = mean_std_error(by_date, axis=1)
+        report = FactorReport(
+            ic=pd.DataFrame(ic, index=self.dates, columns=self.labels),
+            quantile_returns=pd.DataFrame(mean, index=quantile_index, columns=self.labels),
+            quantile_returns_std_error=pd.DataFrame(std_error, index=quantile_index, columns=self.labels),
+            quantile_returns_by_date=pd.DataFrame(
+                by_date.reshape(-1, n_periods),
+                index=pd.MultiIndex.from_product([quantile_index, self.dates], names=["factor_quantile", "date"]),
+                columns=self.labels,
+            ).dropna(how="all"),
+            turnover=self._turnover(quantile, quantile_index),
+            rank_autocorrelation=self._rank_autocorrelation(ranks, step),
+        )
+        if group_codes is not None:
+            group_index = pd.Index(group_labels, name="group")
+            report.ic_by_group = pd.DataFrame(
+                mean_std_error(group_ic, axis=0)[0], index=group_index, columns=self.labels
+            )
+            report.quantile_returns_by_group = pd.DataFrame(
+                mean_std_error(by_date_group, axis=1)[0].reshape(-1, n_periods),
+                index=pd.MultiIndex.from_product([quantile_index, group_index]),
+                columns=self.labels,
+            ).dropna(how="all")
+        return report
+
+    def _turnover(self, quantile, quantile_index):
+        """
+        每个分组中，当天的股票有多少比例不在 period 个交易日之前的该分组中，与 quantile_turnover 相同。
+        """
+        turnover = {}
+        for period, label in zip(self.periods, self.labels):
+            columns = {}
+            for q in quantile_index:
+                members = quantile == q
+                count = members.sum(axis=1)
+                new = (members[period:] & ~members[:-period]).sum(axis=1)
+                values = np.full(len(self.dates), np.nan)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    values[period:] = np.where(count[:-period] > 0, new / count[period:], np.nan)
+                columns[q] = values
+            turnover[label] = pd.DataFrame(columns, index=self.dates).rename_axis(columns="factor_quantile")
+        return turnover
+
+    def _rank_autocorrelation(self, ranks, step):
+        """
+        当天与 period 个交易日之前的因子排名在共同股票上的相关系数，与 factor_rank_autocorrelation 相同。
+        """
+        n_dates = len(self.dates)
+        autocorrelation = {}
+        for period, label in zip(self.periods, self.labels):
+            values = np.full(n_dates, np.nan)
+            for start in range(period, n_dates, step):
+                current = ranks[start:start + step].astype(np.float64)
+                previous = ranks[start - period:start - period + len(current)].astype(np.float64)
+                values[start:start + len(current)] = row_corr(current, previous)
+            autocorrelation[label] = values
+        return pd.DataFrame(autocorrelation, index=self.dates)
+
+
+def summary_table(reports):
+    """
+    把多个因子的 FactorReport.summary() 合并为一张以 (因子名, 周期) 为索引的汇总表。
+    """
+    return pd.concat({name: report.summary() for name, report in reports.items()}, names=["factor", "period"])
+
+
+def _init_worker(analyzer, factors, group_codes, group_labels, quantiles, prepare):
+    global _worker_args
+    _worker_args = (analyzer, factors, group_codes, group_labels, quantiles, prepare)
+
+
+def _analyze_factor(name, analyzer, factors, group_codes, group_labels, quantiles, prepare):
+    factor = factors[name] if prepare is None else prepare(factors[name])
+    return name, analyzer._analyze(analyzer.align(factor), group_codes, group_labels, quantiles)
+
+
+def _analyze_in_worker(name):
+    return _analyze_factor(name, *_worker_args)
+
+
+if __name__ == "__main__":
+    import time
+    import tracemalloc
+
+    import alphalens
+
+    def measure(func, *args):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, elapsed, peak / 2 ** 20
+
+    def make_panel(n_days, n_stocks, seed=0):
+        rng = np.random.default_rng(seed)
+        dates = pd.bdate_range("2008-01-01", periods=n_days)
+        codes = ["s%04d" % i for i in range(n_stocks)]
+        prices = pd.DataFrame(
+            np.round(10 * np.exp(np.cumsum(rng.normal(0, 0.02, (n_days, n_stocks)), axis=0)), 2),
+            index=dates, columns=codes,
+        )
+        prices = prices.where(rng.random(prices.shape) > 0.05)  # 停牌
+        factor = pd.DataFrame(rng.standard_normal(prices.shape), index=dates, columns=codes)
+        factor = factor.where(rng.random(prices.shape) > 0.05).stack()
+        factor.index.names = ["date", "asset"]
+        industry = pd.Series(rng.integers(0, 31, n_stocks), index=codes).map("行业{}".format)
+        industry = pd.Series(industry.reindex(factor.index.get_level_values("asset")).to_numpy(), index=factor.index)
+        return prices, factor, industry.astype("category")
+
+    def run_alphalens(prices, factor, industry, periods):
+        factor_data = alphalens.utils.get_clean_factor_and_forward_returns(
+            factor, prices, industry, quantiles=10, periods=periods
+        )
+        performance = alphalens.performance
+        return {
+            "ic": performance.factor_information_coefficient(factor_data),
+            "quantile_returns": performance.mean_return_by_quantile(factor_data)[0],
+            "ic_by_group": performance.mean_information_coefficient(factor_data, by_group=True),
+            "quantile_returns_by_group": performance.mean_return_by_quantile(factor_data, by_group=True)[0],
+            "turnover": {
+                "%dD" % period: pd.concat(
+                    [performance.quantile_turnover(factor_data["factor_quantile"], q, period) for q in range(1, 11)],
+                    axis=1,
+                )
+                for period in periods
+            },
+            "rank_autocorrelation": pd.concat(
+                [performance.factor_rank_autocorrelation(factor_data, period) for period in periods],
+                axis=1,
+                keys=["%dD" % period for period in periods],
+            ),
+        }
+
+    def run_native(prices, factor, industry, periods):
+        return FactorAnalyzer(prices, periods).analyze(factor, industry, quantiles=10)
+
+    def assert_same(expected, result):
+        def plain(df):
+            df = df.dropna(how="all")
+            df.index = pd.MultiIndex.from_tuples(list(df.index)) if df.index.nlevels > 1 else pd.Index(list(df.index))
+            return df
+
+        pairs = [(expected[name], getattr(result, name)) for name in expected if name != "turnover"]
+        pairs += [(turnover, result.turnover[label]) for label, turnover in expected["turnover"].items()]
+        for left, right in pairs:
+            pd.testing.assert_frame_equal(
+                plain(left), plain(right), check_names=False, check_column_type=False, check_index_type=False, rtol=1e-9
+            )
+
+    periods = (1, 5, 10)
+    # 与 alphalens 对照：250 个交易日 x 2000 只股票，31 个行业
+    n_days, n_stocks = 250, 2000
+    prices, factor, industry = make_panel(n_days, n_stocks)
+    expected, alphalens_time, alphalens_peak = measure(run_alphalens, prices, factor, industry, periods)
+    result, native_time, native_peak = measure(run_native, prices, factor, industry, periods)
+    assert_same(expected, result)
+    performance_log.info(
+        "%d x %d: alphalens %.1fs, peak %.0f MB; FactorAnalyzer %.2fs, peak %.0f MB"
+        % (n_days, n_stocks, alphalens_time, alphalens_peak, native_time, native_peak)
+    )
+
+    # 多个因子：每个因子单独创建 FactorAnalyzer(重新透视价格、计算远期收益) 与 analyze_many 共用远期收益
+    from multiprocessing import cpu_count
+
+    n_days, n_stocks, n_factors = 1000, 2000, 4
+    prices, factor, industry = make_panel(n_days, n_stocks)
+    long_prices = prices.stack()
+    factors = {"factor%d" % i: factor.sample(frac=1, random_state=i).set_axis(factor.index) for i in range(n_factors)}
+    start = time.perf_counter()
+    separate = {
+        name: FactorAnalyzer(long_prices.unstack(), periods).analyze(values, industry)
+        for name, values in factors.items()
+    }
+    separate_time = time.perf_counter() - start
+    for processes in (1, max(cpu_count(), 2)):
+        start = time.perf_counter()
+        reports = FactorAnalyzer(long_prices.unstack(), periods).analyze_many(factors, industry, processes=processes)
+        batch_time = time.perf_counter() - start
+        pd.testing.assert_frame_equal(summary_table(reports), summary_table(separate))
+        performance_log.info(
+            "%d factors %d x %d: separate %.2fs, analyze_many with %d processes %.2fs"
+            % (n_factors, n_days, n_stocks, separate_time, processes, batch_time)
+        )
+
+    # 全市场：4000 个交易日 x 5000 只股票
+    n_days, n_stocks = 4000, 5000
+    prices, factor, industry = make_panel(n_days, n_stocks)
+    result, native_time, native_peak = measure(run_native, prices, factor, industry, periods)
+    performance_log.info(
+        "%d x %d: FactorAnalyzer %.1fs, peak %.0f MB\n%s" % (n_days, n_stocks, native_time, native_peak, result.summary())
+    )
@@ -3,53 +3,91 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 import backtrader as bt
 from backtrader import observers
+import copy
+import json
 import time
+import numpy as np
 from backtrader.utils.py3 import map, range, zip, with_metaclass, string_types, integer_types
 from backtrader.utils import OrderedDict, tzparse, num2date, date2num
-import joblib  # 新增导入joblib
-from base.performance_timer import performance_timer
-import os
-from os.path import exists
+from base.log import performance_log
+from base.performance_timer import PhaseTimer, performance_timer
+from base.parallel_preload import parallel_preload, preload_feeds
+from base.preload_cache import PreloadCache
+from base.checkpoint import Checkpoint, date_num, end_replay, start_replay
+from base.opt_results import OptRecord, OptResultCollector, OptResultSink
+from base.shared_datas import SharedDatas, init_worker, run_worker
 
 
 class FastCerebro(bt.Cerebro):
     params = (
         ("cache_data", False),
         ("replace_cache_data", False),
-        ("cache_file_path", 'backtrader_tmp.joblib'),
+        ("cache_dir", 'backtrader_cache'),
+        ("cache_max_entries", 8),  # 缓存目录中最多保留的条目数，None 表示不限制
+        ("cache_max_bytes", None),  # 缓存目录的最大字节数，None 表示不限制
+        ("shared_datas", False),  # 优化时通过内存映射文件向子进程共享预加载数据
+        ("aligned_clock", False),  # 所有 feed 处于同一交易日历时同步推进，跳过逐 bar 的时间对齐
+        ("opt_chunksize", None),  # 优化时每次发送给子进程的参数组合个数，None 表示自动估算
+        ("opt_result_file", None),  # 优化结果逐条写入的 jsonl 文件，None 表示不写入
+        ("opt_metrics", None),  # callable(strat) -> dict，写入文件的指标，None 表示展开所有分析器的标量结果
+        ("opt_keep_top", None),  # 内存中只保留得分最高的 k 个结果，None 表示全部保留
+        ("opt_score", None),  # callable(result) -> float，opt_keep_top 使用的得分，越大越好
+        ("opt_records", None),  # 优化时返回 OptRecord 的指标列表，如 ["returns.rnorm", ("dd", "drawdown.max.drawdown")]
+        ("phase_timing", False),  # 记录 runstrategies 各阶段耗时，结果保存在 phase_reports 中
+        ("checkpoint_file", None),  # 回测状态快照的保存路径，None 表示不保存
+        ("checkpoint_date", None),  # 保存快照的日期(包含当天的所有 bar)，None 表示回测结束时保存
+        ("resume_file", None),  # 从快照恢复：快照时间及之前的 bar 只推进时钟，不执行策略逻辑和撮合
+        ("window", None),  # (开始日期, 结束日期)：只在区间内运行策略，之前的 bar 只推进时钟(指标预热)，之后停止
+        ("preload_processes", None),  # 预加载使用的子进程数，None 或 1 表示在主进程中逐个 feed 预加载
     )
 
+    # 只在主进程的结果收集器中调用的参数，不随 cerebro 发送给优化子进程(lambda 等无法序列化)
+    _parent_only_params = ("opt_metrics", "opt_score")
+
+    _resume = None  # 恢复中的快照，回放结束后置为 None
+    _checkpoint_dt = None  # 等待保存快照的时间，保存后置为 None
+    _window = None  # 运行区间 (开始, 结束)，backtrader 数值时间
+    _replaying = False  # 回放中：策略逻辑、分析器、定时器和 broker 暂停
+
+    def __getstate__(self):
+        '''
+        优化时 cerebro 被序列化到子进程：去掉只在主进程使用的回调参数。
+        '''
+        rv = super(FastCerebro, self).__getstate__()
+        params = copy.copy(self.params)
+        for name in self._parent_only_params:
+            setattr(params, name, None)
+        rv["params"] = rv["p"] = params
+        return rv
+
     def _preload_data(self):
         self._exactbars = int(self.p.exactbars)
         self._dopreload = self.p.preload
-        for data in self.datas:
-            data.reset()
-            if self._exactbars < 1:  # datas can be full length
-                data.extend(size=self.params.lookahead)
-            data._start()
-            if self._dopreload:
-                data.preload()
+        processes = self.p.preload_processes
+        if self._dopreload and processes and processes > 1 and len(self.datas) > 1:
+            parallel_preload(self.datas, processes, self._exactbars, self.params.lookahead)
+        else:
+            preload_feeds(self.datas, self._exactbars, self.params.lookahead, preload=self._dopreload)
 
     def dopreloaddata(self):
-        cachedata = self.p.cache_data
-        replacecache = self.p.replace_cache_data
-        cachefile = self.p.cache_file_path
-
-        if self._dopreload and cachedata: #如果预加载数据并且缓存数据
-                # 处理缓存文件
-                fileexist = exists(cachefile)
-                # 如果缓存存在且需要重新加载则删除文件
-                if replacecache and fileexist:
-                    os.remove(cachefile)
-                    # 文件状态更新
-                    fileexist = exists(cachefile)
-                # 缓存文件不存在则加载数据
-                if not fileexist:
-                    self._preload_data()
-                    joblib.dump(self.datas, cachefile)
-                else:
-                    load = joblib.load(cachefile)
-                    self.datas = load
+        self._preload_entry = None  # 本次使用的缓存条目目录
+        if self._dopreload and self.p.cache_data:  # 如果预加载数据并且缓存数据
+            cache = PreloadCache(
+                self.p.cache_dir,
+                max_entries=self.p.cache_max_entries,
+                max_bytes=self.p.cache_max_bytes,
+            )
+            # 缓存键由数据源指纹、起止日期、feed 类型和 lines 映射计算得到
+            key = cache.make_key(self.datas, lookahead=self.p.lookahead)
+            # 需要重新加载则删除对应的缓存条目
+            if self.p.replace_cache_data:
+                cache.remove(key)
+
+            # 命中时直接把列文件映射为各 feed 的 line 数组，否则预加载后写入缓存
+            if not cache.load(key, self.datas):
+                self._preload_data()
+                cache.save(key, self.datas)
+            self._preload_entry = cache.entry_path(key)
         else:
             self._preload_data()
 
@@ -76,51 +114,10 @@ class FastCerebro(bt.Cerebro):
             if key in pkeys:
                 setattr(self.params, key, val)
 
-        if not self.datas and not self.p.cache_data:
+        if not self.datas:
             return []  # nothing can be run
 
-        # Manage activate/deactivate object cache
-        bt.linebuffer.LineActions.cleancache()  # clean cache
-        bt.indicator.Indicator.cleancache()  # clean cache
-
-        bt.linebuffer.LineActions.usecache(self.p.objcache)
-        bt.indicator.Indicator.usecache(self.p.objcache)
-
-        self._dorunonce = self.p.runonce
-        self._dopreload = self.p.preload
-        self._exactbars = int(self.p.exactbars)
-
-        if self._exactbars:
-            self._dorunonce = False  # something is saving memory, no runonce
-            self._dopreload = self._dopreload and self._exactbars < 1
-
-        self._doreplay = self._doreplay or any(x.replaying for x in self.datas)
-        if self._doreplay:
-            # preloading is not supported with replay. full timeframe bars
-            # are constructed in realtime
-            self._dopreload = False
-
-        if self._dolive or self.p.live:
-            # in this case both preload and runonce must be off
-            self._dorunonce = False
-            self._dopreload = False
-
-        self.runwriters = list()
-
-        # Add the system default writer if requested
-        if self.p.writer is True:
-            wr = bt.WriterFile()
-            self.runwriters.append(wr)
-
-        # Instantiate any other writers
-        for wrcls, wrargs, wrkwargs in self.writers:
-            wr = wrcls(*wrargs, **wrkwargs)
-            self.runwriters.append(wr)
-
-        # Write down if any writer wants the full csv output
-        self.writers_csv = any(map(lambda x: x.p.csv, self.runwriters))
-
-        self.runstrats = list()
+        self._prepare_run()
 
         if self.signals:  # allow processing of signals
             signalst, sargs, skwargs = self._signal_strat
@@ -155,23 +152,50 @@ class FastCerebro(bt.Cerebro):
         if not self._dooptimize or self.p.maxcpus == 1:
             # If no optimmization is wished ... or 1 core is to be used
             # let's skip process "spawning"
-            for iterstrat in iterstrats:
-                runstrat = self.runstrategies(iterstrat)
-                self.runstrats.append(runstrat)
-                if self._dooptimize:
-                    for cb in self.optcbs:
-                        cb(runstrat)  # callback receives finished strategy
+            collector = self._opt_collector()
+            try:
+                for iterstrat in iterstrats:
+                    runstrat = self.runstrategies(iterstrat)
+                    self._collect(collector, runstrat)
+            finally:
+                collector.close()
+            self.runstrats = collector.results()
         else:
-            if self.p.optdatas and self._dopreload and self._dorunonce:
+            predata = self.p.optdatas and self._dopreload and self._dorunonce
+            if predata:
                 self.dopreloaddata()
 
-            pool = bt.multiprocessing.Pool(self.p.maxcpus or None)
-            for r in pool.imap(self, iterstrats):
-                self.runstrats.append(r)
-                for cb in self.optcbs:
-                    cb(r)  # callback receives finished strategy
+            iterstrats = list(iterstrats)  # 参数组合本身很小，展开后才能估算 chunksize
+            chunksize = self._opt_chunksize(len(iterstrats))
+            collector = self._opt_collector()
+            try:
+                if predata and self.p.shared_datas:
+                    # 数据只通过内存映射文件共享一次，每个任务只传递参数组合
+                    shared = SharedDatas(self.datas, self._preload_entry)
+                    shared.strip()
+                    try:
+                        pool = bt.multiprocessing.Pool(
+                            self.p.maxcpus or None,
+                            initializer=init_worker,
+                            initargs=(self, shared.entry_path),
+                        )
+                        for r in pool.imap(run_worker, iterstrats, chunksize):
+                            self._collect(collector, r)
+
+                        pool.close()
+                        pool.join()
+                    finally:
+                        shared.restore()
+                        shared.close()
+                else:
+                    pool = bt.multiprocessing.Pool(self.p.maxcpus or None)
+                    for r in pool.imap(self, iterstrats, chunksize):
+                        self._collect(collector, r)
 
-            pool.close()
+                    pool.close()
+            finally:
+                collector.close()
+            self.runstrats = collector.results()
 
             if self.p.optdatas and self._dopreload and self._dorunonce:
                 for data in self.datas:
@@ -183,11 +207,105 @@ class FastCerebro(bt.Cerebro):
 
         return self.runstrats
 
+    def _prepare_run(self):
+        '''
+        run 开始时的准备：对象缓存、预加载/向量化模式的判定以及 writers。
+        单独拆出以便滚动优化等在 run 之外调用 runstrategies 的场景复用。
+        '''
+        # Manage activate/deactivate object cache
+        bt.linebuffer.LineActions.cleancache()  # clean cache
+        bt.indicator.Indicator.cleancache()  # clean cache
+
+        bt.linebuffer.LineActions.usecache(self.p.objcache)
+        bt.indicator.Indicator.usecache(self.p.objcache)
+
+        self._dorunonce = self.p.runonce
+        self._dopreload = self.p.preload
+        self._exactbars = int(self.p.exactbars)
+
+        if self._exactbars:
+            self._dorunonce = False  # something is saving memory, no runonce
+            self._dopreload = self._dopreload and self._exactbars < 1
+
+        self._doreplay = self._doreplay or any(x.replaying for x in self.datas)
+        if self._doreplay:
+            # preloading is not supported with replay. full timeframe bars
+            # are constructed in realtime
+            self._dopreload = False
+
+        if self._dolive or self.p.live:
+            # in this case both preload and runonce must be off
+            self._dorunonce = False
+            self._dopreload = False
+
+        self.runwriters = list()
+
+        # Add the system default writer if requested
+        if self.p.writer is True:
+            wr = bt.WriterFile()
+            self.runwriters.append(wr)
+
+        # Instantiate any other writers
+        for wrcls, wrargs, wrkwargs in self.writers:
+            wr = wrcls(*wrargs, **wrkwargs)
+            self.runwriters.append(wr)
+
+        # Write down if any writer wants the full csv output
+        self.writers_csv = any(map(lambda x: x.p.csv, self.runwriters))
+
+        self.runstrats = list()
+        self.phase_reports = list()  # phase_timing 开启时每次 runstrategies 的耗时报告
+
+    def _add_phase_report(self, phase_timer):
+        '''
+        保存并输出本次 runstrategies 的分阶段耗时报告。
+        '''
+        report = phase_timer.report()
+        if report is None:
+            return
+
+        main_loop = report["phases"].get("main_loop")
+        bars = report.get("bars", 0)
+        if main_loop and main_loop["wall"] > 0:
+            report["bars_per_sec"] = bars / main_loop["wall"]
+        self.phase_reports.append(report)
+        performance_log.debug("runstrategies phases: %s" % json.dumps(report))
+
+    def _opt_collector(self):
+        '''
+        优化时按参数创建结果收集器：可选逐条写入磁盘、只保留 top-k；非优化时全部保留。
+        '''
+        if not self._dooptimize:
+            return OptResultCollector()
+
+        sink = None
+        if self.p.opt_result_file:
+            sink = OptResultSink(self.p.opt_result_file, metrics=self.p.opt_metrics)
+        return OptResultCollector(sink=sink, keep_top=self.p.opt_keep_top, score=self.p.opt_score)
+
+    def _collect(self, collector, runstrat):
+        collector.add(runstrat)
+        if self._dooptimize:
+            for cb in self.optcbs:
+                cb(runstrat)  # callback receives finished strategy
+
+    def _opt_chunksize(self, ncombs):
+        '''
+        每次发送给子进程的参数组合个数。未指定时按 组合数 / (进程数 * 4) 估算，
+        在减少进程间通信次数和保持负载均衡之间折中。
+        '''
+        if self.p.opt_chunksize:
+            return self.p.opt_chunksize
+
+        nworkers = self.p.maxcpus or bt.multiprocessing.cpu_count()
+        return max(1, ncombs // (nworkers * 4))
+
     def runstrategies(self, iterstrat, predata=False):
         '''
         Internal method invoked by ``run``` to run a set of strategies
         '''
         self._init_stcount()
+        phase_timer = PhaseTimer(self.p.phase_timing)
 
         self.runningstrats = runstrats = list()
         for store in self.stores:
@@ -221,9 +339,11 @@ class FastCerebro(bt.Cerebro):
 
         # self._plotfillers = [list() for d in self.datas]
         # self._plotfillers2 = [list() for d in self.datas]
+        phase_timer.lap("setup")
 
         if not predata:
             self.dopreloaddata()
+        phase_timer.lap("preload")
 
         for stratcls, sargs, skwargs in iterstrat:
             sargs = self.datas + list(sargs)
@@ -237,6 +357,7 @@ class FastCerebro(bt.Cerebro):
             if self.p.tradehistory:
                 strat.set_tradehistory()
             runstrats.append(strat)
+        phase_timer.lap("strategy_init")
 
         tz = self.p.tz
         if isinstance(tz, integer_types):
@@ -300,19 +421,30 @@ class FastCerebro(bt.Cerebro):
                 else:
                     self._timers.append(timer)
 
+            aligned = self.p.aligned_clock and not self.p.oldsync and self._datas_aligned()
+            self._prepare_checkpoint(runstrats)
+            phase_timer.lap("strategy_start")
             if self._dopreload and self._dorunonce:
                 if self.p.oldsync:
                     self._runonce_old(runstrats)
+                elif aligned:
+                    self._runonce_aligned(runstrats)
                 else:
                     self._runonce(runstrats)
             else:
                 if self.p.oldsync:
                     self._runnext_old(runstrats)
+                elif aligned:
+                    self._runnext_aligned(runstrats)
                 else:
                     self._runnext(runstrats)
+            self._finish_checkpoint(runstrats)
+            phase_timer.lap("main_loop")
+            phase_timer.count("bars", len(runstrats[0]))
 
             for strat in runstrats:
-                strat._stop()
+                strat._stop()  # 包含分析器的 stop
+            phase_timer.lap("strategy_stop")
 
         self._broker.stop()
 
@@ -327,6 +459,12 @@ class FastCerebro(bt.Cerebro):
             store.stop()
 
         self.stop_writers(runstrats)
+        phase_timer.lap("teardown")
+        self._add_phase_report(phase_timer)
+
+        if self._dooptimize and self.p.opt_records:
+            # 只返回参数元组和指标数组，不携带分析器对象
+            return [OptRecord.from_strategy(strat, self.p.opt_records) for strat in runstrats]
 
         if self._dooptimize and self.p.optreturn:
             # Results can be optimized
@@ -345,3 +483,231 @@ class FastCerebro(bt.Cerebro):
             return results
 
         return runstrats
+
+    def _prepare_checkpoint(self, runstrats):
+        '''
+        主循环开始前准备快照的保存和恢复，以及运行区间(window)。
+        回放状态下 bar 只推进数据、指标和策略的时钟，不调用策略的 next、分析器、定时器和 broker。
+        恢复快照时回放到快照之后的第一个 bar 再写回快照状态；指定 window 时回放到区间开始，区间结束后停止运行。
+        '''
+        self._resume = None
+        self._checkpoint_dt = None
+        self._window = None
+        self._replaying = False
+
+        if self.p.window is not None:
+            start, end = self.p.window
+            self._window = (date_num(start, day_end=False), date_num(end))
+            self._start_replay(runstrats)
+
+        if self.p.checkpoint_file is None and self.p.resume_file is None:
+            return
+        if self._dooptimize:
+            raise ValueError("checkpoint_file/resume_file are not supported when optimizing")
+
+        if self.p.checkpoint_file is not None:
+            date = self.p.checkpoint_date
+            self._checkpoint_dt = float("inf") if date is None else date_num(date)
+
+        if self.p.resume_file is not None:
+            resume = Checkpoint.load(self.p.resume_file)
+            resume.check(self, runstrats)
+            self._resume = resume
+            self._start_replay(runstrats)
+            performance_log.info("resume from checkpoint at %s" % resume.datetime)
+
+    def _bar_start(self, runstrats, dt0):
+        '''
+        每个 bar 开始时(撮合订单之前)调用：
+        超出 window 则停止运行；回放到快照之后、区间开始时结束回放；到达快照日期之后保存快照。
+        '''
+        if self._window is not None and dt0 > self._window[1]:
+            self._replaying = True  # 区间之后的 bar 不再撮合
+            self._event_stop = True
+            return
+
+        if self._replaying:
+            if self._resume is not None and dt0 <= self._resume.dt:
+                return
+            if self._window is not None and dt0 < self._window[0]:
+                return
+            self._end_replay(runstrats)
+
+        if self._checkpoint_dt is not None and dt0 > self._checkpoint_dt:
+            self._save_checkpoint(runstrats)
+
+    def _start_replay(self, runstrats):
+        if not self._replaying:
+            for strat in runstrats:
+                start_replay(strat)
+            self._replaying = True
+
+    def _end_replay(self, runstrats):
+        if self._resume is not None:
+            self._resume.restore(self, runstrats)
+            self._resume = None
+        for strat in runstrats:
+            end_replay(strat)
+        self._replaying = False
+
+    def _save_checkpoint(self, runstrats):
+        checkpoint = Checkpoint.capture(self, runstrats)
+        checkpoint.save(self.p.checkpoint_file)
+        self._checkpoint_dt = None
+        performance_log.info("checkpoint at %s saved to %s" % (checkpoint.datetime, self.p.checkpoint_file))
+
+    def _finish_checkpoint(self, runstrats):
+        '''
+        主循环结束后调用，此时还未调用策略和分析器的 stop。
+        '''
+        if self._resume is not None:
+            performance_log.warning("no bars after checkpoint at %s" % self._resume.datetime)
+        if self._replaying:
+            self._end_replay(runstrats)
+        if self._checkpoint_dt is not None:
+            self._save_checkpoint(runstrats)
+
+    def _check_timers(self, runstrats, dt0, cheat=False):
+        # 每个 bar 第一次检查定时器(cheat=True)时处理快照和运行区间，回放期间不触发定时器
+        if cheat and (self._replaying or self._window is not None or self._checkpoint_dt is not None):
+            self._bar_start(runstrats, dt0)
+        if not self._replaying:
+            super(FastCerebro, self)._check_timers(runstrats, dt0, cheat=cheat)
+
+    def _brokernotify(self):
+        # 回放期间 broker 不撮合订单、不更新净值
+        if not self._replaying:
+            super(FastCerebro, self)._brokernotify()
+
+    def _datas_aligned(self):
+        '''
+        启动时检查一次所有 feed 是否处于同一时间轴上：
+        已预加载、非实时/重采样/回放、没有过滤器、周期相同且 datetime 数组完全一致。
+        '''
+        datas = self.datas
+        data0 = datas[0]
+        reason = None
+        if not self._dopreload:
+            reason = "datas are not preloaded"
+        elif self._doreplay or self._dolive or self.p.live:
+            reason = "replay/live datas"
+        elif any(d.resampling or d.replaying or d._filters or d._ffilters for d in datas):
+            reason = "datas with filters/resampling"
+        elif any((d._timeframe, d._compression) != (data0._timeframe, data0._compression) for d in datas):
+            reason = "datas with different timeframes"
+        else:
+            dt0 = self._datetime_array(data0)
+            for d in datas[1:]:
+                if not np.array_equal(self._datetime_array(d), dt0):
+                    reason = "datetime of %s differs from %s" % (d._name, data0._name)
+                    break
+
+        if reason is not None:
+            performance_log.warning("aligned_clock disabled: %s" % reason)
+            return False
+        return True
+
+    @staticmethod
+    def _datetime_array(data):
+        line = data.lines.datetime
+        return np.asarray(line.array, dtype=np.float64)[:line.buflen()]
+
+    def _runnext_aligned(self, runstrats):
+        '''
+        _runnext 的同步版本。所有 feed 的 datetime 完全一致，
+        每一步所有 feed 同时前进一个 bar，不再逐 bar 求最小时间、回退超前的 feed，
+        也不再检查实时数据状态。
+        '''
+        datas = self.datas
+        datas1 = datas[1:]
+        data0 = datas[0]
+
+        while True:
+            self._storenotify()
+            if self._event_stop:  # stop if requested
+                return
+            self._datanotify()
+            if self._event_stop:  # stop if requested
+                return
+
+            d0ret = data0.next(ticks=False)
+            for d in datas1:
+                d.next(ticks=False)
+
+            if not d0ret:
+                break
+
+            for d in datas:
+                d._tick_fill(force=True)
+            dt0 = data0.datetime[0]
+            self._dtmaster = data0.num2date(dt0)
+            self._udtmaster = num2date(dt0)
+
+            # Datas may have generated a new notification after next
+            self._datanotify()
+            if self._event_stop:  # stop if requested
+                return
+
+            self._check_timers(runstrats, dt0, cheat=True)
+            if self.p.cheat_on_open:
+                for strat in runstrats:
+                    strat._next_open()
+                    if self._event_stop:  # stop if requested
+                        return
+
+            self._brokernotify()
+            if self._event_stop:  # stop if requested
+                return
+
+            self._check_timers(runstrats, dt0, cheat=False)
+            for strat in runstrats:
+                strat._next()
+                if self._event_stop:  # stop if requested
+                    return
+
+                self._next_writers(runstrats)
+
+        # Last notification chance before stopping
+        self._datanotify()
+        if self._event_stop:  # stop if requested
+            return
+        self._storenotify()
+
+    def _runonce_aligned(self, runstrats):
+        '''
+        _runonce 的同步版本。所有 feed 的 datetime 完全一致，
+        每一步所有 feed 同时前进一个 bar，不再逐 bar 查看各 feed 的下一个时间。
+        '''
+        for strat in runstrats:
+            strat._once()
+            strat.reset()  # strat called next by next - reset lines
+
+        datas = self.datas
+        data0 = datas[0]
+
+        while len(data0) < data0.buflen():
+            for d in datas:
+                d.advance()
+
+            dt0 = data0.datetime[0]
+
+            self._check_timers(runstrats, dt0, cheat=True)
+
+            if self.p.cheat_on_open:
+                for strat in runstrats:
+                    strat._oncepost_open()
+                    if self._event_stop:  # stop if requested
+                        return
+
+            self._brokernotify()
+            if self._event_stop:  # stop if requested
+                return
+
+            self._check_timers(runstrats, dt0, cheat=False)
+
+            for strat in runstrats:
+                strat._oncepost(dt0)
+                if self._event_stop:  # stop if requested
+                    return
+
+                self._next_writers(runstrats)
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import os
+import pickle
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from base.log import performance_log
+from base.stock_store import StockStore
+
+
+def file_digest(path, size):
+    """
+    文件前 size 个字节的摘要，用于判断已处理过的部分是否被修改。
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    remaining = size
+    with open(path, "rb") as f:
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def frame_digest(df):
+    return hashlib.blake2b(
+        pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes(), digest_size=16
+    ).hexdigest()
+
+
+def cumulative_factor(initial_factor, returns):
+    """
+    在 initial_factor 的基础上连乘 1 + 涨跌幅，空值不计入，与 calculate_adjusted_prices 中 cumprod 的累计值相同。
+    """
+    factor = pd.concat([pd.Series([initial_factor]), 1 + returns], ignore_index=True).cumprod()
+    return factor.dropna().iloc[-1]
+
+
+def stable_rows(frame, null_columns=()):
+    """
+    补全(bfill/ffill)之前的数据中，不会因为追加新的行而改变的前导行数。
+
+    一行的某列为空值时，bfill 会取它之后第一个非空值；如果之后没有非空值，追加的新行就可能改变它。
+    因此每列最后一个非空值之后的行都是不稳定的；最后一行的 下日_* 列依赖下一行，也总是不稳定的。
+
+    :param frame: 合并指数之后、补全之前的数据(不合并指数时为计算完涨跌停和复权价格的数据)
+    :param null_columns: 不参与判断的列：从第一行起全部为空的列(如 CSV 中空白的 备注 列)，
+        否则任何一行都不会确定。这些列之后出现非空值时，调用方需要完整重建
+    """
+    n = len(frame)
+    notna = frame.drop(columns=[column for column in null_columns if column in frame.columns]).notna().to_numpy()
+    if n == 0 or not notna.any(axis=0).all():
+        return 0
+    if notna.shape[1] == 0:
+        return n - 1
+    last = n - 1 - np.argmax(notna[::-1], axis=0)
+    return int(min(last.min() + 1, n - 1))
+
+
+class IncrementalStockProcessor:
+    """
+    股票数据的增量处理。
+
+    每天只在股票 CSV 的末尾追加新的交易日，不再每次都重新处理全部历史。处理结果按股票存放在
+    <store_dir>/<股票代码>/ 下：
+        part-<序号>.arrow     已经确定、不会再改变的处理结果，只追加(Arrow IPC 文件，打开多个小文件的开销很小)
+        state.pkl             增量状态
+
+    增量状态包括：已处理的 CSV 字节数和摘要、最后一个交易日期、累计复权因子、
+    以及最后一个确定行(补全时用于向前填充收盘价等)。尚未确定的末尾几行(如停牌期间的行、
+    下日_* 列依赖下一个交易日的最后一行)连同对应的原始数据一起保存在状态中，下次和新数据一起重新计算。
+
+    更新时只解析 CSV 新增的字节。已处理部分的内容、指数数据的历史部分或起止日期发生变化，
+    新增的行不在最后一个交易日期之后，或已确定的行中全部为空的列出现了非空值(补全时会改变已确定的行)时，
+    自动完整重建。
+
+    结果与 processor.process_stock_data(index_data) 相同。processor 须直接读取 CSV(不使用 store)，
+    且使用 SingleStockDataProcessor 的处理步骤(涨跌停价、复权价格、合并指数)。
+    """
+
+    state_name = "state.pkl"
+    version = 2
+
+    def __init__(self, processor, store_dir, max_parts=50):
+        """
+        :param processor: SingleStockDataProcessor 或其子类的实例
+        :param store_dir: 处理结果的根目录
+        :param max_parts: 结果文件个数超过该值时合并为一个文件
+        """
+        self.processor = processor
+        self.stock_dir = os.path.join(store_dir, processor.stock_code)
+        self.max_parts = max_parts
+
+    @property
+    def csv_path(self):
+        return self.processor.file_path % self.processor.stock_code
+
+    @property
+    def state_path(self):
+        return os.path.join(self.stock_dir, self.state_name)
+
+    def update(self, index_data=None):
+        """
+        处理 CSV 新增的数据，返回 format_data 之后的完整结果。
+        """
+        state = self.load_state()
+        reason = self._check(state, index_data)
+        if reason is None:
+            new_rows = self._read_new_rows(state)
+            reason = self._check_new_rows(state, new_rows)
+            if reason is None and new_rows.empty and self._index_end(index_data) == state["index_end"]:
+                return self.read()
+        if reason is not None:
+            performance_log.debug(f"{self.processor.stock_code}: full rebuild, {reason}")
+            self.rebuild(index_data)
+        else:
+            self._append(state, new_rows, index_data)
+        return self.read()
+
+    def rebuild(self, index_data=None):
+        """
+        完整处理全部历史，重建结果文件和增量状态。
+        """
+        processor = self.processor
+        raw = processor.read_data()
+        size = os.path.getsize(self.csv_path)
+        shutil.rmtree(self.stock_dir, ignore_errors=True)
+        os.makedirs(self.stock_dir)
+
+        state = {
+            "version": self.version,
+            "csv_size": size,
+            "csv_digest": file_digest(self.csv_path, size),
+            "csv_columns": pd.read_csv(self.csv_path, encoding="gbk", skiprows=1, nrows=0).columns.tolist(),
+            "raw_columns": raw.columns.tolist(),
+            "dates": (self.processor.start_date, self.processor.end_date),
+            "index_mode": index_data is not None,
+            "index_end": self._index_end(index_data),
+            "parts": [],
+            "last_date": None,
+            "null_columns": [],  # 从第一行起全部为空、不参与 stable_rows 判断的列
+        }
+        if raw.empty:
+            self._save_state(state)
+            return
+        pre = processor.calculate_zdt_price_and_st(raw.copy())
+        pre = processor.calculate_adjusted_prices(pre)
+        state.update(
+            initial_factor=1.0,
+            # 第一行的复权因子为 1 + 涨跌幅
+            base=pre.iloc[0]["收盘价"] / (1 + pre.iloc[0]["涨跌幅"]),
+            carry=None,
+            last_date=raw["交易日期"].iloc[-1],
+        )
+        self._advance(state, raw, pre, index_data)
+
+    def read(self):
+        """
+        读取完整的处理结果(format_data 之后)，没有数据时返回空的 DataFrame。
+        """
+        state = self.load_state()
+        if state is None or state["last_date"] is None:
+            return pd.DataFrame()
+        frames = [state["tail"]]
+        if state["parts"]:
+            table = pa.concat_tables([self._read_part(part) for part in state["parts"]])
+            frames.insert(0, table.to_pandas())
+        df = pd.concat(frames, ignore_index=True).infer_objects()
+        return self.processor.format_data(df)
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path, "rb") as f:
+            state = pickle.load(f)
+        return state if state.get("version") == self.version else None
+
+    def _save_state(self, state):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.state_path)
+
+    def _check(self, state, index_data):
+        """
+        返回需要完整重建的原因，可以增量更新时返回 None。
+        """
+        if state is None:
+            return "no state"
+        if state["last_date"] is None:
+            return "no data"
+        if state["dates"] != (self.processor.start_date, self.processor.end_date):
+            return "date range changed"
+        if state["index_mode"] != (index_data is not None):
+            return "index data changed"
+        size = os.path.getsize(self.csv_path)
+        if size < state["csv_size"] or file_digest(self.csv_path, state["csv_size"]) != state["csv_digest"]:
+            return "history changed"
+        if index_data is not None and state["carry"] is not None:
+            history = index_data[index_data["交易日期"] <= state["carry"]["交易日期"].iloc[0]]
+            if frame_digest(history) != state["index_digest"]:
+                return "index history changed"
+        return None
+
+    def _read_new_rows(self, state):
+        """
+        只解析 CSV 中上次处理之后追加的字节。
+        """
+        with open(self.csv_path, "rb") as f:
+            f.seek(state["csv_size"])
+            data = f.read()
+        state["csv_size"] += len(data)
+        state["csv_digest"] = file_digest(self.csv_path, state["csv_size"])
+        if not data.strip():
+            return pd.DataFrame(columns=state["raw_columns"])
+        df = pd.read_csv(
+            io.BytesIO(data),
+            encoding="gbk",
+            header=None,
+            names=state["csv_columns"],
+            parse_dates=["交易日期"],
+            usecols=state["raw_columns"],
+            dtype=self.processor.read_dtypes,
+        )[state["raw_columns"]]
+        if self.processor.start_date is not None:
+            df = df[df["交易日期"] >= pd.to_datetime(self.processor.start_date)]
+        if self.processor.end_date is not None:
+            df = df[df["交易日期"] <= pd.to_datetime(self.processor.end_date)]
+        return df.reset_index(drop=True)
+
+    @staticmethod
+    def _check_new_rows(state, new_rows):
+        dates = new_rows["交易日期"]
+        if len(dates) and (dates.iloc[0] <= state["last_date"] or not dates.is_monotonic_increasing or not dates.is_unique):
+            return "rows out of order"
+        return None
+
+    @staticmethod
+    def _index_end(index_data):
+        return None if index_data is None or index_data.empty else index_data["交易日期"].iloc[-1]
+
+    def _append(self, state, new_rows, index_data):
+        processor = self.processor
+        state["index_end"] = self._index_end(index_data)
+        raw = state["raw_tail"]
+        if len(new_rows):
+            raw = pd.concat([raw, new_rows], ignore_index=True)
+            state["last_date"] = new_rows["交易日期"].iloc[-1]
+        pre = raw
+        if not raw.empty:
+            pre = processor.calculate_zdt_price_and_st(raw.copy())
+            pre = processor.calculate_adjusted_prices(pre, initial_factor=state["initial_factor"], base=state["base"])
+        if self._null_columns_filled(state, pre, index_data):
+            performance_log.debug(f"{processor.stock_code}: full rebuild, empty column filled")
+            self.rebuild(index_data)
+            return
+        self._advance(state, raw, pre, index_data)
+
+    @staticmethod
+    def _null_columns_filled(state, pre, index_data):
+        """
+        已确定的行中全部为空的列在之后的数据中是否出现了非空值。
+        """
+        null_columns = state["null_columns"]
+        if not null_columns or state["carry"] is None:
+            return False
+        frames = [pre]
+        if index_data is not None:
+            frames.append(index_data[index_data["交易日期"] > state["carry"]["交易日期"].iloc[0]])
+        for frame in frames:
+            columns = [column for column in null_columns if column in frame.columns]
+            if columns and frame[columns].notna().to_numpy().any():
+                return True
+        return False
+
+    def _advance(self, state, raw, pre, index_data):
+        """
+        计算尚未确定的部分：raw/pre 为最后一个确定行之后的原始数据及其涨跌停、复权计算结果。
+        确定的行追加写入结果文件，其余的行保存在状态中。
+        """
+        processor = self.processor
+        carry = state["carry"]
+        if index_data is not None:
+            index_part = index_data
+            if carry is not None:
+                carry_date = carry["交易日期"].iloc[0]
+                index_part = index_data[index_data["交易日期"] >= carry_date]
+                index_new = index_part[index_part["交易日期"] > carry_date]
+                # 最后一个确定行放在最前面，用于向前填充，合并后去掉
+                merged = processor.merge_with_index_data(pd.concat([carry, pre], ignore_index=True), index_part)
+                merged = merged.iloc[1:].reset_index(drop=True)
+            else:
+                index_new = index_part
+                merged = processor.merge_with_index_data(pre, index_part)
+            prefill = pd.merge(left=pre, right=index_new, on="交易日期", how="right", sort=True)
+        else:
+            merged = pre.reset_index(drop=True)
+            prefill = merged
+
+        if carry is None:
+            # 还没有确定的行时 prefill 包含全部历史
+            state["null_columns"] = prefill.columns[prefill.isna().to_numpy().all(axis=0)].tolist()
+        n_stable = stable_rows(prefill, state["null_columns"])
+        if n_stable:
+            self._write_part(state, merged.iloc[:n_stable])
+            carry = merged.iloc[[n_stable - 1]][pre.columns].reset_index(drop=True)
+            carry_date = carry["交易日期"].iloc[0]
+            done = (pre["交易日期"] <= carry_date).to_numpy()
+            state["initial_factor"] = cumulative_factor(state["initial_factor"], pre.loc[done, "涨跌幅"])
+            raw = raw[~done].reset_index(drop=True)
+            state["carry"] = carry
+            if index_data is not None:
+                state["index_digest"] = frame_digest(index_data[index_data["交易日期"] <= carry_date])
+
+        state["raw_tail"] = raw
+        state["tail"] = merged.iloc[n_stable:].reset_index(drop=True)
+        self._save_state(state)
+
+    def _write_part(self, state, df):
+        parts = state["parts"]
+        number = int(parts[-1][5:11]) + 1 if parts else 0
+        name = "part-%06d.arrow" % number
+        table = pa.Table.from_pandas(StockStore.normalize_types(df.copy()), preserve_index=False)
+        feather.write_feather(table, os.path.join(self.stock_dir, name))
+        parts.append(name)
+        if len(parts) > self.max_parts:
+            self._compact(state)
+
+    def _compact(self, state):
+        """
+        合并所有结果文件。先写新文件再更新状态，最后删除旧文件。
+        """
+        old_parts = state["parts"]
+        name = "part-%06d.arrow" % (int(old_parts[-1][5:11]) + 1)
+        table = pa.concat_tables([self._read_part(part) for part in old_parts])
+        feather.write_feather(table, os.path.join(self.stock_dir, name))
+        state["parts"] = [name]
+        self._save_state(state)
+        for part in old_parts:
+            os.remove(os.path.join(self.stock_dir, part))
+
+    def _read_part(self, part):
+        return feather.read_table(os.path.join(self.stock_dir, part))
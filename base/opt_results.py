@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import json
+import numbers
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def flatten_analysis(analysis, prefix=""):
+    """
+    将分析器的 get_analysis() 结果展开为 {"a.b.c": 标量}。
+    只展开键为字符串的字典，以日期为键的序列(如 PyFolio 的 returns)会被跳过。
+    """
+    flat = {}
+    for key, value in analysis.items():
+        if not isinstance(key, str):
+            continue
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten_analysis(value, name + "."))
+        elif value is None or isinstance(value, (numbers.Number, str)):
+            flat[name] = value
+    return flat
+
+
+def default_metrics(strat):
+    """
+    默认的指标提取方法：展开策略所有分析器中的标量结果。
+    """
+    metrics = {}
+    for name, analyzer in zip(strat.analyzers.getnames(), strat.analyzers):
+        metrics.update(flatten_analysis(analyzer.get_analysis(), name + "."))
+    return metrics
+
+
+def analysis_value(strat, path):
+    """
+    按 "分析器名.键.子键" 读取分析器结果中的标量，不存在或为 None 时返回 nan。
+    """
+    name, _, keys = path.partition(".")
+    value = strat.analyzers.getbyname(name).get_analysis()
+    for key in keys.split(".") if keys else []:
+        value = value.get(key) if isinstance(value, dict) else None
+        if value is None:
+            return np.nan
+    return np.nan if value is None else value
+
+
+class OptRecord:
+    """
+    紧凑的优化结果：参数值元组 + 指标的一维 float64 数组。
+
+    不再携带分析器对象，序列化体积只与参数和指标个数有关，
+    多个结果可以用 records_to_frame 快速拼成 DataFrame。
+    """
+
+    __slots__ = ("param_names", "params", "metric_names", "metrics")
+
+    def __init__(self, param_names, params, metric_names, metrics):
+        self.param_names = param_names
+        self.params = params
+        self.metric_names = metric_names
+        self.metrics = metrics
+
+    @classmethod
+    def from_strategy(cls, strat, metrics):
+        """
+        :param strat: 运行结束的策略
+        :param metrics: 指标列表，每项为 "分析器名.键" 路径，或 (列名, 路径或 callable(strat))
+        """
+        kwargs = strat.params._getkwargs()
+        names = []
+        values = []
+        for spec in metrics:
+            name, getter = (spec, spec) if isinstance(spec, str) else spec
+            names.append(name)
+            values.append(analysis_value(strat, getter) if isinstance(getter, str) else getter(strat))
+        return cls(
+            tuple(kwargs.keys()),
+            tuple(kwargs.values()),
+            tuple(names),
+            np.array(values, dtype=np.float64),
+        )
+
+    def params_dict(self):
+        return dict(zip(self.param_names, self.params))
+
+    def metrics_dict(self):
+        return dict(zip(self.metric_names, self.metrics.tolist()))
+
+    def __getstate__(self):
+        return self.param_names, self.params, self.metric_names, self.metrics
+
+    def __setstate__(self, state):
+        self.param_names, self.params, self.metric_names, self.metrics = state
+
+    def __repr__(self):
+        return "OptRecord(%s, %s)" % (self.params_dict(), self.metrics_dict())
+
+
+def records_to_frame(records):
+    """
+    将 OptRecord 列表拼成一个 DataFrame，列为 参数 + 指标。
+    """
+    if not records:
+        return pd.DataFrame()
+    first = records[0]
+    params = pd.DataFrame([r.params for r in records], columns=list(first.param_names))
+    metrics = pd.DataFrame(np.vstack([r.metrics for r in records]), columns=list(first.metric_names))
+    return pd.concat([params, metrics], axis=1)
+
+
+class OptResultSink:
+    """
+    逐条写入优化结果的 jsonl 文件，每完成一个参数组合就追加一行并立即刷新，
+    即使优化中途崩溃，已完成的结果也不会丢失。
+
+    每行格式：{"params": {...}, "metrics": {...}}，一个结果包含多个策略时写多行。
+    """
+
+    def __init__(self, path, metrics=None):
+        self.path = path
+        self.metrics = metrics or default_metrics
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, result):
+        for strat in result:
+            if isinstance(strat, OptRecord):
+                record = {"params": strat.params_dict(), "metrics": strat.metrics_dict()}
+            else:
+                record = {
+                    "params": dict(strat.params._getkwargs()),
+                    "metrics": self.metrics(strat),
+                }
+            self._file.write(json.dumps(record, ensure_ascii=False, default=repr) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class OptResultCollector:
+    """
+    收集优化结果。
+
+    - sink: 可选的 OptResultSink，每个结果到达时写入磁盘
+    - keep_top: 只在内存中保留得分最高的 k 个结果，None 表示全部保留
+    - score: callable(result) -> float，分数越大越好，nan 视为最低分，keep_top 不为 None 时必须提供
+    """
+
+    def __init__(self, sink=None, keep_top=None, score=None):
+        if keep_top is not None and score is None:
+            raise ValueError("score is required when keep_top is set")
+        self.sink = sink
+        self.keep_top = keep_top
+        self.score = score
+        self._results = []
+        self._counter = itertools.count()  # 分数相同时按到达顺序排序
+
+    def add(self, result):
+        if self.sink is not None:
+            self.sink.write(result)
+
+        if self.keep_top is None:
+            self._results.append(result)
+            return
+
+        score = self.score(result)
+        # 缺失的指标(如 analysis_value 返回的 nan)排在最后，nan 无法参与比较
+        score = -np.inf if np.isnan(score) else score
+        item = (score, -next(self._counter), result)
+        if len(self._results) < self.keep_top:
+            heapq.heappush(self._results, item)
+        else:
+            heapq.heappushpop(self._results, item)
+
+    def results(self):
+        """
+        返回收集到的结果；保留 top-k 时按分数从高到低排列。
+        """
+        if self.keep_top is None:
+            return self._results
+        return [item[2] for item in sorted(self._results, reverse=True)]
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import backtrader as bt
+import numpy as np
+import pandas as pd
+from backtrader.utils import date2num
+
+
+class PanelLine:
+    """
+    单只股票某个字段的 line 视图，按 ago 读取面板矩阵中当前 bar 对应的值。
+    只读，不随 bar 推进做任何操作，当前位置直接取自面板的时钟。
+    """
+
+    __slots__ = ("_clock", "_column")
+
+    def __init__(self, clock, column):
+        self._clock = clock  # 面板 feed 的 datetime LineBuffer
+        self._column = column  # 该股票在矩阵中的一列(视图)
+
+    def __getitem__(self, ago):
+        return self._column[self._clock.lencount - 1 + ago]
+
+    def get(self, ago=0, size=1):
+        end = self._clock.lencount + ago
+        return self._column[end - size: end]
+
+    def __len__(self):
+        return self._clock.lencount
+
+
+class StockView:
+    """
+    面板中单只股票的轻量视图。
+
+    提供与普通 feed 相同的 data.close[0]、data.market_cap[0] 访问方式，
+    以及 broker、订单和成交记录需要的属性(datetime、_name、num2date 等)，
+    因此可以直接用于 order_target_percent、getposition 等接口。
+    """
+
+    _compensate = None
+
+    def __init__(self, panel, name, col):
+        self._panel = panel
+        self._name = name
+        self._col = col
+        self.datetime = panel.lines.datetime  # 与面板共用时钟
+        for field, matrix in panel.fields.items():
+            setattr(self, field, PanelLine(self.datetime, matrix[:, col]))
+
+    @property
+    def p(self):
+        return self._panel.p
+
+    @property
+    def params(self):
+        return self._panel.p
+
+    @property
+    def _tz(self):
+        return self._panel._tz
+
+    def num2date(self, *args, **kwargs):
+        return self._panel.num2date(*args, **kwargs)
+
+    def date2num(self, *args, **kwargs):
+        return self._panel.date2num(*args, **kwargs)
+
+    def __len__(self):
+        return self.datetime.lencount
+
+    def __repr__(self):
+        return "StockView(%s)" % self._name
+
+
+class PanelData(bt.feeds.DataBase):
+    """
+    以 日期 × 股票 矩阵保存全市场数据的面板 feed。
+
+    整个股票池只对应一个 backtrader feed，每个 bar 只推进一次时钟，
+    内存和单 bar 开销只与矩阵大小有关，与股票数量对应的 Python 对象个数无关。
+
+    - dataname: {字段名: DataFrame(index 为交易日期, columns 为股票代码)}，
+      所有 DataFrame 的 index 和 columns 必须一致
+    - stock(code) / stocks: 返回单只股票的视图，支持 data.close[0] 形式的访问
+    - cross_section(field, ago=0): 返回当前 bar 所有股票某字段的一维数组(不复制)
+
+    面板 feed 的价格 line 都为 0，按 strategy.datas 逐个 feed 统计持仓的分析器
+    (PositionsValue、PyFolio 的 positions)在面板模式下没有意义；净值和收益率(TimeReturn 等)不受影响。
+    """
+
+    def __init__(self):
+        panel = self.p.dataname
+        frames = list(panel.values())
+        dates = frames[0].index
+        codes = frames[0].columns
+        for frame in frames[1:]:
+            if not (frame.index.equals(dates) and frame.columns.equals(codes)):
+                raise ValueError("all panel fields must share the same dates and stock codes")
+
+        # 按起止日期截取，使矩阵的行号与 bar 的序号一一对应
+        mask = np.ones(len(dates), dtype=bool)
+        if self.p.fromdate is not None:
+            mask &= dates >= pd.Timestamp(self.p.fromdate)
+        if self.p.todate is not None:
+            mask &= dates <= pd.Timestamp(self.p.todate)
+
+        self.codes = list(codes)
+        self.fields = {
+            field: np.ascontiguousarray(frame.to_numpy(dtype=np.float64)[mask])
+            for field, frame in panel.items()
+        }
+        self._dates = np.array([date2num(d) for d in dates[mask].to_pydatetime()])
+        self.stocks = [StockView(self, code, col) for col, code in enumerate(self.codes)]
+        self._stock_index = {code: col for col, code in enumerate(self.codes)}
+
+    @classmethod
+    def from_frames(cls, frames, fields=None, **kwargs):
+        """
+        由每只股票一个的 DataFrame(index 为交易日期，columns 为字段)构建面板 feed。
+        各股票的日期取并集，缺失的位置为 nan。
+
+        :param frames: {股票代码: DataFrame}
+        :param fields: 需要放入面板的字段，默认使用第一个 DataFrame 的全部列
+        """
+        if fields is None:
+            fields = list(next(iter(frames.values())).columns)
+        dates = pd.DatetimeIndex(sorted(set().union(*(df.index for df in frames.values()))))
+        codes = list(frames.keys())
+        rows = [dates.get_indexer(frames[code].index) for code in codes]
+        panel = {}
+        for field in fields:
+            matrix = np.full((len(dates), len(codes)), np.nan)
+            for col, code in enumerate(codes):
+                matrix[rows[col], col] = frames[code][field].to_numpy(dtype=np.float64)
+            panel[field] = pd.DataFrame(matrix, index=dates, columns=codes)
+        return cls(dataname=panel, **kwargs)
+
+    def start(self):
+        super(PanelData, self).start()
+        self._row = 0
+        self._pricelines = [getattr(self.lines, f) for f in self.getlinealiases() if f != "datetime"]
+
+    def _load(self):
+        if self._row >= len(self._dates):
+            return False
+        self.lines.datetime[0] = self._dates[self._row]
+        # 面板本身不是可交易品种，价格置 0，避免分析器按面板估值时得到 nan
+        for line in self._pricelines:
+            line[0] = 0.0
+        self._row += 1
+        return True
+
+    def stock(self, code):
+        return self.stocks[self._stock_index[code]]
+
+    def cross_section(self, field, ago=0):
+        return self.fields[field][len(self.lines.datetime) - 1 + ago]
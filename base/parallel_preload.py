@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from multiprocessing import Pool
+
+import numpy as np
+
+from base.preload_cache import detach_lines, dump_lines, read_manifest, restore_lines
+
+# 预加载子进程中的 (datas, exactbars, lookahead)，由进程池的 initializer 设置
+_worker_args = None
+
+
+def preload_feeds(datas, exactbars, lookahead, preload=True):
+    """
+    逐个 feed 预加载，与 Cerebro 的串行预加载步骤相同。
+    """
+    for data in datas:
+        detach_lines(data)
+        data.reset()
+        if exactbars < 1:  # datas can be full length
+            data.extend(size=lookahead)
+        data._start()
+        if preload:
+            data.preload()
+
+
+def parallel_preload(datas, processes, exactbars, lookahead):
+    """
+    多进程预加载。
+
+    PandasData 等数据源的 preload 逐个 bar 执行 Python 代码，不释放 GIL，多线程没有收益。
+    这里把 datas 按顺序分成 processes 组，每个子进程串行预加载一组，
+    然后把各条 line 按列写成与预加载缓存相同格式的文件；主进程读入列文件后挂到各 feed 上(attach_lines)，
+    结果与串行预加载相同，与分组方式和完成顺序无关。
+
+    子进程通过 fork 继承 datas，不需要序列化；使用 spawn 启动方式的平台(Windows)上，
+    每个子进程启动时会序列化一次全部 datas。
+
+    :param datas: cerebro.datas
+    :param processes: 子进程个数
+    :param exactbars: cerebro 的 exactbars 参数
+    :param lookahead: cerebro 的 lookahead 参数
+    """
+    groups = [group.tolist() for group in np.array_split(np.arange(len(datas)), processes) if len(group)]
+    tmp_dir = tempfile.mkdtemp(prefix="fast_cerebro_preload_")
+    try:
+        tasks = []
+        for i, group in enumerate(groups):
+            path = os.path.join(tmp_dir, str(i))
+            os.makedirs(path)
+            tasks.append((path, group))
+        with Pool(len(tasks), initializer=_init_worker, initargs=(datas, exactbars, lookahead)) as pool:
+            pool.map(_preload_group, tasks, chunksize=1)
+        for path, group in tasks:
+            # 读入内存而不是映射，临时目录可以立即删除
+            restore_lines(path, read_manifest(path), [datas[i] for i in group], mmap_mode=None)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _init_worker(datas, exactbars, lookahead):
+    global _worker_args
+    _worker_args = (datas, exactbars, lookahead)
+
+
+def _preload_group(task):
+    path, group = task
+    datas, exactbars, lookahead = _worker_args
+    feeds = [datas[i] for i in group]
+    preload_feeds(feeds, exactbars, lookahead)
+    dump_lines(path, feeds)
+
+
+if __name__ == "__main__":
+    import time
+    from multiprocessing import cpu_count
+
+    import backtrader as bt
+    import pandas as pd
+
+    from base.fast_cerebro import FastCerebro
+    from base.log import performance_log
+
+    # 200 个 feed x 2500 个交易日
+    n_feeds, n_days = 200, 2500
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range("2010-01-01", periods=n_days)
+
+    def make_cerebro(processes):
+        cerebro = FastCerebro(preload_processes=processes)
+        for i in range(n_feeds):
+            close = 10 * np.exp(np.cumsum(rng.normal(0, 0.02, n_days)))
+            df = pd.DataFrame(
+                {"open": close, "high": close, "low": close, "close": close, "volume": 1000.0},
+                index=dates,
+            )
+            cerebro.adddata(bt.feeds.PandasData(dataname=df), name="s%04d" % i)
+        cerebro._prepare_run()
+        return cerebro
+
+    processes = max(cpu_count(), 2)
+    timings = {}
+    arrays = {}
+    for name, n in (("serial", None), ("parallel", processes)):
+        rng = np.random.default_rng(0)  # 两次生成相同的数据
+        cerebro = make_cerebro(n)
+        start = time.perf_counter()
+        cerebro._preload_data()
+        timings[name] = time.perf_counter() - start
+        arrays[name] = [np.asarray(line.array, dtype=np.float64) for data in cerebro.datas for line in data.lines]
+
+    assert all(np.array_equal(a, b, equal_nan=True) for a, b in zip(arrays["serial"], arrays["parallel"]))
+    performance_log.info(
+        "preload %d feeds x %d bars: serial %.2fs, %d processes %.2fs, %.1fx"
+        % (n_feeds, n_days, timings["serial"], processes, timings["parallel"],
+           timings["serial"] / timings["parallel"])
+    )
@@ -2,6 +2,7 @@
 import functools
 import timeit
 import time
+from collections import OrderedDict
 from base.log import performance_log
 
 # Try to import the best available time measurement function
@@ -76,6 +77,59 @@ class PerformanceTimer:
         return wrapper
 
 
+class PhaseTimer:
+    """
+    Records wall/cpu time of consecutive phases inside one run and builds a structured report.
+
+    Call ``lap(name)`` at the end of each phase: the time elapsed since the
+    previous lap (or since creation) is added to phase ``name``. When disabled,
+    every call returns immediately, so the instrumentation costs next to nothing.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        if not enabled:
+            return
+
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self._start_time = self._last_time = timeit.default_timer()
+        self._start_cpu_time = self._last_cpu_time = process_time()
+
+    def lap(self, name):
+        if not self.enabled:
+            return
+
+        now = timeit.default_timer()
+        now_cpu = process_time()
+        entry = self.phases.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+        entry["wall"] += now - self._last_time
+        entry["cpu"] += now_cpu - self._last_cpu_time
+        self._last_time = now
+        self._last_cpu_time = now_cpu
+
+    def count(self, name, value):
+        if self.enabled:
+            self.counters[name] = value
+
+    def report(self):
+        """
+        Returns the timing report as a dict (JSON serializable), or None if disabled.
+        """
+        if not self.enabled:
+            return None
+
+        report = {
+            "total": {
+                "wall": self._last_time - self._start_time,
+                "cpu": self._last_cpu_time - self._start_cpu_time,
+            },
+            "phases": dict(self.phases),
+        }
+        report.update(self.counters)
+        return report
+
+
 # Create an instance of PerformanceTimer with debug logging enabled.
 performance_timer = PerformanceTimer(enabled=True)
 
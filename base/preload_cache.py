@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+def source_fingerprint(dataname):
+    """
+    计算数据源的指纹。
+
+    - 文件路径：使用 路径 + 文件大小 + 修改时间(ns)，无需读取文件内容
+    - DataFrame：使用列名、类型和逐行哈希计算内容摘要
+    - 其他对象：对 pickle 序列化后的字节计算摘要
+
+    :param dataname: 数据源，即 feed 的 dataname 参数
+    :return: 指纹字符串
+    """
+    if isinstance(dataname, str) and os.path.exists(dataname):
+        stat = os.stat(dataname)
+        return "file:%s:%d:%d" % (os.path.abspath(dataname), stat.st_size, stat.st_mtime_ns)
+
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(dataname, pd.DataFrame):
+        digest.update(repr(list(dataname.columns)).encode("utf-8"))
+        digest.update(repr([str(t) for t in dataname.dtypes]).encode("utf-8"))
+        digest.update(pd.util.hash_pandas_object(dataname, index=True).values.tobytes())
+        return "frame:%s" % digest.hexdigest()
+
+    digest.update(pickle.dumps(dataname, protocol=pickle.HIGHEST_PROTOCOL))
+    return "object:%s" % digest.hexdigest()
+
+
+def feed_descriptor(data):
+    """
+    描述单个 feed 的所有会影响预加载结果的信息：
+    数据源指纹、feed 类、名称、起止日期以及 lines 与列的映射参数。
+    """
+    params = data.p._getkwargs()
+    dataname = params.pop("dataname", None)
+    return {
+        "source": source_fingerprint(dataname),
+        "class": "%s.%s" % (type(data).__module__, type(data).__qualname__),
+        "name": data._name,
+        "fromdate": repr(params.pop("fromdate", None)),
+        "todate": repr(params.pop("todate", None)),
+        "lines": list(data.lines.getlinealiases()),
+        "params": [(k, repr(v)) for k, v in params.items()],
+    }
+
+
+class MappedLineArray(np.ndarray):
+    """
+    以内存映射数组作为 LineBuffer 的底层存储。
+
+    预加载完成后 backtrader 只会按下标读取数据 line，但在数据耗尽时仍会调用一次
+    append/pop(先 forward 再 backwards)，这里用一个尾部列表承接这类调用，
+    映射的数组本身保持只读，页面按需载入。
+    """
+
+    def __array_finalize__(self, obj):
+        self._tail = []
+
+    def append(self, value):
+        self._tail.append(value)
+
+    def pop(self):
+        return self._tail.pop()
+
+    def __len__(self):
+        return np.ndarray.__len__(self) + len(self._tail)
+
+
+class PreloadCache:
+    """
+    按内容寻址的预加载缓存。
+
+    缓存键由所有 feed 的描述信息计算得到，数据源变化后键随之变化，不会再读到旧数据。
+    多个缓存条目可以同时存放在 cache_dir 下，按最近使用时间(LRU)淘汰，
+    同时可以限制条目个数和总字节数。
+
+    每个条目是一个目录，按列存储：
+        <key>/manifest.json   每个 feed 的类型、名称、lines、在列文件中的偏移和长度
+        <key>/<line>.npy      所有 feed 同名 line 首尾相连的 float64 数组
+    读取时以内存映射方式打开列文件，直接作为各 feed line 的底层数组，不再反序列化 feed 对象。
+    """
+
+    manifest_name = "manifest.json"
+    version = 1
+
+    def __init__(self, cache_dir, max_entries=None, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(datas, **extra):
+        """
+        根据 feed 列表和额外的参数(如 lookahead)计算缓存键。
+        """
+        payload = {
+            "datas": [feed_descriptor(data) for data in datas],
+            "extra": sorted((k, repr(v)) for k, v in extra.items()),
+        }
+        raw = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def contains(self, key):
+        return os.path.exists(os.path.join(self.entry_path(key), self.manifest_name))
+
+    def load(self, key, datas):
+        """
+        将缓存条目中的 line 数组映射回 datas，条目不存在或与 datas 不匹配时返回 False。
+        命中时刷新条目的使用时间。
+        """
+        if not self.contains(key):
+            return False
+        path = self.entry_path(key)
+        manifest = read_manifest(path)
+        if not restore_lines(path, manifest, datas):
+            return False
+        self._touch(path)
+        return True
+
+    def save(self, key, datas):
+        """
+        写入缓存条目。先写临时目录再重命名，避免中途失败留下损坏的条目。
+        """
+        tmp_path = tempfile.mkdtemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            dump_lines(tmp_path, datas)
+            path = self.entry_path(key)
+            if os.path.exists(path):
+                shutil.rmtree(path, ignore_errors=True)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict(keep=key)
+
+    def remove(self, key):
+        shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    def entries(self):
+        """
+        返回 [(key, 最近使用时间, 字节数)]，按最近使用时间从旧到新排序。
+        """
+        result = []
+        for fname in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, fname)
+            if not os.path.isdir(path) or fname.endswith(".tmp"):
+                continue
+            result.append((fname, os.stat(path).st_mtime, self._size(path)))
+        result.sort(key=lambda x: x[1])
+        return result
+
+    def evict(self, keep=None):
+        """
+        按 LRU 顺序淘汰条目，直到满足条目个数和总字节数的限制。
+        keep 指定的条目(通常是刚写入的)不会被淘汰。
+        """
+        entries = [e for e in self.entries() if e[0] != keep]
+        kept = 1 if keep is not None and self.contains(keep) else 0
+        total = sum(e[2] for e in entries)
+        if kept:
+            total += self._size(self.entry_path(keep))
+
+        while entries and (
+            (self.max_entries is not None and len(entries) + kept > self.max_entries)
+            or (self.max_bytes is not None and total > self.max_bytes)
+        ):
+            key, _, size = entries.pop(0)
+            self.remove(key)
+            total -= size
+
+    @staticmethod
+    def _touch(path):
+        os.utime(path, None)
+
+    @staticmethod
+    def _size(path):
+        return sum(
+            os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(path)
+            for f in files
+        )
+
+
+def dump_lines(path, datas):
+    """
+    将已预加载的 datas 按列写入 path 目录：同名 line 首尾相连存成一个 .npy 文件。
+    """
+    columns = {}
+    sizes = {}
+    feeds = []
+    for data in datas:
+        aliases = list(data.lines.getlinealiases())
+        length = len(data.lines[0].array)
+        offsets = {}
+        for alias, line in zip(aliases, data.lines):
+            offsets[alias] = sizes.get(alias, 0)
+            sizes[alias] = offsets[alias] + length
+            columns.setdefault(alias, []).append(np.frombuffer(line.array, dtype=np.float64))
+        feeds.append(
+            {
+                "class": "%s.%s" % (type(data).__module__, type(data).__qualname__),
+                "name": data._name,
+                "lines": aliases,
+                "offsets": offsets,
+                "length": length,
+                "extension": data.lines[0].extension,
+            }
+        )
+
+    for alias, chunks in columns.items():
+        np.save(os.path.join(path, alias + ".npy"), np.concatenate(chunks))
+
+    with open(os.path.join(path, PreloadCache.manifest_name), "w", encoding="utf-8") as f:
+        json.dump({"version": PreloadCache.version, "feeds": feeds}, f, ensure_ascii=False)
+
+
+def read_manifest(path):
+    with open(os.path.join(path, PreloadCache.manifest_name), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def restore_lines(path, manifest, datas, start=True, mmap_mode="r"):
+    """
+    按 manifest 把列文件以内存映射方式挂到 datas 的各条 line 上，
+    结果等价于对 datas 执行过 preload。manifest 与 datas 不匹配时返回 False。
+    start 为 False 时不再启动数据源(feed 已在别处启动过，例如优化子进程中)。
+    mmap_mode 为 None 时把列文件完整读入内存，之后可以删除文件。
+    """
+    feeds = manifest["feeds"]
+    if manifest.get("version") != PreloadCache.version or len(feeds) != len(datas):
+        return False
+    for feed, data in zip(feeds, datas):
+        if feed["lines"] != list(data.lines.getlinealiases()):
+            return False
+
+    columns = {}
+    for feed in feeds:
+        for alias in feed["lines"]:
+            if alias not in columns:
+                columns[alias] = np.load(os.path.join(path, alias + ".npy"), mmap_mode=mmap_mode)
+
+    for feed, data in zip(feeds, datas):
+        attach_lines(data, columns, feed, start=start)
+    return True
+
+
+def attach_lines(data, columns, feed, start=True):
+    """
+    把 columns 中属于 feed 的片段(视图，不复制)设置为 data 各条 line 的底层数组。
+    """
+    data.reset()
+    if start:
+        data._start()
+    # 所有 bar 已在映射数组中，数据源视为已读完
+    data._load = _source_exhausted
+    length = feed["length"]
+    for alias, line in zip(feed["lines"], data.lines):
+        offset = feed["offsets"][alias]
+        line.array = columns[alias][offset: offset + length].view(MappedLineArray)
+        line.extension = feed["extension"]
+
+
+def detach_lines(data):
+    """
+    撤销 attach_lines 对数据源的替换，使 feed 可以重新从数据源预加载。
+    """
+    data.__dict__.pop("_load", None)
+
+
+def _source_exhausted():
+    return False
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import array
+import collections.abc
+import shutil
+import tempfile
+
+from base.preload_cache import dump_lines, read_manifest, restore_lines
+
+# 优化子进程中常驻的 cerebro，由进程池的 initializer 设置
+_worker_cerebro = None
+
+
+class SharedDatas:
+    """
+    优化时在进程间共享预加载数据。
+
+    父进程把已预加载的 line 数组按列写成内存映射文件(与预加载缓存相同的格式，
+    命中缓存时直接复用缓存条目)，然后把 datas 中的 line 数组和数据源剥离，
+    这样 cerebro 只需在每个子进程启动时传递一次且体积很小。
+    子进程以只读方式映射同一批文件，各进程共享操作系统的页缓存，
+    每个任务只传递策略参数组合。
+    """
+
+    def __init__(self, datas, entry_path=None):
+        self.datas = datas
+        self.owned = entry_path is None
+        if self.owned:
+            entry_path = tempfile.mkdtemp(prefix="fast_cerebro_")
+            dump_lines(entry_path, datas)
+        self.entry_path = entry_path
+        self._stash = None
+
+    def strip(self):
+        """
+        剥离 datas 的 line 数组、dataname 以及数据源迭代器(如 PandasDirectData 的 itertuples)，
+        使 feed 对象可以低成本地序列化。
+        """
+        self._stash = []
+        for data in self.datas:
+            arrays = [line.array for line in data.lines]
+            for line in data.lines:
+                line.array = array.array(str("d"))
+            iterators = {
+                k: v for k, v in vars(data).items() if isinstance(v, collections.abc.Iterator)
+            }
+            for k in iterators:
+                delattr(data, k)
+            self._stash.append((arrays, data.p.dataname, iterators))
+            data.p.dataname = None
+
+    def restore(self):
+        """
+        恢复 strip 剥离的内容。
+        """
+        for data, (arrays, dataname, iterators) in zip(self.datas, self._stash):
+            for line, arr in zip(data.lines, arrays):
+                line.array = arr
+            data.p.dataname = dataname
+            for k, v in iterators.items():
+                setattr(data, k, v)
+        self._stash = None
+
+    def close(self):
+        if self.owned:
+            shutil.rmtree(self.entry_path, ignore_errors=True)
+
+
+def init_worker(cerebro, entry_path):
+    """
+    进程池 initializer：把共享的列文件映射到子进程中的 datas 上。
+    """
+    global _worker_cerebro
+    restore_lines(entry_path, read_manifest(entry_path), cerebro.datas, start=False)
+    _worker_cerebro = cerebro
+
+
+def run_worker(iterstrat):
+    """
+    在子进程中运行一组策略参数，datas 在每个任务开始前回到起点。
+    """
+    for data in _worker_cerebro.datas:
+        data.home()
+    return _worker_cerebro.runstrategies(iterstrat, predata=True)
+
+
+def worker_cerebro():
+    """
+    返回子进程中由 init_worker 设置的 cerebro。
+    """
+    return _worker_cerebro
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from base.stock_store import StockStore
+
+
+def file_fingerprint(paths):
+    """
+    源文件的指纹：每个存在的文件的 (路径, 大小, 修改时间)。
+    """
+    fingerprint = []
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            fingerprint.append((path, stat.st_size, stat.st_mtime_ns))
+    return tuple(fingerprint)
+
+
+class StockCache(StockStore):
+    """
+    按股票分区的处理结果缓存，记录每只股票源文件的指纹，源文件变化时只需要重新处理对应的股票。
+
+    <cache_dir>/<股票代码>.parquet  一只股票处理后的数据(与 StockStore 相同的格式，按日期分成多个 row group)
+    <cache_dir>/manifest.pkl         处理参数和 {股票代码: 源文件指纹}
+
+    - 处理参数(如起止日期、处理器类)与生成缓存时不同，整个缓存失效
+    - 源文件的大小或修改时间变化，对应股票的缓存失效(stale)
+    - 处理结果为空的股票只记录在 manifest 中，不写文件
+    - read 按列和日期范围读取部分股票，不需要把全市场的数据读入内存
+
+    写入数据文件之后由 save_manifest 统一更新 manifest，中途退出时未记录的股票下次会重新处理。
+    """
+
+    manifest_name = "manifest.pkl"
+    version = 1
+
+    def __init__(self, cache_dir, params=None, date_column="date"):
+        """
+        :param cache_dir: 缓存目录
+        :param params: 影响处理结果的参数(可比较、可序列化)，与 manifest 中的不同时清空缓存
+        :param date_column: 处理结果中交易日期列的列名，用于按日期范围读取
+        """
+        super().__init__(cache_dir)
+        self.date_column = date_column
+        self.params = params
+        self.entries = {}
+        manifest = self._load_manifest()
+        if manifest is not None and manifest["params"] == params:
+            self.entries = manifest["entries"]
+        else:
+            self.clear()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.store_dir, self.manifest_name)
+
+    @staticmethod
+    def normalize_types(df):
+        """
+        category 列还原为原来的类型(各股票的类别不同)，其他列保持原类型(如 float32)。
+        """
+        for column in df.columns:
+            dtype = df[column].dtype
+            if isinstance(dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype(dtype.categories.dtype)
+        return df
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path, "rb") as f:
+            manifest = pickle.load(f)
+        return manifest if manifest.get("version") == self.version else None
+
+    def save_manifest(self):
+        manifest = {"version": self.version, "params": self.params, "entries": self.entries}
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.manifest_path)
+
+    def clear(self):
+        for stock_code in self.codes():
+            os.remove(self.path(stock_code))
+        self.entries = {}
+        self.save_manifest()
+
+    def stale(self, fingerprints):
+        """
+        :param fingerprints: {股票代码: 源文件指纹}
+        :return: 没有缓存或源文件已变化、需要重新处理的股票代码(按 fingerprints 的顺序)
+        """
+        return [
+            stock_code for stock_code, fingerprint in fingerprints.items()
+            if self.entries.get(stock_code, {}).get("fingerprint") != fingerprint
+        ]
+
+    def put(self, stock_code, df, fingerprint):
+        """
+        写入一只股票的处理结果，df 为 None 或空表示没有数据。
+        """
+        rows = 0 if df is None else len(df)
+        if rows:
+            self.write(stock_code, df.copy())
+        elif self.contains(stock_code):
+            os.remove(self.path(stock_code))
+        self.entries[stock_code] = {"fingerprint": fingerprint, "rows": rows}
+
+    def prune(self, stock_codes):
+        """
+        删除不在 stock_codes 中的股票(如源文件已删除)。
+        """
+        keep = set(stock_codes)
+        for stock_code in [code for code in self.entries if code not in keep]:
+            if self.contains(stock_code):
+                os.remove(self.path(stock_code))
+            del self.entries[stock_code]
+
+    def read_market(self, codes=None, columns=None, start_date=None, end_date=None):
+        """
+        按 codes 的顺序读取多只股票，没有数据的股票被跳过。
+
+        :param codes: 股票代码列表，None 表示缓存中的所有股票
+        :param columns: 需要的列，None 表示全部列
+        """
+        codes = sorted(self.entries) if codes is None else codes
+        paths = [self.path(code) for code in codes if self.entries.get(code, {}).get("rows")]
+        if not paths:
+            return pd.DataFrame()
+        dataset = ds.dataset(paths, format="parquet")
+        date_filter = self._date_filter(start_date, end_date)
+        # 逐个文件读取，保证结果按 codes 的顺序拼接
+        tables = [
+            fragment.to_table(schema=dataset.schema, columns=self._columns(columns), filter=date_filter)
+            for fragment in dataset.get_fragments()
+        ]
+        return pa.concat_tables(tables).to_pandas()
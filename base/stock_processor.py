@@ -1,17 +1,160 @@
 # -*- coding: utf-8 -*-
 import pandas as pd
 import numpy as np
-from decimal import Decimal, ROUND_HALF_UP
 from base.log import performance_log
 import statsmodels.api as sm
 
 
+def round_half_up(values, decimals=2):
+    """
+    向量化的严格四舍五入，与逐个元素执行
+    float(Decimal(x * 10 ** decimals).quantize(Decimal('1'), rounding=ROUND_HALF_UP) / 10 ** decimals)
+    的结果逐位相同。
+
+    Decimal(float) 是浮点数的精确值，所以这里同样对 x * 10 ** decimals 的浮点结果做精确判断：
+    小数部分 magnitude - floor(magnitude) 的浮点减法没有误差，直接与 0.5 比较即可，
+    不会出现 2.675 * 100 = 267.49999999999997 这类被"修正"成 268 的情况。
+    最后整数 / 10 ** decimals 的浮点除法与 Decimal 结果转 float 一样是正确舍入的。
+
+    :param values: 数组或 Series
+    :param decimals: 保留的小数位数
+    :return: float64 数组
+    """
+    scale = 10.0 ** decimals
+    scaled = np.asarray(values, dtype=np.float64) * scale
+    magnitude = np.abs(scaled)
+    whole = np.floor(magnitude)
+    whole += (magnitude - whole) >= 0.5  # ROUND_HALF_UP: 0.5 远离零进位
+    return np.copysign(whole, scaled) / scale
+
+
+def group_shift(series, periods, by=None):
+    """
+    by 为 None 时等同于 series.shift(periods)，否则在每只股票内部移动，不会跨股票取值。
+    """
+    if by is None:
+        return series.shift(periods)
+    return series.groupby(by, sort=False).shift(periods)
+
+
+def take(values, positions):
+    """
+    按行号取值，行号为 -1 的位置为空值(必要时提升类型，如 bool 变为 object)。
+    """
+    if isinstance(values, pd.arrays.NumpyExtensionArray):
+        values = values.to_numpy()  # object 列的 .array，take 只接受 ndarray 或其他 ExtensionArray
+    return pd.api.extensions.take(values, positions, allow_fill=True)
+
+
+def fill_positions(valid):
+    """
+    补全空值时的取值行号：previous 为每一行及之前最后一个有效行，following 为每一行及之后第一个有效行，没有时为 -1。
+    np.where(previous >= 0, previous, following) 相当于先 ffill 再 bfill，
+    np.where(following >= 0, following, previous) 相当于先 bfill 再 ffill。
+
+    :param valid: 每一行是否为有效值的 bool 数组
+    """
+    n = len(valid)
+    rows = np.arange(n)
+    previous = np.maximum.accumulate(np.where(valid, rows, -1))
+    following = np.minimum.accumulate(np.where(valid, rows, n)[::-1])[::-1]
+    following[following == n] = -1
+    return previous, following
+
+
+def cross_section_matrix(values, dates):
+    """
+    把长表中的一列按交易日期排成 日期 x 股票 的矩阵，每行是一个交易日的截面，
+    各行股票个数不同，不足的位置为 nan。用于按日期向量化计算截面统计量。
+
+    :param values: 一列数值(Series 或数组)
+    :param dates: 与 values 对齐的交易日期，不能有空值
+    :return: (matrix, rows, columns)，matrix[rows, columns] 依次为 values 中的值
+    """
+    values = np.asarray(values, dtype=np.float64)
+    rows, _ = pd.factorize(np.asarray(dates))
+    counts = np.bincount(rows)
+    starts = np.cumsum(counts) - counts
+    # 交易日个数不超过 65536 时按 uint16 排序，numpy 对 16 位整数的稳定排序为基数排序
+    order = np.argsort(rows.astype(np.uint16) if len(counts) <= 1 << 16 else rows, kind="stable")
+    columns = np.empty(len(values), dtype=np.intp)
+    columns[order] = np.arange(len(values)) - np.repeat(starts, counts)
+    matrix = np.full((len(counts), counts.max(initial=0)), np.nan)
+    matrix[rows, columns] = values
+    return matrix, rows, columns
+
+
+def row_mean_std(matrix):
+    """
+    每行非空值的均值和样本标准差(ddof=1)，与 Series.mean()/std() 相同：没有值时均值为 nan，只有一个值时标准差为 nan。
+    """
+    valid = ~np.isnan(matrix)
+    count = valid.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(valid, matrix, 0).sum(axis=1) / count
+        deviation = np.where(valid, matrix - mean[:, None], 0)
+        std = np.sqrt((deviation ** 2).sum(axis=1) / (count - 1))
+    std[count < 2] = np.nan
+    return mean, std
+
+
+def row_median(matrix):
+    """
+    每行非空值的中位数，与 Series.median() 相同：偶数个值时取中间两个值的平均，没有值时为 nan。
+    """
+    ordered = np.sort(matrix, axis=1)  # nan 排在每行的最后
+    count = (~np.isnan(matrix)).sum(axis=1)
+    if ordered.shape[1] == 0:
+        return np.full(len(matrix), np.nan)
+    low = np.take_along_axis(ordered, np.maximum(count - 1, 0)[:, None] // 2, axis=1)[:, 0]
+    high = np.take_along_axis(ordered, (count // 2)[:, None], axis=1)[:, 0]
+    return (low + high) / 2
+
+
+def clip_values(values, lower, upper):
+    """
+    与 Series.clip 相同，界限为 nan 时不截断，空值保持为空值。
+    """
+    return np.where(values < lower, lower, np.where(values > upper, upper, values))
+
+
+def group_demean(values, groups):
+    """
+    按组去均值：values 减去所在组的均值。
+
+    :param values: 一维数组，或每列一个变量的二维数组
+    :param groups: 与 values 的行对齐的非负整数组号
+    """
+    if values.ndim == 2:
+        return np.column_stack([group_demean(column, groups) for column in values.T])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.bincount(groups, weights=values) / np.bincount(groups)
+    return values - means[groups]
+
+
 class StockDataProcessor:
     @staticmethod
-    def calculate_adjusted_prices(df):
+    def calculate_adjusted_prices(df, by=None, initial_factor=None, base=None):
+        """
+        :param by: 面板数据的股票代码(Series 或数组)，None 表示 df 为单只股票的数据
+        :param initial_factor: 增量计算时，df 之前所有数据的累计复权因子(空值不计入)
+        :param base: 增量计算时，整段历史第一行的 收盘价 / 复权因子
+        """
         df["涨跌幅"] = df["收盘价"] / df["前收盘价"] - 1
-        df["复权因子"] = (1 + df["涨跌幅"]).cumprod()
-        df["收盘价_复权"] = df["复权因子"] * (df.iloc[0]["收盘价"] / df.iloc[0]["复权因子"])
+        if initial_factor is not None:
+            # 从之前的累计值继续连乘，与对完整历史 cumprod 的结果逐位相同
+            factor = pd.concat([pd.Series([initial_factor]), 1 + df["涨跌幅"]], ignore_index=True).cumprod()
+            df["复权因子"] = factor.to_numpy()[1:]
+            df["收盘价_复权"] = df["复权因子"] * base
+        elif by is None:
+            df["复权因子"] = (1 + df["涨跌幅"]).cumprod()
+            df["收盘价_复权"] = df["复权因子"] * (df.iloc[0]["收盘价"] / df.iloc[0]["复权因子"])
+        else:
+            df["复权因子"] = (1 + df["涨跌幅"]).groupby(by, sort=False).cumprod()
+            # 每只股票第一行的 收盘价 / 复权因子，第一行为空值时整只股票为空值，与单只股票的 iloc[0] 一致
+            is_first = df["复权因子"].groupby(by, sort=False).cumcount() == 0
+            base = (df["收盘价"] / df["复权因子"]).where(is_first).groupby(by, sort=False).transform("first")
+            df["收盘价_复权"] = df["复权因子"] * base
         df["开盘价_复权"] = df["开盘价"] / df["收盘价"] * df["收盘价_复权"]
         df["最高价_复权"] = df["最高价"] / df["收盘价"] * df["收盘价_复权"]
         df["最低价_复权"] = df["最低价"] / df["收盘价"] * df["收盘价_复权"]
@@ -19,7 +162,7 @@ class StockDataProcessor:
         return df
 
     @staticmethod
-    def calculate_zdt_price_and_st(df):
+    def calculate_zdt_price_and_st(df, by=None):
         """
         计算股票当天的涨跌停价格。在计算涨跌停价格的时候，按照严格的四舍五入。
         包含st股，但是不包含新股
@@ -39,6 +182,7 @@ class StockDataProcessor:
             北交所（bj） 30%
 
         :param df: 必须得是日线数据。必须包含的字段：前收盘价，开盘价，最高价，最低价
+        :param by: 面板数据的股票代码(Series 或数组)，None 表示 df 为单只股票的数据
         :return:
         """
         if df.empty:
@@ -68,10 +212,8 @@ class StockDataProcessor:
         df.loc[cond_bj, '跌停价'] = df['前收盘价'] * 0.7
 
         # 四舍五入
-        df['涨停价'] = df['涨停价'].apply(
-            lambda x: float(Decimal(x * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP) / 100))
-        df['跌停价'] = df['跌停价'].apply(
-            lambda x: float(Decimal(x * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP) / 100))
+        df['涨停价'] = round_half_up(df['涨停价'].to_numpy())
+        df['跌停价'] = round_half_up(df['跌停价'].to_numpy())
 
         # 判断是否一字涨停
         df['一字涨停'] = False
@@ -87,10 +229,10 @@ class StockDataProcessor:
         df.loc[df['开盘价'] <= df['跌停价'], '开盘跌停'] = True
 
         # =计算下个交易的相关情况
-        df['下日_一字涨停'] = df['一字涨停'].shift(-1)
-        df['下日_开盘涨停'] = df['开盘涨停'].shift(-1)
-        df['下日_是否ST'] = df['股票名称'].str.contains('ST').shift(-1)
-        df['下日_是否退市'] = df['股票名称'].str.contains('退').shift(-1)
+        df['下日_一字涨停'] = group_shift(df['一字涨停'], -1, by)
+        df['下日_开盘涨停'] = group_shift(df['开盘涨停'], -1, by)
+        df['下日_是否ST'] = group_shift(df['股票名称'].str.contains('ST'), -1, by)
+        df['下日_是否退市'] = group_shift(df['股票名称'].str.contains('退'), -1, by)
 
         return df
 
@@ -99,44 +241,127 @@ class StockDataProcessor:
         """
         原始股票数据在不交易的时候没有数据。
         将原始股票数据和指数数据合并，可以补全原始股票数据没有交易的日期。
-        :param df: 股票数据
+
+        按指数的交易日历一次对齐，补全规则都换算成每一行取值的行号，每列只取值一次，
+        不再对整张表逐步 fillna。结果与 right merge 之后逐步 fillna(见 back_test/股票数据处理基准.py)相同。
+        :param df: 股票数据，交易日期不能重复
         :param index_data: 指数数据
         :return:
         """
+        if not index_data["交易日期"].is_monotonic_increasing:
+            index_data = index_data.sort_values("交易日期", kind="stable")
+        dates = index_data["交易日期"].to_numpy()
+        # 每个交易日在股票数据中的行号，不交易为 -1。不在指数交易日中的行被丢弃，与 how="right" 的合并相同
+        rows = pd.Index(df["交易日期"]).get_indexer(dates)
+        is_trade = rows >= 0
+
+        def source_rows(positions):
+            # 对齐后的行号 -> 股票数据中的行号
+            return np.where(positions >= 0, rows[positions], -1)
+
+        def valid_rows(values):
+            valid = is_trade.copy()
+            valid[is_trade] = pd.notna(values)[rows[is_trade]]
+            return valid
+
+        columns = {}
+        # ===对开、高、收、低、前收盘价价格进行补全处理
+        # 用前一天的收盘价补全收盘价，开头停牌的日期再用之后第一个收盘价补全
+        close = df["收盘价"].to_numpy()
+        previous, following = fill_positions(valid_rows(close))
+        close_ffill = take(close, source_rows(previous))
+        columns["收盘价"] = take(close, source_rows(np.where(previous >= 0, previous, following)))
+        # 用收盘价补全开盘价、最高价、最低价，用前一天的收盘价补全前收盘价，剩余的空值(开头停牌的日期)先向后再向前取值
+        close_shift = np.concatenate([[np.nan], close_ffill[:-1]])
+        for column, fill_values in (
+            ("开盘价", close_ffill),
+            ("最高价", close_ffill),
+            ("最低价", close_ffill),
+            ("前收盘价", close_shift),
+        ):
+            values = take(df[column].to_numpy(), rows)
+            values = np.where(pd.isna(values), fill_values, values)
+            previous, following = fill_positions(pd.notna(values))
+            columns[column] = take(values, np.where(following >= 0, following, previous))
+
+        # ===将停盘时间的某些列，数据填补为0
+        for column in ["成交量", "成交额"]:
+            values = take(df[column].to_numpy(), rows)
+            values[pd.isna(values)] = 0
+            columns[column] = values
+
+        # ===其余空值先用之后的数据补全，之后没有数据时用之前的数据补全
+        for column in df.columns.drop(["交易日期", *columns]):
+            values = df[column].array
+            previous, following = fill_positions(valid_rows(values))
+            columns[column] = take(values, source_rows(np.where(following >= 0, following, previous)))
+        for column in index_data.columns.drop("交易日期"):
+            values = index_data[column].array
+            previous, following = fill_positions(pd.notna(values))
+            columns[column] = take(values, np.where(following >= 0, following, previous))
+
+        # 列的顺序与合并的结果相同：股票数据的列在前，指数数据的列在后
+        order = [*df.columns, *index_data.columns.drop("交易日期")]
+        columns["交易日期"] = dates
+        merged = pd.DataFrame({column: columns[column] for column in order}, copy=False)
+        # 与 DataFrame.fillna 一样，补全后的 object 列(如 下日_开盘涨停)恢复为 bool 等类型
+        merged = merged.infer_objects()
+
+        # ===判断计算当天是否交易
+        merged["是否交易"] = is_trade
+        merged["下日_是否交易"] = merged["是否交易"].shift(-1)
 
-        # ===将股票数据和上证指数合并，结果已经排序
-        df = pd.merge(
-            left=df, right=index_data, on="交易日期", how="right", sort=True, indicator=True
+        return merged
+
+    @staticmethod
+    def merge_with_index_panel(df, index_data, code_column="股票代码"):
+        """
+        merge_with_index_data 的面板版本：一次 reindex 把所有股票对齐到指数的交易日历上，
+        补全规则与逐只股票合并相同，所有的填充都只在同一只股票内部进行。
+        :param df: 多只股票的数据，同一只股票的行连续且按交易日期排序
+        :param index_data: 指数数据
+        :param code_column: 股票代码列
+        :return: 按 (股票代码, 交易日期) 排列的数据，股票顺序与 df 中出现的顺序相同
+        """
+        dates = index_data["交易日期"]
+        codes = pd.unique(df[code_column])
+        grid = pd.MultiIndex.from_arrays(
+            [np.repeat(codes, len(dates)), np.tile(dates.to_numpy(), len(codes))],
+            names=[code_column, "交易日期"],
         )
+        stock_index = pd.MultiIndex.from_frame(df[[code_column, "交易日期"]])
+        # 不在指数交易日中的行被丢弃，与 how="right" 的合并相同
+        merged = df.set_axis(stock_index).reindex(grid)
+        is_trade = grid.isin(stock_index)
+        merged.reset_index(drop=True, inplace=True)
+        merged[code_column] = grid.get_level_values(0)
+        merged["交易日期"] = grid.get_level_values(1)
+        for column in index_data.columns.drop("交易日期"):
+            merged[column] = np.tile(index_data[column].to_numpy(), len(codes))
+        by = merged[code_column].to_numpy()
 
         # ===对开、高、收、低、前收盘价价格进行补全处理
-        # 用前一天的收盘价，补全收盘价的空值
-        df["收盘价"].fillna(method="ffill", inplace=True)
-        # 用收盘价补全开盘价、最高价、最低价的空值
-        df["开盘价"].fillna(value=df["收盘价"], inplace=True)
-        df["最高价"].fillna(value=df["收盘价"], inplace=True)
-        df["最低价"].fillna(value=df["收盘价"], inplace=True)
-        # 补全前收盘价
-        df["前收盘价"].fillna(value=df["收盘价"].shift(), inplace=True)
+        merged["收盘价"] = merged["收盘价"].groupby(by, sort=False).ffill()
+        # 赋值而不是对列 inplace fillna：copy-on-write 下链式 inplace 修改不会写回 merged
+        for column in ["开盘价", "最高价", "最低价"]:
+            merged[column] = merged[column].fillna(merged["收盘价"])
+        merged["前收盘价"] = merged["前收盘价"].fillna(group_shift(merged["收盘价"], 1, by))
 
         # ===将停盘时间的某些列，数据填补为0
         fill_0_list = ["成交量", "成交额"]
-        df.loc[:, fill_0_list] = df[fill_0_list].fillna(value=0)
+        merged.loc[:, fill_0_list] = merged[fill_0_list].fillna(value=0)
 
-        # ===用前一天的数据，补全其余空值
-        df.fillna(method="bfill", inplace=True)
-        df.fillna(method="ffill", inplace=True)
+        # ===用同一只股票前后的数据，补全其余空值
+        merged = merged.groupby(by, sort=False).bfill()
+        merged = merged.groupby(by, sort=False).ffill()
+        # 与 DataFrame.fillna 一样，补全后的 object 列(如 下日_开盘涨停)恢复为 bool 等类型
+        merged = merged.infer_objects()
 
         # ===判断计算当天是否交易
-        df["是否交易"] = True
-        df.loc[df["_merge"] == "right_only", "是否交易"] = False
-        del df["_merge"]
+        merged["是否交易"] = is_trade
+        merged["下日_是否交易"] = group_shift(merged["是否交易"], -1, by)
 
-        df['下日_是否交易'] = df['是否交易'].shift(-1)
-
-        df.reset_index(drop=True, inplace=True)
-
-        return df
+        return merged
 
     @staticmethod
     def winsorize_series(series, n=3):
@@ -196,6 +421,53 @@ class StockDataProcessor:
         # 返回标准化后的序列
         return (series - mean) / std
 
+    @staticmethod
+    def winsorize_by_date(series, dates, n=3):
+        """
+        winsorize_series 的截面版本：每个交易日分别用当天的均值和标准差截断极端值，不同日期的数据互不影响。
+        结果与按日期分组后逐组调用 winsorize_series 相同，当天只有一个有效值时不截断。
+
+        :param series: 面板数据的因子值
+        :param dates: 与 series 对齐的交易日期
+        :param n: 标准差倍数
+        :return: 与 series 索引相同的 Series
+        """
+        matrix, rows, columns = cross_section_matrix(series, dates)
+        mean, std = row_mean_std(matrix)
+        values = clip_values(matrix[rows, columns], (mean - n * std)[rows], (mean + n * std)[rows])
+        return pd.Series(values, index=series.index, name=series.name)
+
+    @staticmethod
+    def filter_extreme_by_mad_by_date(series, dates, n=3):
+        """
+        filter_extreme_by_mad 的截面版本：每个交易日分别用当天的中位数和绝对偏差中位数(MAD)截断极端值。
+
+        :param series: 面板数据的因子值
+        :param dates: 与 series 对齐的交易日期
+        :param n: MAD 倍数
+        :return: 与 series 索引相同的 Series
+        """
+        matrix, rows, columns = cross_section_matrix(series, dates)
+        median = row_median(matrix)
+        mad = row_median(np.abs(matrix - median[:, None]))
+        values = clip_values(matrix[rows, columns], (median - n * mad)[rows], (median + n * mad)[rows])
+        return pd.Series(values, index=series.index, name=series.name)
+
+    @staticmethod
+    def standardize_by_date(series, dates):
+        """
+        standardize_series 的截面版本：每个交易日分别减去当天的均值、除以当天的标准差。
+
+        :param series: 面板数据的因子值
+        :param dates: 与 series 对齐的交易日期
+        :return: 与 series 索引相同的 Series
+        """
+        matrix, rows, columns = cross_section_matrix(series, dates)
+        mean, std = row_mean_std(matrix)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values = (matrix[rows, columns] - mean[rows]) / std[rows]
+        return pd.Series(values, index=series.index, name=series.name)
+
     @staticmethod
     def neutralize(factor_data, dummy_variable):
         model = sm.OLS(factor_data, dummy_variable).fit()  # 将Pandas Series或DataFrame转换为NumPy数组
@@ -203,21 +475,106 @@ class StockDataProcessor:
         neutralized_factor = factor_data - model.predict(dummy_variable)
         return neutralized_factor
 
+    @staticmethod
+    def neutralize_by_date(factor, dates, industry, exposures=None):
+        """
+        neutralize 的截面版本：每个交易日分别把因子对行业哑变量(以及 exposures 中的连续变量，如对数市值)做回归，返回残差。
+
+        只对行业回归时，残差就是因子减去当天同行业的均值，直接按 (交易日期, 行业) 分组去均值，不生成哑变量矩阵。
+        有连续变量时，先把因子和连续变量按 (交易日期, 行业) 去均值，再对每个交易日求解 k x k 的正规方程
+        (Frisch-Waugh，所有交易日批量求解)，内存与行数成正比。
+        因子、行业或连续变量为空值的行不参与回归，结果为空值。
+
+        :param factor: 面板数据的因子值
+        :param dates: 与 factor 对齐的交易日期
+        :param industry: 与 factor 对齐的行业
+        :param exposures: 可选，与 factor 对齐的连续变量(Series 或 DataFrame)
+        :return: 与 factor 索引相同的 Series
+        """
+        values = np.asarray(factor, dtype=np.float64)
+        date_codes, _ = pd.factorize(np.asarray(dates))
+        industry_codes, industries = pd.factorize(np.asarray(industry))  # 空值为 -1
+        valid = ~np.isnan(values) & (industry_codes >= 0)
+        if exposures is not None:
+            exposures = np.asarray(exposures, dtype=np.float64).reshape(len(values), -1)
+            valid &= ~np.isnan(exposures).any(axis=1)
+
+        days = date_codes[valid]
+        residual = group_demean(values[valid], days * len(industries) + industry_codes[valid])
+        if exposures is not None:
+            x = group_demean(exposures[valid], days * len(industries) + industry_codes[valid])
+            n_days, k = len(np.bincount(days)), x.shape[1]
+            xtx = np.empty((n_days, k, k))
+            xty = np.empty((n_days, k))
+            for i in range(k):
+                xty[:, i] = np.bincount(days, weights=x[:, i] * residual, minlength=n_days)
+                for j in range(i, k):
+                    xtx[:, i, j] = xtx[:, j, i] = np.bincount(days, weights=x[:, i] * x[:, j], minlength=n_days)
+            # 伪逆：某天的连续变量共线或样本不足时取最小范数解，残差与 OLS 相同
+            beta = np.matmul(np.linalg.pinv(xtx), xty[:, :, None])[:, :, 0]
+            residual = residual - (x * beta[days]).sum(axis=1)
+
+        result = np.full(len(values), np.nan)
+        result[valid] = residual
+        return pd.Series(result, index=factor.index, name=factor.name)
+
 
 class SingleStockDataProcessor(StockDataProcessor):
-    def __init__(self, stock_code, file_path, start_date=None, end_date=None):
+    # 读取时需要的原始列(交易日期总是读取)，None 表示全部列。CSV 只解析这些列，列式存储只读取这些列
+    read_columns = None
+    # 原始列的目标类型，未列出的列使用默认推断的类型(数值为 float64，文本为 object)。
+    # 价格列参与涨跌停价的四舍五入和复权计算，需要保持 float64；
+    # 只用于补全或分析的数值列可以用 float32，重复的文本(股票名称、行业)用 category
+    read_dtypes = None
+
+    def __init__(self, stock_code, file_path, start_date=None, end_date=None, store=None):
+        """
+        :param store: 可选的 StockStore，股票已转换为列式存储时直接从中读取，否则读取 file_path 指定的 CSV
+        """
         self.stock_code = stock_code
         self.file_path = file_path
         self.start_date = start_date
         self.end_date = end_date
+        self.store = store
+
+    @classmethod
+    def csv_read_options(cls):
+        """
+        按 read_columns 和 read_dtypes 生成 pd.read_csv 的 usecols 和 dtype 参数。
+        """
+        usecols = None
+        if cls.read_columns is not None:
+            usecols = ["交易日期"] + [c for c in cls.read_columns if c != "交易日期"]
+        return dict(usecols=usecols, dtype=cls.read_dtypes)
+
+    @classmethod
+    def apply_read_dtypes(cls, df):
+        """
+        把已读取的原始数据(如列式存储中统一为 float64 的数据、拼接后变为 object 的 category 列)转换为 read_dtypes 中的类型。
+        """
+        if not cls.read_dtypes:
+            return df
+        dtypes = {c: t for c, t in cls.read_dtypes.items() if c in df.columns and df[c].dtype != t}
+        return df.astype(dtypes) if dtypes else df
 
     def read_data(self):
+        if self.store is not None and self.store.contains(self.stock_code):
+            # 按列和日期范围读取，不再解析 GBK CSV
+            return self.apply_read_dtypes(
+                self.store.read(
+                    self.stock_code,
+                    columns=self.read_columns,
+                    start_date=self.start_date,
+                    end_date=self.end_date,
+                )
+            )
         try:
             df = pd.read_csv(
                 self.file_path % self.stock_code,
                 encoding="gbk",
                 skiprows=1,
                 parse_dates=["交易日期"],
+                **self.csv_read_options(),
             )
             df.sort_values(by=["交易日期"], inplace=True)
             df.drop_duplicates(subset=["交易日期"], inplace=True)
@@ -277,6 +634,20 @@ class SingleStockDataProcessor(StockDataProcessor):
         # )
         return df
 
+    @classmethod
+    def process_panel_data(cls, df, index_data=None, code_column="股票代码"):
+        """
+        process_stock_data 的面板版本：对多只股票的长表一次性完成相同的处理(不包括 format_data)。
+        :param df: 多只股票的数据，同一只股票的行连续且按交易日期排序
+        """
+        if df.empty:
+            return df
+        df = cls.calculate_zdt_price_and_st(df, by=df[code_column])
+        df = cls.calculate_adjusted_prices(df, by=df[code_column])
+        if index_data is not None:
+            df = cls.merge_with_index_panel(df, index_data, code_column)
+        return df
+
     # @staticmethod
     # def save_data(df, file_name):
     #     df.to_hdf(file_name, key="df", mode="w")
@@ -310,3 +681,81 @@ class SingleStockDataProcessor(StockDataProcessor):
                 "limit_down",
             ]
         ]
+
+
+class PanelStockDataProcessor:
+    """
+    全市场面板模式的数据处理：把所有股票读成一张 (股票代码, 交易日期) 长表，
+    涨跌停价、复权价格、指数日历对齐都在整张表上向量化完成，
+    不再为每只股票创建一个处理器逐只计算。结果与逐只股票的 process_stock_data 相同。
+
+    - processor_class: 单只股票的处理器类，决定读取的列和类型(read_columns、read_dtypes)、处理步骤(process_panel_data)和 format_data
+    """
+
+    code_column = "股票代码"
+
+    def __init__(
+        self,
+        stock_codes,
+        file_path,
+        start_date=None,
+        end_date=None,
+        store=None,
+        processor_class=SingleStockDataProcessor,
+    ):
+        self.stock_codes = list(stock_codes)
+        self.file_path = file_path
+        self.start_date = start_date
+        self.end_date = end_date
+        self.store = store
+        self.processor_class = processor_class
+
+    def read_data(self):
+        """
+        读取所有股票，返回按 stock_codes 顺序排列、每只股票内部按交易日期排序的长表。
+        """
+        if self.store is not None and all(self.store.contains(code) for code in self.stock_codes):
+            df = self.store.read_market(
+                self.stock_codes,
+                columns=self.processor_class.read_columns,
+                start_date=self.start_date,
+                end_date=self.end_date,
+            )
+        else:
+            frames = [
+                self.processor_class(
+                    code, self.file_path, self.start_date, self.end_date, store=self.store
+                ).read_data()
+                for code in self.stock_codes
+            ]
+            frames = [frame for frame in frames if not frame.empty]
+            if not frames:
+                return pd.DataFrame()
+            df = pd.concat(frames, ignore_index=True)
+        if df.empty:
+            return df
+        # 各股票的 category 列类别不同，拼接后变为 object，统一转换一次
+        df = self.processor_class.apply_read_dtypes(df)
+        # 数据集的读取顺序不保证与文件顺序一致，按 stock_codes 的顺序稳定排序
+        order = pd.Index(self.stock_codes).get_indexer(df[self.code_column])
+        return df.take(np.argsort(order, kind="stable")).reset_index(drop=True)
+
+    def process_market_data(self, index_data=None):
+        """
+        :return: 处理后、未 format 的长表
+        """
+        return self.processor_class.process_panel_data(self.read_data(), index_data, self.code_column)
+
+    def process_stocks(self, index_data=None):
+        """
+        :return: {股票代码: format_data 后的 DataFrame}，与逐只股票的 process_stock_data 结果相同，
+            没有数据的股票不包含在内
+        """
+        df = self.process_market_data(index_data)
+        if df.empty:
+            return {}
+        codes = df[self.code_column].to_numpy()
+        formatted = self.processor_class.format_data(df)
+        # 同一只股票的行是连续的，按边界切片
+        bounds = np.concatenate(([0], np.flatnonzero(codes[1:] != codes[:-1]) + 1, [len(codes)]))
+        return {codes[start]: formatted.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])}
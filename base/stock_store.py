@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+import glob
+import os
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from base.log import performance_log
+
+
+class StockStore:
+    """
+    股票日线数据的列式存储(Parquet)。
+
+    原始数据是每只股票一个 GBK 编码的 CSV(第一行为说明，需要跳过)，每次回测都要完整解析一遍。
+    这里一次性把每只股票转换为一个 Parquet 文件：<store_dir>/<股票代码>.parquet，
+    转换时完成排序和按交易日期去重，读取时不再需要 GBK 解码和排序。
+
+    - 按列存储，只读取需要的列(columns)
+    - 文件按交易日期分成多个 row group，读取时按日期范围过滤(start_date/end_date)，
+      只解码与日期范围有交集的 row group
+    - read_market 把整个目录当作一个数据集读取全市场数据
+    """
+
+    date_column = "交易日期"
+    row_group_size = 500  # 约两年的交易日
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+    def path(self, stock_code):
+        return os.path.join(self.store_dir, "%s.parquet" % stock_code)
+
+    def codes(self):
+        return sorted(
+            os.path.splitext(os.path.basename(f))[0]
+            for f in glob.glob(os.path.join(self.store_dir, "*.parquet"))
+        )
+
+    def contains(self, stock_code):
+        return os.path.exists(self.path(stock_code))
+
+    @classmethod
+    def read_csv(cls, csv_path):
+        """
+        按原始格式解析 CSV：GBK 编码，跳过第一行，按交易日期排序并去重。
+        """
+        df = pd.read_csv(csv_path, encoding="gbk", skiprows=1, parse_dates=[cls.date_column])
+        df.sort_values(by=[cls.date_column], inplace=True)
+        df.drop_duplicates(subset=[cls.date_column], inplace=True)
+        df.reset_index(drop=True, inplace=True)
+        return df
+
+    @staticmethod
+    def normalize_types(df):
+        """
+        统一列类型，保证所有股票的文件 schema 一致，可以作为一个数据集读取：
+        数值列统一为 float64(整数列在有缺失值时会被推断为浮点)，category 列还原为原来的类型(类别各不相同)。
+        """
+        for column in df.columns:
+            dtype = df[column].dtype
+            if isinstance(dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype(dtype.categories.dtype)
+            elif pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+                df[column] = df[column].astype(np.float64)
+        return df
+
+    def write(self, stock_code, df):
+        """
+        写入一只股票的数据(已排序去重)，先写临时文件再重命名。
+        """
+        table = pa.Table.from_pandas(self.normalize_types(df), preserve_index=False)
+        # 全为空值的 object 列会被推断为 null 类型，统一为字符串，保证所有文件的 schema 一致
+        table = table.cast(pa.schema(
+            [field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in table.schema],
+            metadata=table.schema.metadata,
+        ))
+        tmp_path = self.path(stock_code) + ".tmp"
+        pq.write_table(table, tmp_path, row_group_size=self.row_group_size)
+        os.replace(tmp_path, self.path(stock_code))
+
+    def convert_csv(self, csv_path, stock_code=None, force=False):
+        """
+        把一个原始 CSV 转换为 Parquet。目标文件比 CSV 新时跳过，除非 force 为 True。
+
+        :return: 股票代码
+        """
+        if stock_code is None:
+            stock_code = os.path.splitext(os.path.basename(csv_path))[0]
+        target = self.path(stock_code)
+        if not force and os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(csv_path):
+            return stock_code
+        self.write(stock_code, self.read_csv(csv_path))
+        return stock_code
+
+    def convert_folder(self, csv_folder, force=False, use_multiprocessing=True):
+        """
+        转换目录下所有 CSV，返回转换的股票代码列表。
+
+        :param csv_folder: 原始 CSV 所在目录
+        :param force: 是否重新转换已是最新的文件
+        :param use_multiprocessing: 是否使用多进程
+        """
+        csv_files = sorted(glob.glob(os.path.join(csv_folder, "*.csv")))
+        args = [(self.store_dir, f, force) for f in csv_files]
+        if use_multiprocessing:
+            with Pool(max(cpu_count() - 1, 1)) as pool:
+                codes = pool.map(_convert_csv, args)
+        else:
+            codes = [_convert_csv(arg) for arg in args]
+        performance_log.info(f"Converted {len(codes)} csv files to {self.store_dir}")
+        return codes
+
+    def _date_filter(self, start_date=None, end_date=None):
+        field = ds.field(self.date_column)
+        expression = None
+        if start_date is not None:
+            expression = field >= pd.Timestamp(start_date)
+        if end_date is not None:
+            cond = field <= pd.Timestamp(end_date)
+            expression = cond if expression is None else expression & cond
+        return expression
+
+    def _columns(self, columns):
+        # 交易日期总是读取，其他列按需读取
+        if columns is None:
+            return None
+        return [self.date_column] + [c for c in columns if c != self.date_column]
+
+    def read(self, stock_code, columns=None, start_date=None, end_date=None):
+        """
+        读取一只股票在日期范围内的数据。
+
+        :param stock_code: 股票代码
+        :param columns: 需要的列，None 表示全部列
+        :param start_date: 开始日期(包含)，None 表示不限制
+        :param end_date: 结束日期(包含)，None 表示不限制
+        """
+        dataset = ds.dataset(self.path(stock_code), format="parquet")
+        table = dataset.to_table(
+            columns=self._columns(columns),
+            filter=self._date_filter(start_date, end_date),
+        )
+        return table.to_pandas()
+
+    def read_market(self, codes=None, columns=None, start_date=None, end_date=None):
+        """
+        把多只股票读成一个 DataFrame(按股票依次拼接，每只股票内部按交易日期排序)。
+
+        :param codes: 股票代码列表，None 表示目录中的所有股票
+        """
+        codes = self.codes() if codes is None else codes
+        dataset = ds.dataset([self.path(code) for code in codes], format="parquet")
+        table = dataset.to_table(
+            columns=self._columns(columns),
+            filter=self._date_filter(start_date, end_date),
+        )
+        return table.to_pandas()
+
+
+def _convert_csv(args):
+    store_dir, csv_path, force = args
+    return StockStore(store_dir).convert_csv(csv_path, force=force)
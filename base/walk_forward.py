@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import itertools
+
+import backtrader as bt
+import numpy as np
+import pandas as pd
+from backtrader.utils import num2date
+
+from base.log import performance_log
+from base.shared_datas import SharedDatas, init_worker, worker_cerebro
+
+
+class EquityCurve(bt.Analyzer):
+    """
+    记录每个 bar 收盘后的账户净值。运行区间(window)之前分析器暂停，因此只包含区间内的 bar。
+    """
+
+    def start(self):
+        self.dates = []
+        self.values = []
+
+    def next(self):
+        self.dates.append(self.strategy.datetime[0])
+        self.values.append(self.strategy.broker.getvalue())
+
+    def get_analysis(self):
+        return pd.Series(self.values, index=[num2date(d) for d in self.dates], dtype=np.float64)
+
+
+def total_return(values, cash):
+    """
+    默认的样本内评分：区间总收益率。
+
+    :param values: 区间内每个 bar 的净值
+    :param cash: 区间开始时的资金
+    """
+    if not len(values):
+        return np.nan
+    return values.iloc[-1] / cash - 1
+
+
+def window_returns(values, cash):
+    """
+    区间内每个 bar 的收益率，第一个 bar 相对于初始资金计算。
+    """
+    prev = np.concatenate(([cash], values.to_numpy()[:-1]))
+    return pd.Series(values.to_numpy() / prev - 1, index=values.index)
+
+
+def _run_task(cerebro, task):
+    """
+    在 cerebro 已预加载的数据上，只在 window 区间内运行一组策略参数，返回区间内的净值曲线。
+    """
+    key, stratcls, kwargs, window = task
+    for data in cerebro.datas:
+        data.home()
+    cerebro._event_stop = False
+    cerebro.p.window = window
+    strat = cerebro.runstrategies([(stratcls, (), kwargs)], predata=True)[0]
+    return key, strat.analyzers.getbyname(WalkForward.analyzer_name).get_analysis()
+
+
+def _run_worker_task(task):
+    return _run_task(worker_cerebro(), task)
+
+
+class WalkForward:
+    """
+    滚动(walk-forward)优化：在第 N 个训练窗口上优化参数，用最优参数在紧随其后的测试窗口上做样本外回测，
+    再把所有测试窗口的收益拼接成一条样本外净值曲线。
+
+    数据只预加载一次，通过内存映射文件在进程池中共享；所有窗口的优化任务和样本外任务都在同一个进程池中运行。
+    每个任务都从数据起点开始推进时钟(指标可以使用窗口之前的历史数据预热)，只在窗口内执行策略逻辑。
+
+    - cerebro: 已添加数据、broker 设置和分析器的 FastCerebro(不需要 addstrategy)
+    - strategy: 策略类
+    - params: {参数名: 候选值}，按笛卡尔积组合，同 optstrategy
+    - train / test: 训练窗口和测试窗口的长度(以第一个 feed 的 bar 数计)，窗口每次向后滚动 test 个 bar
+    - anchored: True 时训练窗口总是从第一个 bar 开始(扩张窗口)
+    - score: callable(values, cash) -> float，训练窗口的评分，越大越好，默认为区间总收益率
+    - maxcpus: 进程数，None 表示使用所有 CPU，1 表示不使用进程池
+    """
+
+    analyzer_name = "walk_forward_equity"
+
+    def __init__(self, cerebro, strategy, params, train, test, anchored=False, score=None, maxcpus=None):
+        self.cerebro = cerebro
+        self.strategy = strategy
+        self.params = params
+        self.train = train
+        self.test = test
+        self.anchored = anchored
+        self.score = score or total_return
+        self.maxcpus = maxcpus
+
+    def param_grid(self):
+        keys = list(self.params)
+        values = [v if isinstance(v, (list, tuple, range)) else [v] for v in self.params.values()]
+        return [dict(zip(keys, combo)) for combo in itertools.product(*values)]
+
+    def windows(self, dates):
+        """
+        按 bar 序号切分窗口，返回 [(训练开始, 训练结束, 测试开始, 测试结束)]，均为 backtrader 数值时间。
+        """
+        result = []
+        start = 0
+        while start + self.train < len(dates):
+            train_start = 0 if self.anchored else start
+            train_end = start + self.train - 1
+            test_end = min(train_end + self.test, len(dates) - 1)
+            result.append((dates[train_start], dates[train_end], dates[train_end + 1], dates[test_end]))
+            start += self.test
+        return result
+
+    def run(self):
+        """
+        :return: WalkForwardResult
+        """
+        cerebro = self.cerebro
+        cerebro._event_stop = False
+        cerebro._prepare_run()
+        if not cerebro._dopreload:
+            raise ValueError("walk-forward requires preloaded datas")
+        cerebro.addanalyzer(EquityCurve, _name=self.analyzer_name)
+        cerebro.dopreloaddata()
+
+        dates = cerebro._datetime_array(cerebro.datas[0])
+        windows = self.windows(dates)
+        grid = self.param_grid()
+        cash = cerebro.broker.startingcash
+        performance_log.info("walk-forward: %d windows x %d params" % (len(windows), len(grid)))
+
+        train_tasks = [
+            ((w, i), self.strategy, kwargs, (train_start, train_end))
+            for w, (train_start, train_end, _, _) in enumerate(windows)
+            for i, kwargs in enumerate(grid)
+        ]
+
+        try:
+            if self.maxcpus == 1:
+                train_results = [_run_task(cerebro, task) for task in train_tasks]
+                best = self._select(windows, grid, train_results, cash)
+                test_results = [_run_task(cerebro, task) for task in self._test_tasks(windows, grid, best)]
+            else:
+                best, test_results = self._run_pool(windows, grid, train_tasks, cash)
+        finally:
+            cerebro.p.window = None
+            cerebro.analyzers.pop()  # 移除本次添加的 EquityCurve
+
+        return self._stitch(windows, grid, best, dict(test_results), cash)
+
+    def _run_pool(self, windows, grid, train_tasks, cash):
+        cerebro = self.cerebro
+        shared = SharedDatas(cerebro.datas, cerebro._preload_entry)
+        shared.strip()
+        try:
+            pool = bt.multiprocessing.Pool(
+                self.maxcpus or None,
+                initializer=init_worker,
+                initargs=(cerebro, shared.entry_path),
+            )
+            nworkers = self.maxcpus or bt.multiprocessing.cpu_count()
+            chunksize = max(1, len(train_tasks) // (nworkers * 4))
+            # 所有窗口的优化任务一起分发，完成顺序不影响结果
+            train_results = list(pool.imap_unordered(_run_worker_task, train_tasks, chunksize))
+            best = self._select(windows, grid, train_results, cash)
+            test_results = pool.map(_run_worker_task, self._test_tasks(windows, grid, best), 1)
+            pool.close()
+            pool.join()
+        finally:
+            shared.restore()
+            shared.close()
+        return best, test_results
+
+    def _select(self, windows, grid, train_results, cash):
+        """
+        每个训练窗口选出得分最高的参数组合，得分相同时取先出现的组合。
+        返回 {窗口序号: (参数序号, 得分)}。
+        """
+        scores = np.full((len(windows), len(grid)), -np.inf)
+        for (w, i), values in train_results:
+            score = self.score(values, cash)
+            scores[w, i] = -np.inf if np.isnan(score) else score
+        return {w: (int(np.argmax(scores[w])), scores[w].max()) for w in range(len(windows))}
+
+    def _test_tasks(self, windows, grid, best):
+        return [
+            (w, self.strategy, grid[best[w][0]], (test_start, test_end))
+            for w, (_, _, test_start, test_end) in enumerate(windows)
+        ]
+
+    def _stitch(self, windows, grid, best, test_results, cash):
+        rows = []
+        returns = []
+        for w, (train_start, train_end, test_start, test_end) in enumerate(windows):
+            values = test_results[w]
+            rets = window_returns(values, cash)
+            returns.append(rets)
+            rows.append(
+                dict(
+                    train_start=num2date(train_start),
+                    train_end=num2date(train_end),
+                    test_start=num2date(test_start),
+                    test_end=num2date(test_end),
+                    train_score=best[w][1],
+                    test_return=(1 + rets).prod() - 1,
+                    **grid[best[w][0]],
+                )
+            )
+        returns = pd.concat(returns) if returns else pd.Series(dtype=np.float64)
+        return WalkForwardResult(pd.DataFrame(rows), returns, cash * (1 + returns).cumprod())
+
+
+class WalkForwardResult:
+    """
+    - windows: 每个窗口一行，包含训练/测试区间、最优参数、训练得分和样本外收益率
+    - returns: 拼接后的样本外逐 bar 收益率
+    - equity: 以初始资金计的样本外净值曲线
+    """
+
+    def __init__(self, windows, returns, equity):
+        self.windows = windows
+        self.returns = returns
+        self.equity = equity
@@ -1,17 +1,27 @@
 # -*- coding: utf-8 -*-
-from base.stock_processor import SingleStockDataProcessor
+from base.stock_processor import PanelStockDataProcessor, SingleStockDataProcessor
 import pandas as pd
 import numpy as np
 import os
 import glob
+from functools import partial
 from base.log import performance_log
 from multiprocessing import Pool, cpu_count
 from base.config import PathConfig
-import alphalens
+from base.factor_analysis import FactorAnalyzer, summary_table
+from base.stock_cache import StockCache, file_fingerprint
+from base.stock_store import StockStore
 import matplotlib.pyplot as plt  # 由于 Backtrader 的问题，此处要求 pip install matplotlib==3.2.2
 
 
 class SingleFactorStockDataProcessor(SingleStockDataProcessor):
+    # 计算复权价格以及 format_data 用到的原始列
+    read_columns = [
+        "股票代码", "开盘价", "最高价", "最低价", "收盘价", "前收盘价", "成交量", "总市值", "新版申万一级行业名称",
+    ]
+    # 成交量、总市值(因子)只用于因子分析，float32 的精度足够
+    read_dtypes = {"成交量": "float32", "总市值": "float32", "新版申万一级行业名称": "category"}
+
     @staticmethod
     def format_data(df):
         selected_columns = [
@@ -55,6 +65,43 @@ class SingleFactorStockDataProcessor(SingleStockDataProcessor):
         # )
         return df
 
+    @classmethod
+    def process_panel_data(cls, df, index_data=None, code_column="股票代码"):
+        if df.empty:
+            return df
+        return cls.calculate_adjusted_prices(df, by=df[code_column])
+
+
+def prepare_factor(factor, industry):
+    """
+    因子预处理：去极值、标准化、行业中性化，每个交易日的截面分别处理。
+
+    :param factor: 以 (date, stock_code) 为索引的因子值
+    :param industry: 与 factor 对齐的行业
+    """
+    dates = factor.index.get_level_values("date")
+    factor = SingleFactorStockDataProcessor.winsorize_by_date(factor, dates)
+    factor = SingleFactorStockDataProcessor.standardize_by_date(factor, dates)
+    return SingleFactorStockDataProcessor.neutralize_by_date(factor, dates, industry)
+
+
+def alphalens_tear_sheet(factor, prices, groups=None, quantiles=10, periods=(1, 5, 10)):
+    """
+    用 alphalens 生成完整的因子分析图表，只在需要图表时导入 alphalens。
+
+    :param factor: 以 (date, stock_code) 为索引的因子值
+    :param prices: 收盘价透视表，行为日期，列为股票代码
+    :param groups: 与 factor 对齐的行业，None 表示不分组
+    :return: alphalens 清洗后的因子数据
+    """
+    import alphalens
+
+    factor_data = alphalens.utils.get_clean_factor_and_forward_returns(
+        factor, prices, groups, quantiles=quantiles, periods=periods
+    )
+    alphalens.tears.create_full_tear_sheet(factor_data, long_short=False, group_neutral=False, by_group=False)
+    return factor_data
+
 
 class MultiStockProcessor:
     def __init__(
@@ -64,12 +111,24 @@ class MultiStockProcessor:
         end_date,
         hdf_cache_path="all_stocks_data.h5",
         use_multiprocessing=True,
+        store_dir=None,
+        use_panel=False,
+        cache_dir=None,
     ):
+        """
+        :param store_dir: 列式存储目录(StockStore)，指定时优先从中读取股票数据
+        :param use_panel: 是否把所有股票读成一张长表一次性处理(PanelStockDataProcessor)，结果与逐只处理相同
+        :param cache_dir: 按股票分区的缓存目录(StockCache)，指定时代替 hdf_cache_path：
+            只重新处理源文件有变化的股票，读取时可以只选择部分列和日期范围
+        """
         self.data_path = data_path
         self.start_date = start_date
         self.end_date = end_date
         self.hdf_cache_path = hdf_cache_path
         self.use_multiprocessing = use_multiprocessing
+        self.store = StockStore(store_dir) if store_dir else None
+        self.use_panel = use_panel
+        self.cache_dir = cache_dir
 
         # 自动检测data_path目录下的所有CSV文件，并从中提取股票代码
         self.stock_codes = [
@@ -88,6 +147,7 @@ class MultiStockProcessor:
             read_file_path,
             self.start_date,
             self.end_date,
+            store=self.store,
         )
         df = processor.process_stock_data()
         # 如果处理后的数据为空，则记录警告并返回None
@@ -97,12 +157,71 @@ class MultiStockProcessor:
 
         return stock_code, df
 
+    def _process_stocks(self, stock_codes):
+        """
+        处理给定的股票，逐只返回 (股票代码, DataFrame)，没有数据的股票 DataFrame 为 None。
+        """
+        if self.use_panel:
+            print("Using panel processing...")
+            processor = PanelStockDataProcessor(
+                stock_codes,
+                os.path.join(self.data_path, "%s.csv"),
+                self.start_date,
+                self.end_date,
+                store=self.store,
+                processor_class=SingleFactorStockDataProcessor,
+            )
+            stock_data_dict = processor.process_stocks()
+            for stock_code in stock_codes:
+                yield stock_code, stock_data_dict.get(stock_code)
+        elif self.use_multiprocessing:
+            print("Using multiprocessing...")
+            with Pool(processes=max(cpu_count() - 1, 1)) as pool:
+                for stock_code, result in zip(stock_codes, pool.imap(self._process_stock, stock_codes)):
+                    yield stock_code, None if result is None else result[1]
+        else:
+            print("Using single processing...")
+            for stock_code in stock_codes:
+                result = self._process_stock(stock_code)
+                yield stock_code, None if result is None else result[1]
+
+    def _source_fingerprint(self, stock_code):
+        """
+        股票源数据的指纹：CSV，以及使用列式存储时的 Parquet 文件。
+        """
+        paths = [os.path.join(self.data_path, "%s.csv" % stock_code)]
+        if self.store is not None:
+            paths.append(self.store.path(stock_code))
+        return file_fingerprint(paths)
+
+    def update_cache(self):
+        """
+        只重新处理缓存中没有或源文件有变化的股票，返回 StockCache。
+        """
+        cache = StockCache(
+            self.cache_dir,
+            params=(SingleFactorStockDataProcessor.__qualname__, str(self.start_date), str(self.end_date)),
+        )
+        cache.prune(self.stock_codes)
+        # 处理之前记录指纹：处理期间源文件被修改时，缓存记录的是旧指纹，下次会重新处理
+        fingerprints = {code: self._source_fingerprint(code) for code in self.stock_codes}
+        stale = cache.stale(fingerprints)
+        performance_log.info(f"Processing {len(stale)} of {len(self.stock_codes)} stocks.")
+        if stale:
+            for stock_code, df in self._process_stocks(stale):
+                cache.put(stock_code, df, fingerprints[stock_code])
+        cache.save_manifest()
+        return cache
+
     def _merge_and_save_to_hdf(self, dfs):
         """
         合并多个DataFrame为一个，并保存到HDF文件中。
         """
         merged_df = pd.concat(dfs, ignore_index=True)
-        merged_df.to_hdf(self.hdf_cache_path, "df", mode="w")
+        # 各股票的行业类别不同，拼接后变为 object，重新转换为统一的 category
+        merged_df["industry"] = merged_df["industry"].astype("category")
+        # category 列只能以 table 格式保存
+        merged_df.to_hdf(self.hdf_cache_path, "df", mode="w", format="table")
 
     def _load_merged_from_hdf(self) -> pd.DataFrame:
         """
@@ -111,73 +230,100 @@ class MultiStockProcessor:
         merged_df = pd.read_hdf(self.hdf_cache_path, "df")
         return merged_df
 
-    def load_or_process_stocks(self):
+    def load_or_process_stocks(self, columns=None, start_date=None, end_date=None):
         """
-        根据配置选择单进程或多进程处理所有股票数据，并保存/加载到HDF文件。
+        根据配置选择单进程或多进程处理所有股票数据，并保存/加载到缓存(cache_dir)或HDF文件。
+
+        :param columns: 需要的列，None 表示全部列(date 列总是读取)
+        :param start_date: 开始日期(包含)，None 表示不限制
+        :param end_date: 结束日期(包含)，None 表示不限制
         """
+        if self.cache_dir is not None:
+            merged_df = self.update_cache().read_market(self.stock_codes, columns, start_date, end_date)
+            if "industry" in merged_df:
+                merged_df["industry"] = merged_df["industry"].astype("category")
+            return merged_df
         if os.path.exists(self.hdf_cache_path):
             print("Loading merged data from HDF cache...")
-            return self._load_merged_from_hdf()
         else:
             print("Processing all stocks...")
-            if self.use_multiprocessing:
-                print("Using multiprocessing...")
-                with Pool(processes=max(cpu_count() - 1, 1)) as pool:
-                    results = pool.map(self._process_stock, self.stock_codes)
-            else:
-                print("Using single processing...")
-                results = [self._process_stock(args) for args in self.stock_codes]
-
-            # 过滤并构造字典
             stock_data_dict = {
-                result[0]: result[1] for result in results if result is not None
+                stock_code: df for stock_code, df in self._process_stocks(self.stock_codes) if df is not None
             }
             performance_log.info(f"Loaded {len(stock_data_dict)} stocks.")
             # 保存到HDF文件
             self._merge_and_save_to_hdf(stock_data_dict)
-            return self._load_merged_from_hdf()
+        merged_df = self._load_merged_from_hdf()
+        if start_date is not None:
+            merged_df = merged_df[merged_df["date"] >= pd.Timestamp(start_date)]
+        if end_date is not None:
+            merged_df = merged_df[merged_df["date"] <= pd.Timestamp(end_date)]
+        if columns is not None:
+            merged_df = merged_df[["date"] + [c for c in columns if c != "date"]]
+        return merged_df
+
+    def evaluate_factors(self, factor_columns, merged_df=None, periods=(1, 5, 10), quantiles=10, processes=None):
+        """
+        批量分析多个因子列：价格透视表和远期收益只计算一次，各因子的预处理(prepare_factor)和分析在多个进程中并行。
+
+        :param factor_columns: 因子列名列表
+        :param merged_df: 可选，load_or_process_stocks 的结果(可以先加入自定义的因子列)，None 时从缓存读取需要的列
+        :param periods: 远期收益的周期
+        :param quantiles: 分组数
+        :param processes: 进程数，None 表示 CPU 个数减一
+        :return: (以 (因子名, 周期) 为索引的汇总表, {因子名: FactorReport})
+        """
+        if merged_df is None:
+            merged_df = self.load_or_process_stocks(columns=["stock_code", "close", "industry", *factor_columns])
+        panel = merged_df.set_index(["date", "stock_code"])
+        analyzer = FactorAnalyzer(panel["close"].unstack(), periods=periods)
+        reports = analyzer.analyze_many(
+            {column: panel[column] for column in factor_columns},
+            groups=panel["industry"],
+            quantiles=quantiles,
+            prepare=partial(prepare_factor, industry=panel["industry"]),
+            processes=max(cpu_count() - 1, 1) if processes is None else processes,
+        )
+        return summary_table(reports), reports
 
 
 if __name__ == "__main__":
     output_base = os.path.splitext(os.path.basename(__file__))[
         0
     ]  # 获取当前文件名，去掉路径和扩展名
-    output_file = os.path.join(
-        PathConfig.data_folder, f"{output_base}.h5"
-    )  # 拼接路径和新文件名
+    cache_dir = os.path.join(
+        PathConfig.data_folder, f"{output_base}_cache"
+    )  # 拼接路径和新目录名
     processor = MultiStockProcessor(
         data_path=PathConfig.stock_daily_folder,
         start_date="2008-01-01",
         end_date="2024-01-01",
-        hdf_cache_path=output_file,
         use_multiprocessing=True,
+        cache_dir=cache_dir,
     )
-    merged_df = processor.load_or_process_stocks()
+    # 只读取因子分析用到的列
+    merged_df = processor.load_or_process_stocks(columns=["stock_code", "close", "factor", "industry"])
     performance_log.info(merged_df.head(5))
     # 数据不是正态分布做对数处理
     merged_df["factor"] = np.log(merged_df["factor"])
     # merged_df["factor"].hist(bins=100, figsize=(18, 9))
     # plt.show()
     # print(merged_df["factor"].skew())
-    # 去极值
-    merged_df["factor"] = SingleFactorStockDataProcessor.winsorize_series(
-        merged_df["factor"]
+    # 去极值(每个交易日的截面分别处理)
+    merged_df["factor"] = SingleFactorStockDataProcessor.winsorize_by_date(
+        merged_df["factor"], merged_df["date"]
     )
 
-    # 标准化
-    merged_df["factor"] = SingleFactorStockDataProcessor.standardize_series(
-        merged_df["factor"]
+    # 标准化(每个交易日的截面分别处理)
+    merged_df["factor"] = SingleFactorStockDataProcessor.standardize_by_date(
+        merged_df["factor"], merged_df["date"]
     )
     # merged_df["factor"].hist(bins=100, figsize=(18, 9))
     # plt.show()
 
-    # 中性化
-    ## 创建行业哑变量
-    industry_dummies = pd.get_dummies(merged_df["industry"], prefix="industry")
-    industry_dummies = industry_dummies.astype(int)
-    ## 中性化处理
-    merged_df["size_factor_neutralize"] = SingleFactorStockDataProcessor.neutralize(
-        merged_df["factor"], industry_dummies
+    # 行业中性化(每个交易日的截面分别回归，等价于减去当天同行业的均值)
+    merged_df["size_factor_neutralize"] = SingleFactorStockDataProcessor.neutralize_by_date(
+        merged_df["factor"], merged_df["date"], merged_df["industry"]
     )
     # merged_df[['factor', 'size_factor_neutralize']].hist(bins=100, figsize=(18, 9))
     # plt.show()
@@ -200,21 +346,18 @@ if __name__ == "__main__":
     )
     performance_log.info(group_df.head(5))
 
-    # alphalens数据处理
-    factor_data = alphalens.utils.get_clean_factor_and_forward_returns(
-        factor_df,
-        price_df,
-        group_df["industry"],
-        quantiles=10,
-        periods=(1, 5, 10),
-    )
-    # alphalens - -IC分析的报告完整
-    alphalens.tears.create_full_tear_sheet(
-        factor_data, long_short=False, group_neutral=False, by_group=False
-    )
-    # alphalens--IC分析的报告
-    # alphalens.tears.create_information_tear_sheet(factor_data, group_neutral=False, by_group=False)
-    # alphalens--收益率分析的报告
-    # alphalens.tears.create_returns_tear_sheet(factor_data, long_short=False, group_neutral=False, by_group=False)
-    # alphalens--换手率分析的报告
-    # alphalens.tears.create_turnover_tear_sheet(factor_data)
+    # 因子分析：IC、IC 衰减、分层收益、换手率和按行业的结果，与 alphalens 相同
+    analyzer = FactorAnalyzer(price_df, periods=(1, 5, 10))
+    report = analyzer.analyze(factor_df["size_factor_neutralize"], group_df["industry"], quantiles=10)
+    performance_log.info(report.summary())
+    performance_log.info(report.quantile_returns)
+    performance_log.info(report.ic_by_group)
+
+    # 多个因子批量分析：价格透视表和远期收益只计算一次，各因子在多个进程中并行分析
+    # summary, reports = processor.evaluate_factors(["factor", "volume"])
+    # performance_log.info(summary)
+
+    # 需要 alphalens 的完整图表时改为 True
+    show_tear_sheet = False
+    if show_tear_sheet:
+        alphalens_tear_sheet(factor_df, price_df, group_df["industry"], quantiles=10, periods=(1, 5, 10))
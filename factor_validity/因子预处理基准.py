@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import time
+
+import numpy as np
+import pandas as pd
+
+from base.log import performance_log
+from base.stock_processor import StockDataProcessor
+
+
+def make_panel(rng, n_stocks, n_days):
+    """
+    因子面板：约 5% 为空值，行的顺序打乱。
+    :return: (因子值, 交易日期)
+    """
+    dates = np.repeat(pd.bdate_range("2008-01-01", periods=n_days), n_stocks)
+    factor = rng.standard_t(3, dates.size)
+    factor[rng.random(factor.size) < 0.05] = np.nan
+    shuffle = rng.permutation(factor.size)
+    return pd.Series(factor[shuffle]), pd.Series(dates[shuffle])
+
+
+def benchmark_by_date(factor, dates, n_sample_dates=100):
+    """
+    去极值、MAD 过滤、标准化的逐日截面处理，与逐日 groupby-transform 的结果比较(对照只取前 n_sample_dates 个交易日)。
+    """
+    sample = dates.isin(dates.unique()[:n_sample_dates])
+    for by_date, whole in (
+        (StockDataProcessor.winsorize_by_date, StockDataProcessor.winsorize_series),
+        (StockDataProcessor.filter_extreme_by_mad_by_date, StockDataProcessor.filter_extreme_by_mad),
+        (StockDataProcessor.standardize_by_date, StockDataProcessor.standardize_series),
+    ):
+        start = time.perf_counter()
+        by_date(factor, dates)
+        by_date_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        expected = factor[sample].groupby(dates[sample]).transform(whole)
+        groupby_time = time.perf_counter() - start
+
+        pd.testing.assert_series_equal(by_date(factor[sample], dates[sample]), expected)
+        performance_log.info(
+            "%s %d rows: %.2fs, groupby-transform %.2fs for %d dates"
+            % (by_date.__name__, factor.size, by_date_time, groupby_time, n_sample_dates)
+        )
+
+
+def benchmark_neutralize(rng, factor, dates, n_sample_dates=20):
+    """
+    行业中性化：31 个行业，对照为每个交易日单独拟合 sm.OLS(行业哑变量 + 对数市值)，只取前 n_sample_dates 个交易日。
+    """
+    industry = pd.Series(pd.Categorical.from_codes(rng.integers(0, 31, factor.size), ["行业%d" % i for i in range(31)]))
+    log_cap = pd.Series(rng.normal(22, 1, factor.size))
+    sample = dates.isin(dates.unique()[:n_sample_dates])
+    for exposures in (None, log_cap):
+        start = time.perf_counter()
+        StockDataProcessor.neutralize_by_date(factor, dates, industry, exposures)
+        by_date_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        expected = pd.Series(np.nan, index=factor.index[sample])
+        for _, group in factor[sample].groupby(dates[sample]):
+            group = group.dropna()
+            x = pd.get_dummies(industry[group.index]).astype(float)
+            if exposures is not None:
+                x["对数市值"] = exposures[group.index]
+            expected[group.index] = StockDataProcessor.neutralize(group, x)
+        ols_time = time.perf_counter() - start
+
+        pd.testing.assert_series_equal(
+            StockDataProcessor.neutralize_by_date(
+                factor[sample], dates[sample], industry[sample],
+                None if exposures is None else exposures[sample],
+            ),
+            expected,
+            check_names=False,
+        )
+        performance_log.info(
+            "neutralize_by_date %s %d rows: %.2fs, per-date OLS %.2fs for %d dates"
+            % ("industry" if exposures is None else "industry + log cap", factor.size, by_date_time, ols_time,
+               n_sample_dates)
+        )
+
+
+if __name__ == "__main__":
+    # 全市场规模：5000 只股票 x 4000 个交易日
+    rng = np.random.default_rng(0)
+    factor, dates = make_panel(rng, 5000, 4000)
+    benchmark_by_date(factor, dates)
+    benchmark_neutralize(rng, factor, dates)